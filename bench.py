@@ -0,0 +1,772 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import shutil
+import subprocess
+import threading
+import sqlite3
+import re
+import csv
+import io
+import zipfile
+import itertools
+import http.server
+import socketserver
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+# Offline benchmark for index.py: local stand-ins for every Zoho and HubSpot endpoint the migration
+# calls, a set of scripted scenarios run against them, and a results file to compare runs
+
+BENCH_RESULTS_FILE = os.getenv("BENCH_RESULTS_FILE", "bench_results.jsonl")
+BENCH_REGRESSION_THRESHOLD = float(os.getenv("BENCH_REGRESSION_THRESHOLD", "0.15"))  # Relative drop that counts as a regression
+BENCH_TIMEOUT = int(os.getenv("BENCH_TIMEOUT", "1800"))  # Seconds before a scenario run is killed
+INDEX_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.py")
+ZOHO_TIMEZONE = timezone(timedelta(hours=5, minutes=30))
+INITIAL_TIME = "2024-01-01T00:00:00+05:30"  # Modified_Time and Created_Time of the generated records
+STAND_IN_USERS = 4  # Zoho users owning the deals in turn; the last one has no HubSpot owner
+STAND_IN_DEFAULT_OWNER_ID = "61009999"  # DEFAULT_HUBSPOT_OWNER_ID given to index.py
+
+# Stand-in server behaviour; each scenario overrides some of these
+DEFAULT_SERVER_SETTINGS = {
+    "deals": 100,
+    "max_attachments_per_deal": 4,  # Each deal gets 0..N attachments
+    "attachment_rate": 1.0,  # Share of deals that get any attachments at all
+    "min_size": 20 * 1024,
+    "max_size": 2 * 1024 * 1024,
+    "large_rate": 0.0,  # Share of attachments that are large_size instead
+    "large_size": 0,
+    "duplicate_rate": 0.0,  # Share of attachments whose content repeats an earlier one
+    "latency_ms": 20,  # Added to every response, plus up to 50% jitter
+    "download_bytes_per_second": 0,  # Per-connection download bandwidth; 0 for unlimited
+    "zoho_rate": 0,  # Requests per second before answering 429; 0 for unlimited
+    "hubspot_rate": 0,
+    "throttle_rate": 0.0,  # Share of requests answered with a random 429
+    "error_rate": 0.0,  # Share of requests answered with a 503
+    "drop_rate": 0.0,  # Share of downloads cut off halfway through the body
+    "range_requests": True,  # Answer Range requests with 206 partial content
+    "ai_batch_seconds": 2,  # How long a stand-in Message Batch stays in_progress
+    "seed": 42
+}
+
+# name -> stand-in settings, extra environment for index.py and extra command line arguments.
+# "phases" runs index.py once per argument list, one after the other, and measures them together.
+# With "changed_deals", a full pass runs first and is not measured; then that many deals each get
+# a new attachment, and the measured run only has to pick those up
+SCENARIOS = {
+    "baseline": {},
+    "high_latency": {"server": {"latency_ms": 250}},
+    "rate_limited": {"server": {"zoho_rate": 8, "hubspot_rate": 8},
+                     "env": {"ZOHO_REQUESTS_PER_SECOND": "20", "HUBSPOT_REQUESTS_PER_SECOND": "20"}},
+    "flaky": {"server": {"throttle_rate": 0.05, "error_rate": 0.05}},
+    "large_files": {"server": {"deals": 20, "min_size": 8 * 1024 * 1024, "max_size": 32 * 1024 * 1024,
+                               "download_bytes_per_second": 20 * 1024 * 1024}},
+    "huge_files": {"server": {"deals": 12, "max_attachments_per_deal": 1, "min_size": 128 * 1024 * 1024,
+                              "max_size": 256 * 1024 * 1024, "download_bytes_per_second": 20 * 1024 * 1024}},
+    "parallel_ranges": {"server": {"deals": 12, "max_attachments_per_deal": 1, "min_size": 128 * 1024 * 1024,
+                                   "max_size": 256 * 1024 * 1024, "download_bytes_per_second": 20 * 1024 * 1024},
+                        "env": {"PARALLEL_RANGE_THRESHOLD": str(64 * 1024 * 1024)}},
+    "small_staging_quota": {"server": {"min_size": 1024 * 1024, "max_size": 4 * 1024 * 1024},
+                            "env": {"STAGING_QUOTA_BYTES": str(16 * 1024 * 1024)}},
+    "dropped_downloads": {"server": {"min_size": 1024 * 1024, "max_size": 8 * 1024 * 1024, "drop_rate": 0.2}},
+    "streaming": {"server": {"deals": 40, "min_size": 1024 * 1024, "max_size": 8 * 1024 * 1024,
+                             "download_bytes_per_second": 20 * 1024 * 1024},
+                  "env": {"STREAMING_TRANSFER": "1"}},
+    "duplicates": {"server": {"duplicate_rate": 0.5}},
+    "bulk_read": {"env": {"ZOHO_DEAL_SOURCE": "bulk", "BULK_POLL_INTERVAL": "1"}},
+    "workers": {"args": ["--workers", "4"]},
+    "delta_nightly": {"changed_deals": 5, "args": ["--delta"]},
+    "sparse_deals": {"server": {"deals": 500, "attachment_rate": 0.05}},
+    "coql_discovery": {"server": {"deals": 500, "attachment_rate": 0.05}, "env": {"ZOHO_ATTACHMENT_SOURCE": "coql"}},
+    "bulk_discovery": {"server": {"deals": 500, "attachment_rate": 0.05},
+                       "env": {"ZOHO_ATTACHMENT_SOURCE": "bulk", "BULK_POLL_INTERVAL": "1"}},
+    "two_phase": {"phases": [["extract"], ["load"]]},
+    "reconcile": {"phases": [[], ["reconcile"]]},
+    "month_folders": {"env": {"HUBSPOT_FOLDER_LAYOUT": "month"}},
+    "ai_tagging": {"server": {"duplicate_rate": 0.3}, "env": {"AI_TAGGING": "1", "AI_BATCH_SIZE": "50", "AI_POLL_INTERVAL": "1"}},
+    "streaming_tagging": {"env": {"STREAMING_TRANSFER": "1", "AI_TAGGING": "1", "AI_BATCH_SIZE": "50", "AI_POLL_INTERVAL": "1"}},
+    "mixed_sizes": {"server": {"deals": 200, "large_rate": 0.02, "large_size": 96 * 1024 * 1024,
+                               "download_bytes_per_second": 16 * 1024 * 1024},
+                    "env": {"ZOHO_ATTACHMENT_SOURCE": "coql"}}
+}
+
+# Field metadata served by /settings/fields, enough for fields.py and the migration's schema check
+STAND_IN_FIELDS = {
+    "Deals": [{"field_label": "Deal Name", "api_name": "Deal_Name", "data_type": "text"},
+              {"field_label": "Stage", "api_name": "Stage", "data_type": "picklist",
+               "pick_list_values": [{"display_value": "Qualification"}, {"display_value": "Closed Won"}]},
+              {"field_label": "Amount", "api_name": "Amount", "data_type": "currency"},
+              {"field_label": "Deal Owner", "api_name": "Owner", "data_type": "ownerlookup"},
+              {"field_label": "Modified Time", "api_name": "Modified_Time", "data_type": "datetime"}],
+    "Accounts": [{"field_label": "Account Name", "api_name": "Account_Name", "data_type": "text"}],
+    "Contacts": [{"field_label": "Last Name", "api_name": "Last_Name", "data_type": "text"},
+                 {"field_label": "Email Opt Out", "api_name": "Email_Opt_Out", "data_type": "boolean"}]
+}
+
+# Token bucket answering "may this request go through now?" without blocking
+class Bucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False, 0
+            self.tokens -= 1
+            return True, int(self.tokens)
+
+# Synthetic Zoho deals, attachments and matching HubSpot deals, generated from a seed so
+# every run of a scenario migrates the same data
+def build_dataset(settings):
+    rng = random.Random(settings["seed"])
+    deals, attachments, contents = [], {}, []
+    # HubSpot emails differ in case from Zoho's, which the owner match has to ignore
+    users = [{"id": str(3876000000000 + k), "full_name": f"Owner {k}", "email": f"owner{k}@example.com"} for k in range(STAND_IN_USERS)]
+    owners = [{"id": str(61000000 + k), "email": user["email"].capitalize()} for k, user in enumerate(users[:-1])]
+    for i in range(settings["deals"]):
+        deal_id = str(4876000000000 + i)
+        user = users[i % len(users)]
+        deals.append({"id": deal_id, "Deal_Name": f"Deal {i}", "Stage": "Closed Won", "Amount": 1000 + i,
+                      "Owner": {"name": user["full_name"], "id": user["id"], "email": user["email"]}, "Modified_Time": INITIAL_TIME})
+        attachments[deal_id] = []
+        if settings["attachment_rate"] < 1 and rng.random() >= settings["attachment_rate"]:
+            continue
+        for j in range(rng.randint(0, settings["max_attachments_per_deal"])):
+            attachment_id = str(5876000000000 + i * 100 + j)
+            if contents and rng.random() < settings["duplicate_rate"]:
+                content_key, size = rng.choice(contents)
+            else:
+                content_key, size = attachment_id, rng.randint(settings["min_size"], settings["max_size"])
+                if settings["large_rate"] and rng.random() < settings["large_rate"]:
+                    size = settings["large_size"]
+                contents.append((content_key, size))
+            attachments[deal_id].append({"id": attachment_id, "File_Name": f"file_{attachment_id}.pdf", "Size": str(size),
+                                         "Created_Time": INITIAL_TIME, "content_key": content_key})
+    return {"deals": deals, "attachments": attachments, "notes": {}, "files": set(), "file_folders": {}, "folders": {}, "ai_batches": {},
+            "users": users, "owners": owners,
+            "owner_of_user": {user["id"]: owner["id"] for user, owner in zip(users, owners)},
+            "by_id": {a["id"]: a for items in attachments.values() for a in items},
+            "hubspot_deals": [{"id": str(91000000 + i), "properties": {"zoho_deal_id": d["id"]}} for i, d in enumerate(deals)]}
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, settings):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.settings = settings
+        self.data = build_dataset(settings)
+        self.buckets = {"zoho": Bucket(settings["zoho_rate"]) if settings["zoho_rate"] else None,
+                        "hubspot": Bucket(settings["hubspot_rate"]) if settings["hubspot_rate"] else None}
+        self.rng = random.Random(settings["seed"])
+        self.lock = threading.Lock()
+        self.stats = {"calls": {}, "throttled": 0, "errors": 0, "downloaded_bytes": 0, "uploaded_bytes": 0,
+                      "uploads": 0, "folders": 0, "notes": 0, "noted_attachments": 0, "dropped": 0, "ai_requests": 0}
+        self.bulk_jobs = []
+        self.ids = itertools.count(1)  # HubSpot file and note IDs; not reset with the stats
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    # Clients hanging up mid-response (killed runs, abandoned streams) are expected here
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.update({key: {} if key == "calls" else 0 for key in self.stats})
+
+    # Touch `count` deals the way a user adding a file in Zoho would: a new attachment and a newer Modified_Time
+    def add_attachments(self, count):
+        now = datetime.now(ZOHO_TIMEZONE).isoformat(timespec="seconds")
+        added = []
+        for deal in random.Random(self.settings["seed"] + 1).sample(self.data["deals"], min(count, len(self.data["deals"]))):
+            attachment_id = str(6876000000000 + len(added))
+            attachment = {"id": attachment_id, "File_Name": f"file_{attachment_id}.pdf", "Size": str(self.settings["min_size"]),
+                          "Created_Time": now, "content_key": attachment_id}
+            with self.lock:
+                deal["Modified_Time"] = now
+                self.data["attachments"][deal["id"]].append(attachment)
+                self.data["by_id"][attachment_id] = attachment
+            added.append(attachment)
+        return added
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", content_type="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Read (and, for uploads, discard) a request body sent with Content-Length or chunked encoding.
+    # The first few KB are always kept in self.body_head, where multipart form fields are
+    def read_body(self, keep=True):
+        data, total = [], 0
+        self.body_head = b""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                length = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if length == 0:
+                    self.rfile.readline()
+                    break
+                chunk = self.rfile.read(length)
+                self.rfile.readline()
+                if len(self.body_head) < 4096:
+                    self.body_head += chunk[:4096]
+                total += len(chunk)
+                if keep:
+                    data.append(chunk)
+        else:
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining:
+                chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                if len(self.body_head) < 4096:
+                    self.body_head += chunk[:4096]
+                total += len(chunk)
+                if keep:
+                    data.append(chunk)
+        return b"".join(data), total
+
+    # Latency, rate limits and injected failures; returns True when the request was already answered
+    def simulate(self, api):
+        server = self.server
+        settings = server.settings
+        if settings["latency_ms"]:
+            time.sleep(settings["latency_ms"] / 1000 * (1 + server.rng.random() * 0.5))
+        with server.lock:
+            server.stats["calls"][api] = server.stats["calls"].get(api, 0) + 1
+            roll = server.rng.random()
+        self.rate_headers = {}
+        bucket = server.buckets.get(api)
+        if bucket:
+            allowed, remaining = bucket.take()
+            if api == "hubspot":
+                self.rate_headers = {"X-HubSpot-RateLimit-Max": str(int(bucket.rate)),
+                                     "X-HubSpot-RateLimit-Interval-Milliseconds": "1000",
+                                     "X-HubSpot-RateLimit-Remaining": str(remaining)}
+            else:
+                self.rate_headers = {"X-RATELIMIT-REMAINING": str(remaining),
+                                     "X-RATELIMIT-RESET": str(int((time.time() + 1) * 1000))}
+            if not allowed:
+                server.count("throttled")
+                self.send(429, {"status": "error", "message": "rate limit"}, headers=dict(self.rate_headers, **{"Retry-After": "1"}))
+                return True
+        if roll < settings["throttle_rate"]:
+            server.count("throttled")
+            self.send(429, {"status": "error", "message": "rate limit"}, headers={"Retry-After": "1"})
+            return True
+        if roll < settings["throttle_rate"] + settings["error_rate"]:
+            server.count("errors")
+            self.send(503, {"status": "error", "message": "unavailable"})
+            return True
+        return False
+
+    # Records changed after the request's If-Modified-Since, like Zoho; all of them without the header
+    def changed_since(self, records, field):
+        since = self.headers.get("If-Modified-Since")
+        if not since:
+            return records
+        since = datetime.fromisoformat(since)
+        return [record for record in records if datetime.fromisoformat(record[field]) > since]
+
+    def api_for(self, path):
+        if path.startswith("/oauth"):
+            return "token"
+        if path.startswith("/v1/messages"):
+            return "anthropic"
+        return "zoho" if path.startswith("/crm/v7") or path.startswith("/crm/bulk") else "hubspot"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path, query = url.path, parse_qs(url.query)
+        if self.simulate(self.api_for(path)):
+            return
+        data = self.server.data
+        if path == "/crm/v7/Deals" and "ids" in query:
+            ids = set(query["ids"][0].split(","))
+            deals = [{"id": d["id"], "Owner": d["Owner"]} for d in data["deals"] if d["id"] in ids]
+            return self.send(200, {"data": deals, "info": {"more_records": False}}, headers=self.rate_headers) if deals else self.send(204)
+        if path == "/crm/v7/Deals":
+            page, per_page = int(query.get("page", ["1"])[0]), int(query.get("per_page", ["200"])[0])
+            changed = self.changed_since(data["deals"], "Modified_Time")
+            if not changed and self.headers.get("If-Modified-Since"):
+                return self.send(304)
+            deals = changed[(page - 1) * per_page:page * per_page]
+            if not deals:
+                return self.send(204)
+            more = page * per_page < len(changed)
+            return self.send(200, {"data": deals, "info": {"page": page, "per_page": per_page, "more_records": more}}, headers=self.rate_headers)
+        match = re.fullmatch(r"/crm/v7/Deals/(\d+)/Attachments", path)
+        if match:
+            attachments = [{key: value for key, value in a.items() if key != "content_key"}
+                           for a in self.changed_since(data["attachments"].get(match.group(1), []), "Created_Time")]
+            if not attachments and self.headers.get("If-Modified-Since"):
+                return self.send(304)
+            if not attachments:
+                return self.send(204)
+            return self.send(200, {"data": attachments, "info": {"more_records": False}}, headers=self.rate_headers)
+        match = re.fullmatch(r"/v1/messages/batches/(\w+)(/results)?", path)
+        if match and match.group(1) in data["ai_batches"]:
+            return self.send_ai_batch(data["ai_batches"][match.group(1)], bool(match.group(2)))
+        match = re.fullmatch(r"/crm/v7/Attachments/(\d+)", path)
+        if match and match.group(1) in data["by_id"]:
+            return self.send_attachment(data["by_id"][match.group(1)])
+        match = re.fullmatch(r"/crm/bulk/v7/read/(\d+)/result", path)
+        if match:
+            return self.send(200, self.bulk_result(int(match.group(1))), "application/zip", self.rate_headers)
+        match = re.fullmatch(r"/crm/bulk/v7/read/(\d+)", path)
+        if match:
+            job = self.server.bulk_jobs[int(match.group(1))]
+            result = {"page": job["page"], "count": len(job["rows"]), "more_records": job["more_records"]}
+            return self.send(200, {"data": [{"id": match.group(1), "state": "COMPLETED", "result": result}]}, headers=self.rate_headers)
+        if path == "/crm/v7/users":
+            page, per_page = int(query.get("page", ["1"])[0]), int(query.get("per_page", ["200"])[0])
+            users = data["users"][(page - 1) * per_page:page * per_page]
+            if not users:
+                return self.send(204)
+            return self.send(200, {"users": users, "info": {"more_records": page * per_page < len(data["users"])}}, headers=self.rate_headers)
+        if path == "/crm/v3/owners":
+            after, limit = int(query.get("after", ["0"])[0]), int(query.get("limit", ["100"])[0])
+            body = {"results": data["owners"][after:after + limit]}
+            if after + limit < len(data["owners"]):
+                body["paging"] = {"next": {"after": str(after + limit)}}
+            return self.send(200, body, headers=self.rate_headers)
+        if path == "/crm/v7/settings/modules":
+            return self.send(200, {"modules": [{"api_name": name, "api_supported": True} for name in STAND_IN_FIELDS]}, headers=self.rate_headers)
+        if path == "/crm/v7/settings/fields":
+            module = query.get("module", [""])[0]
+            if module not in STAND_IN_FIELDS:
+                return self.send(400, {"code": "INVALID_MODULE", "message": f"no module {module}"})
+            etag = '"' + hashlib.sha1(json.dumps(STAND_IN_FIELDS[module]).encode()).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                return self.send(304, headers={"ETag": etag})
+            return self.send(200, {"fields": STAND_IN_FIELDS[module]}, headers=dict(self.rate_headers, ETag=etag))
+        if path == "/files/v3/folders/search":
+            parent, name = query.get("parentFolderIds", [""])[0], query.get("name", [""])[0]
+            folder_id = data["folders"].get((parent, name))
+            return self.send(200, {"results": [{"id": folder_id, "name": name, "parentFolderId": parent}] if folder_id else []}, headers=self.rate_headers)
+        if path == "/files/v3/files/search":
+            return self.send(200, {"results": [{"id": file_id} for file_id in query.get("ids", []) if file_id in data["files"]]}, headers=self.rate_headers)
+        if path == "/crm/v3/objects/deals":
+            after, limit = int(query.get("after", ["0"])[0]), int(query.get("limit", ["100"])[0])
+            body = {"results": data["hubspot_deals"][after:after + limit]}
+            if after + limit < len(data["hubspot_deals"]):
+                body["paging"] = {"next": {"after": str(after + limit)}}
+            return self.send(200, body, headers=self.rate_headers)
+        self.send(404, {"message": f"no stand-in for GET {path}"})
+
+    # Stream the synthetic file body in 64 KB blocks, paced to the configured bandwidth. Honours
+    # single Range requests and, at drop_rate, cuts the connection halfway through the body
+    def send_attachment(self, attachment):
+        settings = self.server.settings
+        size = int(attachment["Size"])
+        block = hashlib.sha256(attachment["content_key"].encode()).digest() * 2048
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        ranged = bool(match) and settings["range_requests"]
+        if ranged:
+            start, end = int(match.group(1)), min(int(match.group(2) or size - 1), size - 1)
+            if start >= size:
+                return self.send(416, headers={"Content-Range": f"bytes */{size}"})
+        length = end - start + 1
+        self.send_response(206 if ranged else 200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Content-Disposition", f'attachment; filename="{attachment["File_Name"]}"')
+        if settings["range_requests"]:
+            self.send_header("Accept-Ranges", "bytes")
+        if ranged:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        for name, value in self.rate_headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        with self.server.lock:
+            cut_at = length // 2 if self.server.rng.random() < settings["drop_rate"] else None
+        bandwidth = settings["download_bytes_per_second"]
+        position = start
+        while position <= end:
+            offset = position % len(block)
+            chunk = block[offset:offset + min(len(block) - offset, end - position + 1)]
+            if cut_at is not None and position - start + len(chunk) > cut_at:
+                self.wfile.write(chunk[:cut_at - (position - start)])
+                self.server.count("dropped")
+                self.close_connection = True
+                return
+            self.wfile.write(chunk)
+            position += len(chunk)
+            if bandwidth:
+                time.sleep(len(chunk) / bandwidth)
+        self.server.count("downloaded_bytes", length)
+
+    def bulk_result(self, job_id):
+        job = self.server.bulk_jobs[job_id]
+        rows = io.StringIO()
+        writer = csv.writer(rows)
+        columns = ["Id"] + [field for field in job["fields"] if field != "id"]
+        writer.writerow(columns)
+        for record in job["rows"]:
+            values = [record["id" if column == "Id" else column] for column in columns]
+            # Lookups such as Owner export as the bare record ID
+            writer.writerow([value["id"] if isinstance(value, dict) else value for value in values])
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w") as z:
+            z.writestr(f"{job_id}.csv", rows.getvalue())
+        return archive.getvalue()
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        api = self.api_for(path)
+        body, size = self.read_body(keep=path != "/files/v3/files")
+        if api != "token" and self.simulate(api):
+            return
+        data = self.server.data
+        if api == "token":
+            return self.send(200, {"access_token": f"bench-{time.time()}", "refresh_token": "bench-refresh", "expires_in": 3600})
+        if path == "/crm/bulk/v7/read":
+            query = json.loads(body)["query"]
+            page, per_page = query.get("page", 1), 200000
+            if query["module"]["api_name"] == "Attachments":
+                records = [dict(a, Parent_Id=deal_id) for deal_id, items in data["attachments"].items() for a in items]
+            else:
+                records = data["deals"]
+            criteria = query.get("criteria")
+            for condition in (criteria.get("group", [criteria]) if criteria else []):
+                if condition["comparator"] == "greater_than":
+                    since = datetime.fromisoformat(condition["value"])
+                    records = [r for r in records if datetime.fromisoformat(r[condition["api_name"]]) > since]
+            with self.server.lock:
+                self.server.bulk_jobs.append({"page": page, "fields": query["fields"], "rows": records[(page - 1) * per_page:page * per_page],
+                                              "more_records": page * per_page < len(records)})
+                job_id = len(self.server.bulk_jobs) - 1
+            return self.send(201, {"data": [{"status": "success", "details": {"id": str(job_id)}}]}, headers=self.rate_headers)
+        if path == "/files/v3/folders":
+            folder = json.loads(body)
+            key = (str(folder["parentFolderId"]), folder["name"])
+            with self.server.lock:
+                if key in data["folders"]:
+                    return self.send(409, {"status": "error", "category": "CONFLICT", "message": "folder already exists"})
+                data["folders"][key] = str(150000000 + next(self.server.ids))
+                self.server.stats["folders"] += 1
+            return self.send(201, {"id": data["folders"][key], "name": folder["name"], "parentFolderId": key[0]}, headers=self.rate_headers)
+        if path == "/v1/messages/batches":
+            batch_requests = json.loads(body)["requests"]
+            with self.server.lock:
+                batch_id = f"msgbatch_{next(self.server.ids)}"
+                data["ai_batches"][batch_id] = {"id": batch_id, "created": time.time(), "requests": batch_requests}
+                self.server.stats["ai_requests"] += len(batch_requests)
+            return self.send_ai_batch(data["ai_batches"][batch_id], False)
+        if path == "/crm/v3/objects/notes/batch/update":
+            results = []
+            with self.server.lock:
+                for update in json.loads(body)["inputs"]:
+                    if update["id"] in data["notes"]:
+                        data["notes"][update["id"]]["body"] = update["properties"]["hs_note_body"]
+                        results.append({"id": update["id"]})
+            return self.send(200, {"status": "COMPLETE", "results": results}, headers=self.rate_headers)
+        if path == "/crm/v7/coql":
+            return self.send_coql(json.loads(body)["select_query"])
+        if path == "/files/v3/files":
+            folder = re.search(rb'name="folderId"\r\n\r\n([^\r]+)\r\n', self.body_head)
+            with self.server.lock:
+                self.server.stats["uploads"] += 1
+                self.server.stats["uploaded_bytes"] += size
+                file_id = str(180000000 + next(self.server.ids))
+                data["files"].add(file_id)
+                data["file_folders"][file_id] = folder.group(1).decode() if folder else None
+            return self.send(201, {"id": file_id, "size": size}, headers=self.rate_headers)
+        if path == "/crm/v3/objects/notes/batch/read":
+            results = [{"id": note["id"], "properties": {"hs_attachment_ids": note["attachment_ids"]}}
+                       for note in (data["notes"].get(str(i["id"])) for i in json.loads(body)["inputs"]) if note]
+            return self.send(200, {"status": "COMPLETE", "results": results}, headers=self.rate_headers)
+        if path == "/crm/v4/associations/notes/deals/batch/read":
+            results = [{"from": {"id": note["id"]}, "to": [{"toObjectId": int(deal_id), "associationTypes": [{"typeId": 214}]} for deal_id in note["deals"]]}
+                       for note in (data["notes"].get(str(i["id"])) for i in json.loads(body)["inputs"]) if note]
+            return self.send(200, {"status": "COMPLETE", "results": results}, headers=self.rate_headers)
+        if path == "/crm/v3/objects/deals/search":
+            filters = json.loads(body)["filterGroups"][0]["filters"]
+            results = [d for d in data["hubspot_deals"]
+                       if all(f["operator"] != "EQ" or d["properties"].get(f["propertyName"]) == f["value"] for f in filters)]
+            return self.send(200, {"total": len(results), "results": results[:100]}, headers=self.rate_headers)
+        if path == "/crm/v3/objects/notes":
+            return self.send(201, {"id": self.record_note(json.loads(body))}, headers=self.rate_headers)
+        if path == "/crm/v3/objects/notes/batch/create":
+            results = []
+            for note in json.loads(body)["inputs"]:
+                result = {"id": self.record_note(note), "properties": note["properties"]}
+                if "objectWriteTraceId" in note:
+                    result["objectWriteTraceId"] = note["objectWriteTraceId"]
+                results.append(result)
+            return self.send(201, {"status": "COMPLETE", "results": results}, headers=self.rate_headers)
+        self.send(404, {"message": f"no stand-in for POST {path}"})
+
+    # Only the query shape the migration sends: deal attachments after an id, optionally created
+    # after a time, in id order
+    def send_coql(self, select_query):
+        match = re.search(r"id > (\d+)(?: and Created_Time > '([^']+)')? order by id asc limit (\d+)", select_query)
+        if "from Attachments" not in select_query or "$se_module = 'Deals'" not in select_query or not match:
+            return self.send(400, {"code": "SYNTAX_ERROR", "message": "unsupported query in the stand-in"})
+        last_id, since, limit = int(match.group(1)), match.group(2), int(match.group(3))
+        rows = sorted(({"id": a["id"], "Parent_Id": {"id": deal_id}, "File_Name": a["File_Name"], "Size": a["Size"], "Created_Time": a["Created_Time"]}
+                       for deal_id, items in self.server.data["attachments"].items() for a in items
+                       if int(a["id"]) > last_id and (not since or datetime.fromisoformat(a["Created_Time"]) > datetime.fromisoformat(since))),
+                      key=lambda row: int(row["id"]))
+        if not rows:
+            return self.send(204)
+        return self.send(200, {"data": rows[:limit], "info": {"count": min(len(rows), limit), "more_records": len(rows) > limit}}, headers=self.rate_headers)
+
+    # A Message Batch, or its JSONL results once ai_batch_seconds have passed. Every request gets a
+    # fixed reply naming the file it was about
+    def send_ai_batch(self, batch, results):
+        ended = time.time() - batch["created"] >= self.server.settings["ai_batch_seconds"]
+        if results:
+            if not ended:
+                return self.send(404, {"type": "error", "error": {"type": "not_found_error", "message": "results not ready"}})
+            lines = []
+            for request in batch["requests"]:
+                prompt = request["params"]["messages"][0]["content"][-1]["text"]
+                file_name = re.match(r"File name: (.*)", prompt).group(1)
+                reply = json.dumps({"document_type": "Contract", "summary": f"Stand-in summary of {file_name}."})
+                message = {"id": f"msg_{request['custom_id'][:8]}", "type": "message", "role": "assistant", "model": request["params"]["model"],
+                           "content": [{"type": "text", "text": reply}], "stop_reason": "end_turn", "stop_sequence": None,
+                           "usage": {"input_tokens": 100, "output_tokens": 30}}
+                lines.append(json.dumps({"custom_id": request["custom_id"], "result": {"type": "succeeded", "message": message}}))
+            return self.send(200, "\n".join(lines).encode(), "application/binary")
+        count = len(batch["requests"])
+        created = datetime.fromtimestamp(batch["created"], timezone.utc).isoformat()
+        return self.send(200, {
+            "id": batch["id"], "type": "message_batch", "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {"processing": 0 if ended else count, "succeeded": count if ended else 0, "errored": 0, "canceled": 0, "expired": 0},
+            "created_at": created, "expires_at": created, "ended_at": created if ended else None, "archived_at": None, "cancel_initiated_at": None,
+            "results_url": f"{self.server.url}/v1/messages/batches/{batch['id']}/results" if ended else None})
+
+    def record_note(self, note):
+        attachment_ids = [a for a in str(note["properties"].get("hs_attachment_ids", "")).split(";") if a]
+        with self.server.lock:
+            self.server.stats["notes"] += 1
+            self.server.stats["noted_attachments"] += len(attachment_ids)
+            note_id = str(270000000 + next(self.server.ids))
+            self.server.data["notes"][note_id] = {"id": note_id, "attachment_ids": ";".join(attachment_ids),
+                                                  "owner": note["properties"].get("hubspot_owner_id"),
+                                                  "body": note["properties"].get("hs_note_body", ""),
+                                                  "deals": [str(a["to"]["id"]) for a in note.get("associations", [])]}
+        return note_id
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(INDEX_SCRIPT)).stdout.strip() or None
+    except OSError:
+        return None
+
+# Fresh working directory with stored (expired) tokens, so every run starts headless and refreshes once
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix="migration-bench-")
+    for token_file in ("zoho_tokens.json", "hubspot_tokens.json"):
+        with open(os.path.join(workdir, token_file), "w") as f:
+            json.dump({"access_token": "expired", "refresh_token": "bench-refresh", "expires_at": 0}, f)
+    with open(os.path.join(workdir, "hubspot_folder_config.json"), "w") as f:
+        json.dump({"folder_id": "1000"}, f)
+    return workdir
+
+def run_index(arguments, workdir, env, log_name):
+    with open(os.path.join(workdir, log_name), "w") as log:
+        try:
+            return subprocess.run([sys.executable, INDEX_SCRIPT, "--headless"] + arguments, cwd=workdir, env=env,
+                                  stdout=log, stderr=subprocess.STDOUT, timeout=BENCH_TIMEOUT).returncode
+        except subprocess.TimeoutExpired:
+            return "timeout"
+
+def noted_attachment_ids(workdir):
+    path = os.path.join(workdir, "migration.db")
+    if not os.path.exists(path):
+        return set()
+    conn = sqlite3.connect(path)
+    noted = {row[0] for row in conn.execute("SELECT zoho_attachment_id FROM attachments WHERE status = 'noted'")}
+    conn.close()
+    return noted
+
+# Uploads that did not go into one of the folders created under the configured root folder
+def unfoldered_uploads(data):
+    folders = set(data["folders"].values())
+    return sum(1 for folder_id in data["file_folders"].values() if folder_id not in folders)
+
+# Notes whose owner is not the HubSpot owner matched to the deal's Zoho owner (or the default owner)
+def misowned_notes(data):
+    zoho_deals = {d["id"]: d["properties"]["zoho_deal_id"] for d in data["hubspot_deals"]}
+    deal_owners = {d["id"]: d["Owner"]["id"] for d in data["deals"]}
+    count = 0
+    for note in data["notes"].values():
+        for deal_id in note["deals"]:
+            if note["owner"] != data["owner_of_user"].get(deal_owners[zoho_deals[deal_id]], STAND_IN_DEFAULT_OWNER_ID):
+                count += 1
+                break
+    return count
+
+# Run one scenario end to end and return its result row
+def run_scenario(name, scenario, deals=None, keep=False):
+    settings = dict(DEFAULT_SERVER_SETTINGS, **scenario.get("server", {}))
+    if deals:
+        settings["deals"] = deals
+    server = StandInServer(settings).start()
+    workdir = prepare_workdir()
+    env = dict(os.environ, ZOHO_API_HOST=server.url, ZOHO_ACCOUNTS_HOST=server.url,
+               HUBSPOT_API_HOST=server.url, HUBSPOT_FILES_HOST=server.url, MIGRATION_DB="migration.db",
+               PYTHONUNBUFFERED="1", DEFAULT_HUBSPOT_OWNER_ID=STAND_IN_DEFAULT_OWNER_ID, ANTHROPIC_BASE_URL=server.url,
+               ANTHROPIC_API_KEY="bench", **scenario.get("env", {}))
+    expected_attachments = list(server.data["by_id"].values())
+    already_noted = set()
+    if scenario.get("changed_deals"):
+        print(f"--------------------------------Benchmark: {name} warm-up pass--------------------------------")
+        run_index([], workdir, env, "warmup.log")
+        already_noted = noted_attachment_ids(workdir)
+        expected_attachments = server.add_attachments(scenario["changed_deals"])
+        server.reset_stats()
+    expected = len(expected_attachments)
+    expected_bytes = sum(int(a["Size"]) for a in expected_attachments)
+    print(f"--------------------------------Benchmark: {name} ({settings['deals']} deals, {expected} files, {expected_bytes / 1048576:.1f} MB)--------------------------------")
+    started = time.perf_counter()
+    phases = scenario.get("phases", [scenario.get("args", [])])
+    returncode, phase_seconds = 0, []
+    for i, arguments in enumerate(phases):
+        phase_started = time.perf_counter()
+        returncode = run_index(arguments, workdir, env, "run.log" if len(phases) == 1 else f"run-{i + 1}.log") or returncode
+        phase_seconds.append(round(time.perf_counter() - phase_started, 3))
+    seconds = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    noted_ids = sorted(noted_attachment_ids(workdir) - already_noted)
+    migrated_bytes = sum(int(server.data["by_id"][i]["Size"]) for i in noted_ids if i in server.data["by_id"])
+    api_calls = sum(count for api, count in server.stats["calls"].items() if api not in ("token", "anthropic"))
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "commit": git_commit(),
+        "scenario": name,
+        "settings": settings,
+        "env": scenario.get("env", {}),
+        "args": scenario.get("args", []),
+        "returncode": returncode,
+        "seconds": round(seconds, 3),
+        "phase_seconds": phase_seconds,
+        "files": len(noted_ids),
+        "expected_files": expected,
+        "megabytes": round(migrated_bytes / 1048576, 3),
+        "files_per_second": round(len(noted_ids) / seconds, 3),
+        "mb_per_second": round(migrated_bytes / 1048576 / seconds, 3),
+        "api_calls": api_calls,
+        "api_calls_per_file": round(api_calls / len(noted_ids), 3) if noted_ids else None,
+        "uploads": server.stats["uploads"],
+        "folders": server.stats["folders"],
+        "unfoldered_uploads": unfoldered_uploads(server.data),
+        "notes": server.stats["notes"],
+        "misowned_notes": misowned_notes(server.data),
+        "ai_requests": server.stats["ai_requests"],
+        "tagged_notes": sum(1 for note in server.data["notes"].values() if "<strong>" in note["body"]),
+        "throttled": server.stats["throttled"],
+        "injected_errors": server.stats["errors"],
+        "dropped_downloads": server.stats["dropped"]
+    }
+    if keep or returncode != 0 or len(noted_ids) != expected:
+        print(f"⚠️ Kept working directory with run.log: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def load_results(path=BENCH_RESULTS_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# Incomplete runs, and slowdowns against the last stored run of the same scenario and settings
+def find_regressions(result, history):
+    previous = [r for r in history if r["scenario"] == result["scenario"] and r["settings"] == result["settings"]
+                and r["env"] == result["env"] and r["args"] == result["args"] and r["files"] == r["expected_files"]]
+    problems = []
+    if result["files"] != result["expected_files"]:
+        problems.append(f"migrated {result['files']} of {result['expected_files']} files")
+    if result.get("unfoldered_uploads"):
+        problems.append(f"{result['unfoldered_uploads']} uploads landed outside the deal and month folders")
+    if result["env"].get("AI_TAGGING") == "1" and result.get("tagged_notes") != result["notes"]:
+        problems.append(f"{result.get('tagged_notes')} of {result['notes']} notes got AI tags")
+    if result.get("misowned_notes"):
+        problems.append(f"{result['misowned_notes']} notes have the wrong owner")
+    if not previous:
+        return problems
+    last = previous[-1]
+    for key in ("files_per_second", "mb_per_second"):
+        if last[key] and result[key] < last[key] * (1 - BENCH_REGRESSION_THRESHOLD):
+            problems.append(f"{key} {result[key]} vs {last[key]} at {last['commit']}")
+    if last["api_calls_per_file"] and result["api_calls_per_file"] and \
+            result["api_calls_per_file"] > last["api_calls_per_file"] * (1 + BENCH_REGRESSION_THRESHOLD):
+        problems.append(f"api_calls_per_file {result['api_calls_per_file']} vs {last['api_calls_per_file']} at {last['commit']}")
+    return problems
+
+def print_summary(results):
+    print(f"{'scenario':<18}{'files':>11}{'seconds':>10}{'files/s':>10}{'MB/s':>9}{'calls/file':>12}{'429s':>7}{'5xx':>6}")
+    for r in results:
+        print(f"{r['scenario']:<18}{r['files']:>5}/{r['expected_files']:<5}{r['seconds']:>10.1f}{r['files_per_second']:>10.2f}"
+              f"{r['mb_per_second']:>9.2f}{r['api_calls_per_file'] or 0:>12.2f}{r['throttled']:>7}{r['injected_errors']:>6}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark index.py against local Zoho and HubSpot stand-ins")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--deals", type=int, help="override the number of deals in every scenario")
+    parser.add_argument("--results", default=BENCH_RESULTS_FILE, help="JSON lines file the results are appended to")
+    parser.add_argument("--no-save", action="store_true", help="do not append this run to the results file")
+    parser.add_argument("--keep", action="store_true", help="keep each scenario's working directory and log")
+    parser.add_argument("--check", action="store_true", help="exit non-zero when a scenario regressed or did not finish")
+    args = parser.parse_args()
+
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    history = load_results(args.results)
+    results, regressions = [], []
+    for name in args.scenarios or SCENARIOS:
+        result = run_scenario(name, SCENARIOS[name], deals=args.deals, keep=args.keep)
+        results.append(result)
+        problems = find_regressions(result, history)
+        for problem in problems:
+            print(f"⚠️ {name}: {problem}")
+        regressions.extend(problems)
+        if not args.no_save:
+            with open(args.results, "a") as f:
+                f.write(json.dumps(result) + "\n")
+    print_summary(results)
+    if args.check and regressions:
+        sys.exit(1)
@@ -1,50 +1,196 @@
 import requests
 import csv
 import os
+import json
+import time
+import argparse
+import sys
+import threading
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
 AQ_ZOHO_ACCESS_TOKEN = os.getenv("AQ_ZOHO_ACCESS_TOKEN")
-module_name = 'Accounts'  # Change to Contacts, Deals, etc.
+ZOHO_API_HOST = os.getenv("ZOHO_API_HOST", "https://www.zohoapis.in")  # Same data center as index.py, whose tokens it can use
+ZOHO_API_BASE = f"{ZOHO_API_HOST}/crm/v7"
+SCHEMA_MODULES = os.getenv("ZOHO_SCHEMA_MODULES", "Accounts,Contacts,Deals")  # Comma separated; --all exports every API-enabled module
+SCHEMA_CACHE_DIR = os.getenv("SCHEMA_CACHE_DIR", "schema_cache")  # One cached response per module
+SCHEMA_CACHE_MAX_AGE = int(os.getenv("SCHEMA_CACHE_MAX_AGE", 0))  # Seconds a cached schema is used without asking Zoho; 0 always revalidates
+SCHEMA_WORKERS = int(os.getenv("SCHEMA_WORKERS", 8))  # Modules fetched at the same time
+SCHEMA_MAX_RETRIES = 3
+ZOHO_SCHEMA_FILE = os.getenv("ZOHO_SCHEMA_FILE", "zoho_schema.json")  # Consolidated bundle, loaded by index.py at startup
+SCHEMA_CSV_FILE = os.getenv("SCHEMA_CSV_FILE", "zoho_schema.csv")
 
-url = f'https://www.zohoapis.com/crm/v7/settings/fields?module={module_name}'
-headers = {
-    'Authorization': f'Zoho-oauthtoken {AQ_ZOHO_ACCESS_TOKEN}'
-}
+# One pooled session for every request, sized so each worker keeps its own connection alive
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=SCHEMA_WORKERS, pool_maxsize=SCHEMA_WORKERS))
+session.mount("http://", HTTPAdapter(pool_connections=SCHEMA_WORKERS, pool_maxsize=SCHEMA_WORKERS))
+print_lock = threading.Lock()
 
-try:
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()  # Raises an HTTPError for bad responses
+def log(message):
+    with print_lock:
+        print(message)
+
+# The migration's stored token works too, refreshed through its refresh token once it has expired,
+# so the exporter runs any time after index.py has authorized
+def get_access_token():
+    if AQ_ZOHO_ACCESS_TOKEN:
+        return AQ_ZOHO_ACCESS_TOKEN
+    from index import ZOHO_TOKENS
+    access_token = ZOHO_TOKENS.get()
+    if not access_token:
+        raise Exception("No Zoho access token. Set AQ_ZOHO_ACCESS_TOKEN or run index.py to authorize first.")
+    return access_token
+
+def get_headers():
+    return {'Authorization': f'Zoho-oauthtoken {get_access_token()}'}
+
+# GET with a few retries on throttling and server errors
+def zoho_get(url, headers, params=None):
+    for attempt in range(SCHEMA_MAX_RETRIES + 1):
+        response = session.get(url, headers=headers, params=params, timeout=60)
+        if response.status_code != 429 and response.status_code < 500 or attempt == SCHEMA_MAX_RETRIES:
+            return response
+        delay = float(response.headers.get("Retry-After") or 2 ** attempt)
+        log(f"🔁 {response.status_code} from {url}, retrying in {delay}s")
+        time.sleep(delay)
+
+# API names of every module the API can read
+def get_all_modules():
+    response = zoho_get(f"{ZOHO_API_BASE}/settings/modules", get_headers())
+    response.raise_for_status()
+    return [module["api_name"] for module in response.json().get("modules", []) if module.get("api_supported", True)]
+
+def cache_path(module_name):
+    return os.path.join(SCHEMA_CACHE_DIR, f"{module_name}.json")
+
+def load_cached(module_name):
+    if not os.path.exists(cache_path(module_name)):
+        return None
+    with open(cache_path(module_name), "r") as f:
+        return json.load(f)
+
+def save_cached(module_name, entry):
+    os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path(module_name) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f)
+    os.replace(tmp_path, cache_path(module_name))
+
+# Fields of one module. A cached copy younger than SCHEMA_CACHE_MAX_AGE is used as is; an older one
+# is revalidated with If-None-Match/If-Modified-Since, so an unchanged schema costs a 304 and no body.
+# Returns (fields, "fetched" | "unchanged" | "cached")
+def get_module_fields(module_name, refresh=False):
+    cached = None if refresh else load_cached(module_name)
+    if cached and time.time() - cached.get("fetched_at", 0) < SCHEMA_CACHE_MAX_AGE:
+        return cached["fields"], "cached"
+    headers = get_headers()
+    if cached and cached.get("etag"):
+        headers['If-None-Match'] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers['If-Modified-Since'] = cached["last_modified"]
+    response = zoho_get(f"{ZOHO_API_BASE}/settings/fields", headers, params={"module": module_name})
+    if response.status_code == 304 and cached:
+        cached["fetched_at"] = time.time()
+        save_cached(module_name, cached)
+        return cached["fields"], "unchanged"
+    response.raise_for_status()
     fields = response.json().get('fields', [])
-    print(f"Fields successfully retrieved for {module_name}")
-    print(f"Total fields: {len(fields)}")
+    save_cached(module_name, {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+        "fields": fields,
+    })
+    return fields, "fetched"
+
+# Picklist options, or true/false for booleans, as listed in the CSV
+def field_values(field):
+    data_type = field.get('data_type')
+    if data_type == 'picklist' or data_type == 'multiselectpicklist':
+        return [value.get('display_value') for value in field.get('pick_list_values', [])]
+    if data_type == 'boolean':
+        return ['true', 'false']
+    return []
 
-    with open(f'{module_name}_fields.csv', mode='w', newline='') as file:
+def schema_field(field):
+    return {
+        "field_label": field.get('field_label'),
+        "api_name": field.get('api_name'),
+        "data_type": field.get('data_type'),
+        "values": field_values(field),
+    }
+
+def write_bundle(schema):
+    bundle = {"generated_at": datetime.now(timezone.utc).isoformat(), "modules": schema}
+    tmp_path = ZOHO_SCHEMA_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(bundle, f, indent=2)
+    os.replace(tmp_path, ZOHO_SCHEMA_FILE)
+    with open(SCHEMA_CSV_FILE, mode='w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(['Field Label', 'API Name', 'Data Type', 'Values'])
-        for field in fields:
-            values = []
-            data_type = field.get('data_type')
-            if data_type == 'picklist' or data_type == 'multiselectpicklist':
-                # Extract values from pick_list_values for picklist or multiselectpicklist
-                values = [value.get('display_value') for value in field.get('pick_list_values', [])]
-                print(f"{data_type} values for {field.get('field_label')}: {values}")  # Debug print
-            elif data_type == 'boolean':
-                # Boolean fields have true/false values
-                values = ['true', 'false']
-                print(f"Boolean values for {field.get('field_label')}: {values}")  # Debug print
-            # Join values into a string for CSV
-            values_str = '; '.join(values) if values else ''
-            writer.writerow([
-                field.get('field_label'),
-                field.get('api_name'),
-                data_type,
-                values_str
-            ])
-    print(f"Fields successfully exported to {module_name}_fields.csv")
-
-except requests.exceptions.HTTPError as http_err:
-    print(f"HTTP error occurred: {http_err}")
-    print(f"Response content: {response.text}")  # Print API error details
-except requests.exceptions.RequestException as err:
-    print(f"Error occurred: {err}")
-except ValueError as json_err:
-    print(f"JSON decoding error: {json_err}")
\ No newline at end of file
+        writer.writerow(['Module', 'Field Label', 'API Name', 'Data Type', 'Values'])
+        for module_name, entry in schema.items():
+            for field in entry["fields"]:
+                writer.writerow([module_name, field["field_label"], field["api_name"], field["data_type"], '; '.join(field["values"])])
+
+# Fetch every module concurrently and write the consolidated JSON and CSV bundle. A module that fails
+# falls back to its cached schema; if one has no cache, the old bundle is kept and None is returned
+def export_schema(modules, refresh=False):
+    print(f"--------------------------------Exporting {len(modules)} module schemas--------------------------------")
+    schema, counts, failed = {}, {"fetched": 0, "unchanged": 0, "cached": 0}, []
+    with ThreadPoolExecutor(max_workers=SCHEMA_WORKERS) as executor:
+        futures = {executor.submit(get_module_fields, module_name, refresh): module_name for module_name in modules}
+        for future in as_completed(futures):
+            module_name = futures[future]
+            try:
+                fields, source = future.result()
+            except requests.exceptions.HTTPError as http_err:
+                log(f"❌ HTTP error for {module_name}: {http_err} - {http_err.response.text}")
+                failed.append(module_name)
+                continue
+            except (requests.exceptions.RequestException, ValueError) as err:
+                log(f"❌ Error for {module_name}: {err}")
+                failed.append(module_name)
+                continue
+            counts[source] += 1
+            schema[module_name] = {"fields": [schema_field(field) for field in fields]}
+            log(f"✅ {module_name}: {len(fields)} fields ({source})")
+    missing = []
+    for module_name in failed:
+        cached = load_cached(module_name)
+        if cached is None:
+            missing.append(module_name)
+            continue
+        schema[module_name] = {"fields": [schema_field(field) for field in cached["fields"]]}
+        log(f"⚠️ {module_name}: using the cached schema from {datetime.fromtimestamp(cached.get('fetched_at', 0), timezone.utc).isoformat()}")
+    print(f"📊 {counts['fetched']} fetched, {counts['unchanged']} unchanged, {counts['cached']} from cache, {len(failed)} failed")
+    if missing:
+        print(f"❌ No schema for {', '.join(missing)}; {ZOHO_SCHEMA_FILE} and {SCHEMA_CSV_FILE} were left unchanged")
+        return None
+    # Keep the bundle in the requested module order so reruns diff cleanly
+    schema = {module_name: schema[module_name] for module_name in modules if module_name in schema}
+    write_bundle(schema)
+    print(f"Schema exported to {ZOHO_SCHEMA_FILE} and {SCHEMA_CSV_FILE}")
+    return schema
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export Zoho CRM field schemas")
+    parser.add_argument("modules", nargs="*", help="Module API names (default: ZOHO_SCHEMA_MODULES)")
+    parser.add_argument("--all", action="store_true", help="Export every module the API can read")
+    parser.add_argument("--refresh", action="store_true", help="Ignore the cache and download every schema")
+    args = parser.parse_args()
+    try:
+        if args.all:
+            modules = get_all_modules()
+        else:
+            modules = args.modules or [module.strip() for module in SCHEMA_MODULES.split(",") if module.strip()]
+        if export_schema(modules, refresh=args.refresh) is None:
+            sys.exit(1)
+    except requests.exceptions.HTTPError as http_err:
+        print(f"HTTP error occurred: {http_err}")
+        print(f"Response content: {http_err.response.text}")
+    except requests.exceptions.RequestException as err:
+        print(f"Error occurred: {err}")
+    except ValueError as json_err:
+        print(f"JSON decoding error: {json_err}")
@@ -10,21 +10,61 @@ import socketserver
 from urllib.parse import parse_qs, urlparse
 # from dotenv import load_dotenv
 import mimetypes
+import queue
+import threading
+import bisect
+import re
+import contextlib
+import socket
+import subprocess
+import sys
+import zlib
+import argparse
+import hashlib
+import random
+import csv
+import io
+import tempfile
+import shutil
+import zipfile
+import uuid
+import mmap
+import tarfile
+import heapq
+import itertools
+import base64
+import html
+import collections
+import traceback
+import atexit
 import requests
+from urllib3.exceptions import NewConnectionError
 
 # Load environment variables
 # load_dotenv()
 
-# API configurations
-ZOHO_API_BASE = "https://www.zohoapis.in/crm/v7"
-HUBSPOT_UPLOAD_URL = "https://api.hubspot.com/files/v3/files"
-HUBSPOT_DEALS_API = "https://api.hubspot.com/crm/v3/objects/deals"
-HUBSPOT_NOTES_API = "https://api.hubspot.com/crm/v3/objects/notes"
-ZOHO_TOKEN_URL = "https://accounts.zoho.in/oauth/v2/token"
-ZOHO_AUTH_URL = "https://accounts.zoho.in/oauth/v2/auth"
+# API configurations. The hosts can be pointed elsewhere, e.g. at the local stand-ins in bench.py
+ZOHO_API_HOST = os.getenv("ZOHO_API_HOST", "https://www.zohoapis.in")
+ZOHO_ACCOUNTS_HOST = os.getenv("ZOHO_ACCOUNTS_HOST", "https://accounts.zoho.in")
+HUBSPOT_API_HOST = os.getenv("HUBSPOT_API_HOST", "https://api.hubspot.com")
+HUBSPOT_FILES_HOST = os.getenv("HUBSPOT_FILES_HOST", "https://api.hubapi.com")
+ZOHO_API_BASE = f"{ZOHO_API_HOST}/crm/v7"
+ZOHO_BULK_API_BASE = f"{ZOHO_API_HOST}/crm/bulk/v7"
+HUBSPOT_UPLOAD_URL = f"{HUBSPOT_FILES_HOST}/files/v3/files"
+HUBSPOT_DEALS_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/deals"
+HUBSPOT_DEALS_SEARCH_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/deals/search"
+HUBSPOT_NOTES_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/notes"
+HUBSPOT_NOTES_BATCH_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/notes/batch/create"
+HUBSPOT_NOTES_BATCH_UPDATE_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/notes/batch/update"
+HUBSPOT_NOTES_BATCH_READ_API = f"{HUBSPOT_API_HOST}/crm/v3/objects/notes/batch/read"
+HUBSPOT_NOTE_DEALS_BATCH_READ_API = f"{HUBSPOT_API_HOST}/crm/v4/associations/notes/deals/batch/read"
+HUBSPOT_FILES_SEARCH_API = f"{HUBSPOT_FILES_HOST}/files/v3/files/search"
+ZOHO_TOKEN_URL = f"{ZOHO_ACCOUNTS_HOST}/oauth/v2/token"
+ZOHO_AUTH_URL = f"{ZOHO_ACCOUNTS_HOST}/oauth/v2/auth"
 HUBSPOT_AUTH_URL = "https://app.hubspot.com/oauth/authorize"
-HUBSPOT_TOKEN_URL = "https://api.hubspot.com/oauth/v1/token"
-HUBSPOT_FOLDERS_API = "https://api.hubspot.com/files/v3/folders"
+HUBSPOT_TOKEN_URL = f"{HUBSPOT_API_HOST}/oauth/v1/token"
+HUBSPOT_FOLDERS_API = f"{HUBSPOT_API_HOST}/files/v3/folders"
+HUBSPOT_OWNERS_API = f"{HUBSPOT_API_HOST}/crm/v3/owners"
 
 # OAuth configurations
 ZOHO_CLIENT_ID = os.getenv("ZOHO_CLIENT_ID")
@@ -32,25 +72,161 @@ ZOHO_CLIENT_SECRET = os.getenv("ZOHO_CLIENT_SECRET")
 HUBSPOT_CLIENT_ID = os.getenv("HUBSPOT_CLIENT_ID")
 HUBSPOT_CLIENT_SECRET = os.getenv("HUBSPOT_CLIENT_SECRET")
 REDIRECT_URI = "http://localhost:8000"
-ZOHO_SCOPE = "ZohoCRM.modules.ALL,ZohoCRM.bulk.ALL,ZohoCRM.Files.READ"
-HUBSPOT_SCOPE = "crm.import files crm.objects.deals.read crm.objects.deals.write"
+ZOHO_SCOPE = "ZohoCRM.modules.ALL,ZohoCRM.bulk.ALL,ZohoCRM.Files.READ,ZohoCRM.coql.READ,ZohoCRM.users.READ"
+HUBSPOT_SCOPE = "crm.import files crm.objects.deals.read crm.objects.deals.write crm.objects.owners.read"
 TOKEN_FILE = "zoho_tokens.json"
 HUBSPOT_TOKEN_FILE = "hubspot_tokens.json"
 FOLDER_CONFIG_FILE = "hubspot_folder_config.json"
-DB_FILE = "migration.db"  # Initialize DB_FILE here
+DB_FILE = os.getenv("MIGRATION_DB", "migration.db")  # Shared by every worker process when sharded
 ATTACHMENTS_FOLDER = os.getenv("ATTACHMENTS_FOLDER", "attachments")
+STAGING_QUOTA_BYTES = int(os.getenv("STAGING_QUOTA_BYTES", str(20 * 1024 ** 3)))  # Most bytes kept in ATTACHMENTS_FOLDER
+STAGING_MIN_FREE_BYTES = int(os.getenv("STAGING_MIN_FREE_BYTES", str(1024 ** 3)))  # Never stage a file that would leave less free disk
+STAGING_WAIT_SECONDS = int(os.getenv("STAGING_WAIT_SECONDS", "300"))  # How long a download waits for room before going to the retry queue
+ARCHIVE_FOLDER = os.getenv("ARCHIVE_FOLDER", "archives")  # Tar chunks and manifests written by `extract` and read by `load`
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", str(4 * 1024 ** 3)))  # Start a new archive chunk past this size
+# Uploads go into subfolders of the chosen HubSpot folder: "deal" (one per Zoho deal), "month" (year,
+# then month, of the attachment's Zoho Created_Time) or "none" (the chosen folder itself)
+HUBSPOT_FOLDER_LAYOUT = os.getenv("HUBSPOT_FOLDER_LAYOUT", "deal")
+
+# Pipeline concurrency: worker threads per stage and the size of the queue feeding each stage
+LIST_WORKERS = int(os.getenv("LIST_WORKERS", "4"))
+DOWNLOAD_WORKERS = int(os.getenv("DOWNLOAD_WORKERS", "8"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+NOTE_WORKERS = int(os.getenv("NOTE_WORKERS", "4"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "500"))
+# Files at least LARGE_FILE_THRESHOLD bytes go through a separate large-file lane with its own workers
+LARGE_FILE_THRESHOLD = int(os.getenv("LARGE_FILE_THRESHOLD", str(64 * 1024 * 1024)))
+LARGE_DOWNLOAD_WORKERS = int(os.getenv("LARGE_DOWNLOAD_WORKERS", "2"))
+LARGE_UPLOAD_WORKERS = int(os.getenv("LARGE_UPLOAD_WORKERS", "2"))
+# Throughput assumed by the run estimate until a run of at least ESTIMATE_MIN_BYTES has measured it
+ESTIMATE_BYTES_PER_SECOND = float(os.getenv("ESTIMATE_BYTES_PER_SECOND", str(20 * 1024 * 1024)))  # All transfers together
+ESTIMATE_STREAM_BYTES_PER_SECOND = float(os.getenv("ESTIMATE_STREAM_BYTES_PER_SECOND", str(5 * 1024 * 1024)))  # One transfer
+ESTIMATE_MIN_BYTES = 64 * 1024 * 1024
+PIPELINE_STATUS_INTERVAL = int(os.getenv("PIPELINE_STATUS_INTERVAL", "10"))  # Seconds between progress lines and metrics file writes
+METRICS_FILE = os.getenv("METRICS_FILE", "migration_metrics.prom")  # Prometheus text format; empty to disable
+EVENT_LOG_FILE = os.getenv("EVENT_LOG_FILE", "migration_events.jsonl")  # Structured JSON Lines event log; empty to disable
+EVENT_LOG_LEVEL = os.getenv("EVENT_LOG_LEVEL", "debug")  # Lowest level written to EVENT_LOG_FILE
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")  # Lowest level printed to the console
+EVENT_LOG_MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", str(64 * 1024 * 1024)))  # Rotate the event log past this size
+EVENT_LOG_BACKUPS = int(os.getenv("EVENT_LOG_BACKUPS", "5"))  # Rotated files kept as EVENT_LOG_FILE.1 ... .N
+EVENT_LOG_FLUSH_SECONDS = 1
+EVENT_LOG_BUFFER = 100000  # Records waiting for the writer before debug and info records are dropped
+EVENT_FIELD_MAX_CHARS = 2000  # Response bodies and other long fields are cut to this length
+ERROR_RING_SIZE = int(os.getenv("ERROR_RING_SIZE", "200"))  # Recent warnings and errors kept for the crash dump
+CRASH_DUMP_FILE = os.getenv("CRASH_DUMP_FILE", "migration_crash.jsonl")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))  # Keep-alive connections per API host
+TOKEN_REFRESH_MARGIN = 300  # Refresh access tokens this many seconds before they expire
+STREAMING_TRANSFER = os.getenv("STREAMING_TRANSFER", "0") == "1"  # Pipe Zoho downloads straight into HubSpot uploads
+STREAM_CHUNK_SIZE = 64 * 1024  # Bytes held in memory per streaming transfer
+DELTA_SYNC = os.getenv("MIGRATION_DELTA", "0") == "1"  # Only list deals changed since the last clean pass
+RANGE_CHECKPOINT_BYTES = int(os.getenv("RANGE_CHECKPOINT_BYTES", str(8 * 1024 * 1024)))  # Download progress saved to the state store this often
+PARALLEL_RANGE_THRESHOLD = int(os.getenv("PARALLEL_RANGE_THRESHOLD", str(256 * 1024 * 1024)))  # Files this big are fetched as parallel byte ranges
+PARALLEL_RANGE_PARTS = int(os.getenv("PARALLEL_RANGE_PARTS", "4"))  # Byte ranges fetched at once for one large file
+ZOHO_SCHEMA_FILE = os.getenv("ZOHO_SCHEMA_FILE", "zoho_schema.json")  # Field bundle written by fields.py, read instead of the API
+# "deals" lists each deal's attachments; "coql" or "bulk" discover every deal attachment up front in a
+# few paged calls; "stored" works through the list already in migration.db without calling Zoho for it
+ZOHO_ATTACHMENT_SOURCE = os.getenv("ZOHO_ATTACHMENT_SOURCE", "deals")
+COQL_PAGE_SIZE = 2000  # Most rows one COQL query returns
+ZOHO_DEAL_SOURCE = os.getenv("ZOHO_DEAL_SOURCE", "api")  # "api" pages through /Deals, "bulk" runs a Bulk Read export
+ZOHO_PAGE_SIZE = 200  # Maximum records per page for Zoho list endpoints
+BULK_POLL_INTERVAL = float(os.getenv("BULK_POLL_INTERVAL", "10"))  # Seconds between Bulk Read job status checks
+DEDUPLICATE_UPLOADS = os.getenv("DEDUPLICATE_UPLOADS", "1") == "1"  # Reuse the HubSpot file for identical content
+NOTE_BATCHING = os.getenv("NOTE_BATCHING", "1") == "1"  # One note per deal carrying all its attachments
+NOTE_MAX_ATTACHMENTS = int(os.getenv("NOTE_MAX_ATTACHMENTS", "50"))  # Attachments per note before it is emitted
+NOTE_BATCH_SIZE = min(int(os.getenv("NOTE_BATCH_SIZE", "100")), 100)  # Notes per batch/create call (HubSpot max 100)
+NOTE_FLUSH_SECONDS = int(os.getenv("NOTE_FLUSH_SECONDS", "30"))  # Emit partially filled notes after this long
+HUBSPOT_BATCH_READ_SIZE = 100  # IDs per HubSpot batch read call (HubSpot max 100)
+# AI tagging: a document type and short summary for every uploaded file, added to its note. Files go
+# to the Message Batches API in the background and notes are patched once the results are in
+AI_TAGGING = os.getenv("AI_TAGGING", "0") == "1"
+AI_TAGGING_MODEL = os.getenv("AI_TAGGING_MODEL", "claude-3-5-haiku-20241022")
+AI_MAX_TOKENS = 300
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "1000"))  # Files per Message Batch
+AI_BATCH_MAX_BYTES = int(os.getenv("AI_BATCH_MAX_BYTES", str(128 * 1024 * 1024)))  # Request bytes per Message Batch (API max 256 MB)
+AI_TEXT_CHARS = int(os.getenv("AI_TEXT_CHARS", "20000"))  # Characters of extracted text sent per file
+AI_DOCUMENT_MAX_BYTES = int(os.getenv("AI_DOCUMENT_MAX_BYTES", str(4 * 1024 * 1024)))  # Larger PDFs, images and Office files are not tagged
+# Bytes of a streamed file kept in memory for tagging: one more than a tag request ever reads, so a longer file shows as too large
+AI_CAPTURE_BYTES = max(AI_DOCUMENT_MAX_BYTES, AI_TEXT_CHARS * 4) + 1
+AI_POLL_INTERVAL = float(os.getenv("AI_POLL_INTERVAL", "30"))  # Seconds between Message Batch status checks
+AI_WAIT_SECONDS = int(os.getenv("AI_WAIT_SECONDS", "600"))  # How long a run waits for its batches before leaving them to `tag`
+AI_DOCUMENT_TYPES = [document_type.strip() for document_type in os.getenv(
+    "AI_DOCUMENT_TYPES", "Contract,Invoice,Quote,Proposal,Purchase Order,Receipt,Report,Presentation,Spreadsheet,Correspondence,Image,Other"
+).split(",") if document_type.strip()]
+ZOHO_IDS_PER_REQUEST = 100  # Record IDs one Zoho "ids" read accepts
+OWNER_MAP_TTL = int(os.getenv("OWNER_MAP_TTL", "86400"))  # Seconds before Zoho users are matched to HubSpot owners again
+DEFAULT_HUBSPOT_OWNER_ID = os.getenv("DEFAULT_HUBSPOT_OWNER_ID", "671151283")  # Owner of notes on deals whose owner has no HubSpot match; empty for none
+RECONCILE_CHUNK_SIZE = int(os.getenv("RECONCILE_CHUNK_SIZE", "1000"))  # State store rows checked per chunk
+
+# Rate limiting and retries. Bucket seeds follow the documented limits and are corrected from
+# the rate-limit headers on every response: HubSpot allows 100-190 requests per 10 seconds per
+# app (search: 5/second), Zoho's per-org limit depends on the edition
+ZOHO_REQUESTS_PER_SECOND = float(os.getenv("ZOHO_REQUESTS_PER_SECOND", "10"))
+HUBSPOT_REQUESTS_PER_SECOND = float(os.getenv("HUBSPOT_REQUESTS_PER_SECOND", "10"))
+HUBSPOT_SEARCH_REQUESTS_PER_SECOND = 4
+# This process's share of every API limit: `--workers N` gives each worker 1/N. Seeds and the limits
+# read from rate-limit headers are both scaled by it, since the headers describe the whole app
+RATE_LIMIT_SHARE = float(os.getenv("RATE_LIMIT_SHARE", "1"))
+API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", "5"))  # In-line retries for 429, 5xx and connection errors
+API_BACKOFF_BASE = 1.0  # Seconds; doubled per attempt, with jitter
+API_BACKOFF_CAP = 60.0
+RETRY_QUEUE_BASE_DELAY = 60  # Seconds before the first retry of an item that exhausted its in-line retries
+RETRY_QUEUE_MAX_DELAY = 6 * 3600
+RETRY_QUEUE_MAX_ATTEMPTS = int(os.getenv("RETRY_QUEUE_MAX_ATTEMPTS", "8"))
+RETRY_WAIT_SECONDS = int(os.getenv("RETRY_WAIT_SECONDS", "120"))  # Keep the run alive for retries due this soon
+
+# State store group commits: writes are committed together every N logical commits or T seconds
+STATE_COMMIT_EVERY = int(os.getenv("STATE_COMMIT_EVERY", "200"))
+STATE_COMMIT_SECONDS = float(os.getenv("STATE_COMMIT_SECONDS", "1"))
+
+# Sharded runs: each worker owns the deals whose ID hashes to its shard and holds a lease on its shard
+# and on every deal it is working on; leases of a crashed worker expire and its shard is taken over
+LEASE_SECONDS = int(os.getenv("LEASE_SECONDS", "300"))
+LEASE_POLL_SECONDS = float(os.getenv("LEASE_POLL_SECONDS", "5"))  # How often a finished worker checks on the others
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
 
 # Global variable to store authorization code and folder ID
 AUTH_CODE = None
 HUBSPOT_FOLDER_ID = None
 CURRENT_SERVICE = None  # To track which service is being authorized
 ZOHO_ACCESS_TOKEN = None  # Global to store Zoho token
+HEADLESS = os.getenv("MIGRATION_HEADLESS", "0") == "1"  # Never open a browser; rely on stored refresh tokens
+
+# Set when a deal or attachment listing fails, so the delta high-water mark is not moved past it
+ZOHO_LISTING_INCOMPLETE = threading.Event()
+
+# In-memory copy of the deal_map table: zoho_deal_id -> hubspot_deal_id
+DEAL_INDEX = {}
+# Searches that found no HubSpot deal: zoho_deal_id -> when. A miss is served for DEAL_MISS_TTL seconds,
+# so one deal's files share a search, while a retry (RETRY_QUEUE_BASE_DELAY or later) searches again
+DEAL_MISSES = {}
+DEAL_MISS_TTL = int(os.getenv("DEAL_MISS_TTL", "30"))
+HUBSPOT_SEARCH_MAX_RESULTS = 10000  # The CRM search endpoint refuses to page past this many results
+
+# In-memory copies of the owner_map table (zoho_user_id -> hubspot_owner_id, None when no HubSpot
+# owner has the user's email, and zoho_user_id -> email) and the deal_owners table (zoho_deal_id -> zoho_user_id)
+OWNER_MAP = {}
+OWNER_EMAILS = {}
+DEAL_OWNERS = {}
+
+# Keep-alive connection pools, one session per API (the adapter keeps a separate pool per host)
+def create_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+ZOHO_SESSION = create_session()
+HUBSPOT_SESSION = create_session()
+
+# One SQLite connection is shared by all pipeline workers; every statement runs under this lock
+DB_LOCK = threading.RLock()
 
 # HTTP server to capture OAuth code and handle folder selection
 class OAuthHandler(http.server.SimpleHTTPRequestHandler):
     def do_GET(self):
         global AUTH_CODE, HUBSPOT_FOLDER_ID, CURRENT_SERVICE
-        print(f"Received request: {self.path}")
+        EVENTS.debug("oauth_request", f"Received request: {self.path}")
         parsed_url = urlparse(self.path)
         query_params = parse_qs(parsed_url.query)
         if 'code' in query_params:
@@ -76,7 +252,7 @@ class OAuthHandler(http.server.SimpleHTTPRequestHandler):
 
     def do_POST(self):
         global AUTH_CODE, HUBSPOT_FOLDER_ID
-        print(f"Received POST request: {self.path}")
+        EVENTS.debug("oauth_request", f"Received POST request: {self.path}")
         if self.path.startswith('/select_folder') and AUTH_CODE:
             content_length = int(self.headers.get('Content-Length', 0))
             post_data = self.rfile.read(content_length).decode()
@@ -109,23 +285,9 @@ def load_folder_config():
             HUBSPOT_FOLDER_ID = config.get("folder_id")
     return HUBSPOT_FOLDER_ID
 
-# Load or refresh Zoho tokens
-def load_zoho_tokens():
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'r') as f:
-            tokens = json.load(f)
-            access_token = tokens.get('access_token')
-            refresh_token = tokens.get('refresh_token')
-            expires_at = tokens.get('expires_at', 0)
-            if expires_at > time.time() + 300:
-                return access_token
-            if refresh_token:
-                return refresh_zoho_token(refresh_token)
-    return None  # Token will be set by the server in migrate_attachments
-
 # Refresh Zoho access token
 def refresh_zoho_token(refresh_token):
-    print("Refreshing Zoho access token...")
+    EVENTS.info("token_refresh", "Refreshing Zoho access token...", service="zoho")
     payload = {
         "refresh_token": refresh_token,
         "client_id": ZOHO_CLIENT_ID,
@@ -133,7 +295,7 @@ def refresh_zoho_token(refresh_token):
         "grant_type": "refresh_token"
     }
     try:
-        response = requests.post(ZOHO_TOKEN_URL, data=payload)
+        response = api_request("zoho", "POST", ZOHO_TOKEN_URL, idempotent=True, data=payload)
         if response.status_code == 200:
             data = response.json()
             access_token = data.get("access_token")
@@ -145,42 +307,31 @@ def refresh_zoho_token(refresh_token):
             }
             with open(TOKEN_FILE, 'w') as f:
                 json.dump(tokens, f)
-            print("✅ Access token refreshed")
+            EVENTS.info("token_refreshed", "✅ Access token refreshed", service="zoho")
             return access_token
         else:
-            print(f"❌ Failed to refresh token: {response.status_code} - {response.text}")
+            EVENTS.error("token_refresh_failed", f"❌ Failed to refresh token: {response.status_code}", service="zoho",
+                         status=response.status_code, response=response.text)
             return get_new_zoho_token()
     except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
+        EVENTS.error("token_refresh_failed", f"❌ Request failed: {e}", service="zoho")
         return get_new_zoho_token()
 
 # Get new Zoho access token via OAuth
 def get_new_zoho_token():
     global AUTH_CODE, CURRENT_SERVICE
+    if HEADLESS:
+        raise Exception(f"Zoho token refresh failed and a new authorization needs a browser. Run `python index.py` interactively once to renew {TOKEN_FILE}.")
     AUTH_CODE = None
     CURRENT_SERVICE = "zoho"
     auth_url = f"{ZOHO_AUTH_URL}?scope={ZOHO_SCOPE}&client_id={ZOHO_CLIENT_ID}&response_type=code&access_type=offline&redirect_uri={REDIRECT_URI}"
-    print(f"Opening browser for Zoho authorization: {auth_url}")
+    EVENTS.info("authorization", f"Opening browser for Zoho authorization: {auth_url}", service="zoho")
     webbrowser.open(auth_url)
     return AUTH_CODE  # Will be set by the server
 
-# Load or refresh HubSpot tokens
-def load_hubspot_tokens():
-    if os.path.exists(HUBSPOT_TOKEN_FILE):
-        with open(HUBSPOT_TOKEN_FILE, 'r') as f:
-            tokens = json.load(f)
-            access_token = tokens.get('access_token')
-            refresh_token = tokens.get('refresh_token')
-            expires_at = tokens.get('expires_at', 0)
-            if expires_at > time.time() + 300:
-                return access_token
-            if refresh_token:
-                return refresh_hubspot_token(refresh_token)
-    return None  # Token will be set by the server in migrate_attachments
-
 # Refresh HubSpot access token
 def refresh_hubspot_token(refresh_token):
-    print("Refreshing HubSpot access token...")
+    EVENTS.info("token_refresh", "Refreshing HubSpot access token...", service="hubspot")
     payload = {
         "refresh_token": refresh_token,
         "client_id": HUBSPOT_CLIENT_ID,
@@ -188,7 +339,7 @@ def refresh_hubspot_token(refresh_token):
         "grant_type": "refresh_token"
     }
     try:
-        response = requests.post(HUBSPOT_TOKEN_URL, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = api_request("hubspot", "POST", HUBSPOT_TOKEN_URL, idempotent=True, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
         if response.status_code == 200:
             data = response.json()
             access_token = data.get("access_token")
@@ -201,13 +352,14 @@ def refresh_hubspot_token(refresh_token):
             }
             with open(HUBSPOT_TOKEN_FILE, 'w') as f:
                 json.dump(tokens, f)
-            print("✅ HubSpot access token refreshed")
+            EVENTS.info("token_refreshed", "✅ HubSpot access token refreshed", service="hubspot")
             return access_token
         else:
-            print(f"❌ Failed to refresh token: {response.status_code} - {response.text}")
+            EVENTS.error("token_refresh_failed", f"❌ Failed to refresh token: {response.status_code}", service="hubspot",
+                         status=response.status_code, response=response.text)
             return get_new_hubspot_token()
     except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
+        EVENTS.error("token_refresh_failed", f"❌ Request failed: {e}", service="hubspot")
         return get_new_hubspot_token()
 
 # Get new HubSpot access token via OAuth
@@ -223,7 +375,7 @@ def get_new_hubspot_token():
         "code": AUTH_CODE
     }
     try:
-        response = requests.post(HUBSPOT_TOKEN_URL, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
+        response = api_request("hubspot", "POST", HUBSPOT_TOKEN_URL, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
         if response.status_code == 200:
             data = response.json()
             access_token = data.get("access_token")
@@ -236,124 +388,1444 @@ def get_new_hubspot_token():
             }
             with open(HUBSPOT_TOKEN_FILE, 'w') as f:
                 json.dump(tokens, f)
-            print("✅ New HubSpot tokens saved")
+            EVENTS.info("tokens_saved", "✅ New HubSpot tokens saved", service="hubspot")
             return access_token
         else:
             raise Exception(f"Failed to get HubSpot tokens: {response.status_code} - {response.text}")
     except requests.exceptions.RequestException as e:
         raise Exception(f"Request failed: {e}")
 
+# In-memory access token shared by all workers. The token file is read once and again only
+# after a refresh, and a single thread refreshes ahead of expiry while the others keep going
+class TokenCache:
+    def __init__(self, token_file, refresh):
+        self.token_file = token_file
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        self.access_token = None
+        self.refresh_token = None
+        self.expires_at = 0
+
+    def read_token_file(self):
+        if os.path.exists(self.token_file):
+            with open(self.token_file, 'r') as f:
+                tokens = json.load(f)
+            self.access_token = tokens.get('access_token')
+            self.refresh_token = tokens.get('refresh_token')
+            self.expires_at = tokens.get('expires_at', 0)
+
+    def get(self):
+        if self.access_token and self.expires_at > time.time() + TOKEN_REFRESH_MARGIN:
+            return self.access_token
+        # Another thread is already refreshing: keep using the current token while it is still valid
+        if not self.lock.acquire(blocking=self.expires_at <= time.time() + 30):
+            return self.access_token
+        try:
+            if self.access_token and self.expires_at > time.time() + TOKEN_REFRESH_MARGIN:
+                return self.access_token
+            if not self.access_token:
+                self.read_token_file()
+                if self.access_token and self.expires_at > time.time() + TOKEN_REFRESH_MARGIN:
+                    return self.access_token
+            if self.refresh_token and self.refresh(self.refresh_token):
+                self.read_token_file()
+            return self.access_token
+        finally:
+            self.lock.release()
+
+    # Force the next get() to refresh, e.g. after a 401 from the API
+    def invalidate(self):
+        with self.lock:
+            self.expires_at = 0
+
+    # Drop the in-memory copy so the next get() re-reads the token file (after a new OAuth grant)
+    def reset(self):
+        with self.lock:
+            self.access_token = None
+            self.refresh_token = None
+            self.expires_at = 0
+
+ZOHO_TOKENS = TokenCache(TOKEN_FILE, refresh_zoho_token)
+HUBSPOT_TOKENS = TokenCache(HUBSPOT_TOKEN_FILE, refresh_hubspot_token)
+
 def get_zoho_headers():
-    access_token = load_zoho_tokens()
+    access_token = ZOHO_TOKENS.get()
     return {
         "Authorization": f"Zoho-oauthtoken {access_token}",
         "Content-Type": "application/json"
     }
 
+# Zoho answers requests carrying If-Modified-Since with only the records changed after it, or a 304
+def get_zoho_headers_since(modified_since):
+    headers = get_zoho_headers()
+    if modified_since:
+        headers["If-Modified-Since"] = modified_since
+    return headers
+
 # Initialize HubSpot headers with dynamic token
 def get_hubspot_headers():
-    access_token = load_hubspot_tokens()
+    access_token = HUBSPOT_TOKENS.get()
     return {
         "Authorization": f"Bearer {access_token}",
         "Content-Type": "application/json"
     }
 
+# Structured event log: one JSON object per line, keyed by the deal and attachment being worked on.
+# Emitting a record is a dict build and a list append; a background thread serializes, writes and
+# rotates the file. Only LOG_LEVEL and above reach the console, and the latest warnings and errors
+# are kept in memory so a crash leaves them in CRASH_DUMP_FILE
+class EventLog:
+    LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+    def __init__(self, path=EVENT_LOG_FILE, level=EVENT_LOG_LEVEL, console_level=LOG_LEVEL):
+        self.path = path
+        self.crash_path = CRASH_DUMP_FILE
+        self.level = self.LEVELS.get(level.lower(), 10) if path else 100
+        self.console_level = self.LEVELS.get(console_level.lower(), 20)
+        self.lowest = min(self.level, self.console_level)
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.print_lock = threading.Lock()
+        self.buffer = []
+        self.dropped = 0
+        self.recent = collections.deque(maxlen=ERROR_RING_SIZE)
+        self.local = threading.local()
+        self.wake = threading.Event()
+        self.closed = threading.Event()
+        self.writer = None
+        self.file = None
+
+    # Shard processes each get their own files: migration_events.jsonl -> migration_events.1.jsonl
+    def start(self, shard=0, shards=1):
+        if shards > 1:
+            self.path = self.path and shard_path(self.path, shard)
+            self.crash_path = self.crash_path and shard_path(self.crash_path, shard)
+        threading.excepthook = self.thread_crashed
+        with self.lock:
+            self.start_writer()
+
+    def start_writer(self):
+        if self.writer is None and self.path:
+            self.writer = threading.Thread(target=self.run_writer, name="event-log", daemon=True)
+            self.writer.start()
+            atexit.register(self.close)
+
+    # Deal and attachment IDs (or other fields) added to every record this thread emits inside the block
+    @contextlib.contextmanager
+    def context(self, **fields):
+        previous = getattr(self.local, "fields", {})
+        self.local.fields = {**previous, **fields}
+        try:
+            yield
+        finally:
+            self.local.fields = previous
+
+    def debug(self, event, message, **fields):
+        self.emit("debug", event, message, fields)
+
+    def info(self, event, message, **fields):
+        self.emit("info", event, message, fields)
+
+    def warning(self, event, message, **fields):
+        self.emit("warning", event, message, fields)
+
+    def error(self, event, message, **fields):
+        self.emit("error", event, message, fields)
+
+    def emit(self, level, event, message, fields):
+        severity = self.LEVELS[level]
+        if severity < self.lowest:
+            return
+        for key, value in fields.items():
+            if isinstance(value, str) and len(value) > EVENT_FIELD_MAX_CHARS:
+                fields[key] = value[:EVENT_FIELD_MAX_CHARS] + "..."
+        record = {"ts": time.time(), "level": level, "event": event, "msg": message,
+                  "thread": threading.current_thread().name, **getattr(self.local, "fields", {}), **fields}
+        self.submit(record, severity)
+
+    def submit(self, record, severity):
+        if severity >= self.console_level:
+            self.print_record(record, severity)
+        if severity >= self.LEVELS["warning"]:
+            self.recent.append(record)
+        if severity < self.level:
+            return
+        with self.lock:
+            # A writer that cannot keep up sheds the chatty records, never the warnings and errors
+            if len(self.buffer) >= EVENT_LOG_BUFFER and severity < self.LEVELS["warning"]:
+                self.dropped += 1
+                return
+            self.buffer.append(record)
+            self.start_writer()
+
+    def print_record(self, record, severity):
+        line = record["msg"]
+        if severity >= self.LEVELS["warning"]:
+            keys = ", ".join(f"{key} {record[key]}" for key in ("deal", "attachment") if record.get(key))
+            if keys:
+                line = f"{line} ({keys})"
+        with self.print_lock:
+            print(line)
+
+    @staticmethod
+    def serialize(record):
+        timestamp = datetime.fromtimestamp(record["ts"], timezone.utc).isoformat(timespec="milliseconds")
+        return json.dumps({key: value for key, value in {**record, "ts": timestamp}.items() if value is not None},
+                          ensure_ascii=False, default=str) + "\n"
+
+    def run_writer(self):
+        while not self.closed.is_set():
+            self.wake.wait(EVENT_LOG_FLUSH_SECONDS)
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            records.append({"ts": time.time(), "level": "warning", "event": "events_dropped",
+                            "msg": f"⚠️ Event log fell behind and dropped {dropped} debug and info records"})
+        if not records:
+            return
+        with self.write_lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, "a", encoding="utf-8")
+                self.file.write("".join(self.serialize(record) for record in records))
+                self.file.flush()
+                if self.file.tell() >= EVENT_LOG_MAX_BYTES:
+                    self.rotate()
+            except OSError as e:
+                print(f"❌ Could not write the event log {self.path}: {e}", file=sys.stderr)
+
+    # migration_events.jsonl -> .1 -> .2 ... up to EVENT_LOG_BACKUPS; the oldest is overwritten
+    def rotate(self):
+        self.file.close()
+        self.file = None
+        for index in range(EVENT_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if EVENT_LOG_BACKUPS:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def close(self):
+        self.closed.set()
+        self.wake.set()
+        if self.writer and self.writer is not threading.current_thread():
+            self.writer.join()
+        self.flush()
+        with self.write_lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    # Log the exception with its traceback, then write the recent warnings and errors on their own,
+    # so the items that went wrong before the crash are one file away
+    def crash(self, exc):
+        self.exception("crash", f"❌ Crashed: {exc!r}", exc)
+        self.close()
+        if not self.crash_path:
+            return
+        try:
+            with open(self.crash_path, "w", encoding="utf-8") as f:
+                f.writelines(self.serialize(record) for record in list(self.recent))
+            print(f"Last {len(self.recent)} warnings and errors written to {self.crash_path}", file=sys.stderr)
+        except OSError as e:
+            print(f"❌ Could not write the crash dump {self.crash_path}: {e}", file=sys.stderr)
+
+    def thread_crashed(self, args):
+        self.exception("thread_crash", f"❌ Thread {args.thread.name if args.thread else '?'} crashed: {args.exc_value!r}", args.exc_value)
+
+    # Error record with the full traceback, which is never cut to EVENT_FIELD_MAX_CHARS
+    def exception(self, event, message, exc, **fields):
+        record = {"ts": time.time(), "level": "error", "event": event, "msg": message, "thread": threading.current_thread().name,
+                  **getattr(self.local, "fields", {}), **fields,
+                  "traceback": "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))}
+        self.submit(record, self.LEVELS["error"])
+
+def shard_path(path, shard):
+    root, extension = os.path.splitext(path)
+    return f"{root}.{shard}{extension}"
+
+EVENTS = EventLog()
+
+# In-process counters, latency histograms and gauges, exported in Prometheus text format.
+# Recording is a perf_counter call and a dict update under one lock, cheap enough to leave on
+class Metrics:
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, sorted label items) -> value
+        self.histograms = {}  # stage -> [bucket counts..., +Inf count, sum]
+        self.gauges = {}
+        self.started = time.time()
+        self.last_sample = (self.started, 0)  # (time, bytes) at the previous progress line
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * (len(self.LATENCY_BUCKETS) + 2)
+            histogram[bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def total(self, name, **labels):
+        wanted = set(labels.items())
+        with self.lock:
+            return sum(value for (counter, items), value in self.counters.items()
+                       if counter == name and wanted <= set(items))
+
+    def stage_seconds(self, stage):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            return histogram[-1] if histogram else 0
+
+    # Refresh the derived gauges (throughput, ETA) and return the one-line progress summary
+    def progress(self, queue_depths):
+        now = time.time()
+        listed = self.total("migration_items_listed_total")
+        done = self.total("migration_items_completed_total")
+        failed = self.total("migration_items_failed_total")
+        # Bytes that reached HubSpot (or the archive when extracting); downloads staged to disk are counted again there
+        transferred = sum(self.total("migration_bytes_total", direction=direction) for direction in ("upload", "transfer", "archive"))
+        previous_time, previous_bytes = self.last_sample
+        bytes_per_second = (transferred - previous_bytes) / max(now - previous_time, 1e-6)
+        self.last_sample = (now, transferred)
+        rate = done / max(now - self.started, 1e-6)
+        eta = (listed - done - failed) / rate if rate else None
+        self.set_gauge("migration_bytes_per_second", bytes_per_second)
+        self.set_gauge("migration_eta_seconds", eta if eta is not None else -1)
+        for stage, depth in queue_depths.items():
+            self.set_gauge("migration_queue_depth", depth, stage=stage)
+        depths = " ".join(f"{stage}={depth}" for stage, depth in queue_depths.items())
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "--:--:--"
+        return (f"📊 {done}/{listed} done, {failed} failed | {bytes_per_second / 1048576:.1f} MB/s | "
+                f"{self.total('migration_api_requests_total')} API calls, {self.total('migration_api_retries_total')} retries, "
+                f"{self.total('migration_api_throttled_total')} throttled | queues {depths} | ETA {eta_text}")
+
+    def render(self):
+        def label_text(labels, extra=()):
+            items = list(labels) + list(extra)
+            return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}" if items else ""
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, labels in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{label_text(labels)} {value}" for (counter, labels), value in self.counters.items() if counter == name)
+            for name in sorted({name for name, labels in self.gauges}):
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{label_text(labels)} {value:g}" for (gauge, labels), value in self.gauges.items() if gauge == name)
+            if self.histograms:
+                lines.append("# TYPE migration_stage_seconds histogram")
+            for stage, histogram in self.histograms.items():
+                labels = (("stage", stage),)
+                cumulative = 0
+                for bound, count in zip(self.LATENCY_BUCKETS + ("+Inf",), histogram[:-1]):
+                    cumulative += count
+                    lines.append(f"migration_stage_seconds_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"migration_stage_seconds_sum{label_text(labels)} {histogram[-1]:.6f}")
+                lines.append(f"migration_stage_seconds_count{label_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    # Write through a temporary file so a scraper never reads a half-written file
+    def write(self, path=METRICS_FILE):
+        if not path:
+            return
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+METRICS = Metrics()
+
+# /crm/v3/objects/deals/123 -> /crm/v3/objects/deals/{id}, so the endpoint label stays low-cardinality
+def endpoint_label(url):
+    return re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(url).path)
+
+# Token bucket shared by all workers calling one API. `observe_*` adjust the refill rate and
+# remaining budget from the server's rate-limit headers; `pause` stops the bucket after a 429.
+# `share` is the part of the limit this process may use
+class RateLimiter:
+    def __init__(self, rate, capacity=None, share=RATE_LIMIT_SHARE):
+        self.share = share
+        self.rate = rate * share
+        self.capacity = capacity or max(self.rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # HubSpot: X-HubSpot-RateLimit-Max requests per X-HubSpot-RateLimit-Interval-Milliseconds
+    def observe_hubspot(self, headers):
+        limit = headers.get("X-HubSpot-RateLimit-Max")
+        interval_ms = headers.get("X-HubSpot-RateLimit-Interval-Milliseconds")
+        remaining = headers.get("X-HubSpot-RateLimit-Remaining")
+        with self.lock:
+            self.refill(time.monotonic())
+            if limit and interval_ms:
+                self.rate = int(limit) / (int(interval_ms) / 1000) * self.share
+                self.capacity = max(int(limit) * self.share, 1)
+            if remaining is not None:
+                self.tokens = min(self.tokens, int(remaining) * self.share)
+
+    # Zoho: X-RATELIMIT-REMAINING calls left in the window that resets at X-RATELIMIT-RESET (epoch ms)
+    def observe_zoho(self, headers):
+        remaining = headers.get("X-RATELIMIT-REMAINING")
+        reset_ms = headers.get("X-RATELIMIT-RESET")
+        if remaining is None:
+            return
+        with self.lock:
+            self.refill(time.monotonic())
+            self.tokens = min(self.tokens, int(remaining) * self.share)
+        if int(remaining) <= 0 and reset_ms:
+            self.pause(max(0, int(reset_ms) / 1000 - time.time()))
+
+RATE_LIMITERS = {
+    "zoho": RateLimiter(ZOHO_REQUESTS_PER_SECOND),
+    "hubspot": RateLimiter(HUBSPOT_REQUESTS_PER_SECOND),
+    "hubspot_search": RateLimiter(HUBSPOT_SEARCH_REQUESTS_PER_SECOND)
+}
+API_CLIENTS = {
+    "zoho": (ZOHO_SESSION, ZOHO_TOKENS, "Zoho-oauthtoken"),
+    "hubspot": (HUBSPOT_SESSION, HUBSPOT_TOKENS, "Bearer"),
+    "hubspot_search": (HUBSPOT_SESSION, HUBSPOT_TOKENS, "Bearer")
+}
+
+# Exponential backoff with equal jitter
+def backoff_delay(attempt, base=API_BACKOFF_BASE, cap=API_BACKOFF_CAP):
+    delay = min(cap, base * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+# True when the connection could not be opened, so the request never reached the server
+def connect_failed(error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+# Send a request through the API's pooled session and rate limiter. 429, 5xx and connection
+# errors are retried with backoff (a 429 also pauses the whole bucket); a 401 refreshes the
+# token once. The last response is returned as-is once retries are exhausted.
+# A POST may already have been applied when a 5xx or a dropped connection comes back, so unless the
+# caller marks it `idempotent` (searches, batch reads, token refreshes) it is only retried on 429 and
+# on connections that never opened; anything else goes back to the caller and the retry queue
+def api_request(api, method, url, retries=API_MAX_RETRIES, idempotent=None, **kwargs):
+    if idempotent is None:
+        idempotent = method not in ("POST", "PATCH")
+    session, tokens, auth_scheme = API_CLIENTS[api]
+    limiter = RATE_LIMITERS[api]
+    attempt = 0
+    refreshed = False
+    while True:
+        # Rewind file bodies so a retry resends the whole file
+        for value in (kwargs.get("files") or {}).values():
+            if isinstance(value, tuple) and hasattr(value[1], "seek"):
+                value[1].seek(0)
+        if isinstance(kwargs.get("data"), StreamingMultipartBody):
+            kwargs["data"].rewind()
+        limiter.acquire()
+        endpoint = endpoint_label(url)
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            METRICS.inc("migration_api_requests_total", api=api, endpoint=endpoint, status="error")
+            if attempt >= retries or not (idempotent or connect_failed(e)):
+                raise
+            METRICS.inc("migration_api_retries_total", api=api)
+            time.sleep(backoff_delay(attempt))
+            attempt += 1
+            continue
+        METRICS.inc("migration_api_requests_total", api=api, endpoint=endpoint, status=response.status_code)
+        # The HubSpot headers describe the general app limit, not the lower search limit
+        if api == "zoho":
+            limiter.observe_zoho(response.headers)
+        elif api == "hubspot":
+            limiter.observe_hubspot(response.headers)
+        headers = kwargs.get("headers") or {}
+        if response.status_code == 401 and not refreshed and "Authorization" in headers:
+            refreshed = True
+            tokens.invalidate()
+            kwargs["headers"] = dict(headers, Authorization=f"{auth_scheme} {tokens.get()}")
+            response.close()
+            continue
+        if response.status_code == 429 or response.status_code >= 500:
+            delay = retry_after_seconds(response) or backoff_delay(attempt)
+            if response.status_code == 429:
+                METRICS.inc("migration_api_throttled_total", api=api)
+                limiter.pause(delay)
+            if attempt >= retries or (response.status_code >= 500 and not idempotent):
+                return response
+            METRICS.inc("migration_api_retries_total", api=api)
+            EVENTS.debug("api_retry", f"⚠️ {api} returned {response.status_code}, retrying in {delay:.1f}s",
+                         api=api, status=response.status_code, url=endpoint_label(url), attempt=attempt + 1)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+            continue
+        return response
+
+# Migration state store. Each attachment row moves through
+#   listed -> downloaded -> uploaded -> noted
+# (with `extract` and `load`: listed -> downloaded -> archived, then archived -> uploaded -> noted)
+# or ends in failed once the retry queue gives up on it. The connection is shared by all
+# pipeline threads under DB_LOCK; commit() only counts a logical commit, and the writes are
+# flushed as one transaction every STATE_COMMIT_EVERY commits or STATE_COMMIT_SECONDS, so a
+# crash can lose at most the last second of progress (those items are simply redone)
+class StateStore:
+    def __init__(self, conn, commit_every=STATE_COMMIT_EVERY, commit_seconds=STATE_COMMIT_SECONDS):
+        self.conn = conn
+        self.commit_every = commit_every
+        self.commit_seconds = commit_seconds
+        self.pending = 0
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically, name="state-commit", daemon=True)
+        self.flusher.start()
+
+    def execute(self, sql, params=()):
+        with DB_LOCK:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        with DB_LOCK:
+            return self.conn.executemany(sql, rows)
+
+    def commit(self):
+        with DB_LOCK:
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.flush()
+
+    def flush(self):
+        with DB_LOCK:
+            if self.conn.in_transaction:
+                self.conn.commit()
+            self.pending = 0
+
+    def flush_periodically(self):
+        while not self.closed.wait(self.commit_seconds):
+            self.flush()
+
+    # Read-then-write sequences that other worker processes may race on run under BEGIN IMMEDIATE
+    @contextlib.contextmanager
+    def transaction(self):
+        with DB_LOCK:
+            self.flush()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.rollback()
+                raise
+            self.conn.commit()
+
+    def close(self):
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.conn.close()
+
 # Initialize or connect to SQLite database with created_date
-def init_db():
-    conn = sqlite3.connect(DB_FILE)  # Now DB_FILE is initialized
+def init_db(commit_every=STATE_COMMIT_EVERY):
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30)  # Shared across pipeline threads under DB_LOCK
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS attachments
                  (zoho_deal_id TEXT, zoho_attachment_id TEXT, file_name TEXT, file_path TEXT,
                   hubspot_attachment_id TEXT, hubspot_deal_id TEXT, hubspot_note_id TEXT, status TEXT, created_date TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS deal_map
+                 (zoho_deal_id TEXT PRIMARY KEY, hubspot_deal_id TEXT NOT NULL, updated_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_state
+                 (key TEXT PRIMARY KEY, value TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS retry_queue
+                 (zoho_deal_id TEXT, zoho_attachment_id TEXT, file_name TEXT, stage TEXT, attempts INTEGER,
+                  next_attempt_at REAL, last_error TEXT, PRIMARY KEY (zoho_deal_id, zoho_attachment_id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS retry_queue_due ON retry_queue (next_attempt_at)")
+    c.execute('''CREATE TABLE IF NOT EXISTS leases
+                 (zoho_deal_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS leases_owner ON leases (owner)")
+    c.execute('''CREATE TABLE IF NOT EXISTS content_hashes
+                 (sha256 TEXT PRIMARY KEY, hubspot_file_id TEXT NOT NULL, size INTEGER, created_date TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS content_hashes_size ON content_hashes (size)")
+    # Files in the staging cache. Pinned files (downloading, or waiting to be uploaded, including
+    # through the retry queue) are never evicted; uploaded ones are evicted oldest-used first
+    c.execute('''CREATE TABLE IF NOT EXISTS staged_files
+                 (zoho_deal_id TEXT, zoho_attachment_id TEXT, path TEXT NOT NULL, size INTEGER NOT NULL,
+                  pinned INTEGER NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (zoho_deal_id, zoho_attachment_id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS staged_files_lru ON staged_files (pinned, last_used)")
+    # Bytes already written to each byte range of a partial download; range_end is NULL for "to the end"
+    c.execute('''CREATE TABLE IF NOT EXISTS download_progress
+                 (zoho_deal_id TEXT, zoho_attachment_id TEXT, range_start INTEGER, range_end INTEGER, written INTEGER NOT NULL,
+                  PRIMARY KEY (zoho_deal_id, zoho_attachment_id, range_start))''')
+    columns = {row[1] for row in c.execute("PRAGMA table_info(attachments)")}
+    for column, column_type in (("size", "INTEGER"), ("sha256", "TEXT"), ("created_time", "TEXT")):
+        if column not in columns:
+            c.execute(f"ALTER TABLE attachments ADD COLUMN {column} {column_type}")
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'attachments_key'").fetchone():
+        # Databases from before the unique key can hold repeated rows; keep the latest of each
+        c.execute("DELETE FROM attachments WHERE rowid NOT IN (SELECT MAX(rowid) FROM attachments GROUP BY zoho_deal_id, zoho_attachment_id)")
+        c.execute("CREATE UNIQUE INDEX attachments_key ON attachments (zoho_deal_id, zoho_attachment_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS attachments_status ON attachments (status)")
+    # Discrepancies found by `reconcile`; `action` is the stage a targeted re-run (--reconciled) redoes
+    c.execute('''CREATE TABLE IF NOT EXISTS reconcile_issues
+                 (zoho_deal_id TEXT, zoho_attachment_id TEXT, issue TEXT, action TEXT, detail TEXT, found_at TEXT,
+                  PRIMARY KEY (zoho_deal_id, zoho_attachment_id, issue))''')
+    # Zoho users matched to HubSpot owners by email, rebuilt once OWNER_MAP_TTL has passed, and the
+    # owner of every deal as the deal listing reported it
+    c.execute('''CREATE TABLE IF NOT EXISTS owner_map
+                 (zoho_user_id TEXT PRIMARY KEY, email TEXT, hubspot_owner_id TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS deal_owners
+                 (zoho_deal_id TEXT PRIMARY KEY, zoho_user_id TEXT NOT NULL)''')
+    # AI tags by file content, the Message Batches they were requested in, and notes already given their tags
+    c.execute('''CREATE TABLE IF NOT EXISTS ai_tags
+                 (sha256 TEXT PRIMARY KEY, status TEXT NOT NULL, batch_id TEXT, document_type TEXT, summary TEXT, updated_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS ai_batches
+                 (batch_id TEXT PRIMARY KEY, status TEXT NOT NULL, request_count INTEGER, created_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS tagged_notes
+                 (hubspot_note_id TEXT PRIMARY KEY, patched_at TEXT)''')
+    # HubSpot folders created or found under the chosen folder, so each is resolved once
+    c.execute('''CREATE TABLE IF NOT EXISTS hubspot_folders
+                 (parent_folder_id TEXT, name TEXT, folder_id TEXT NOT NULL, PRIMARY KEY (parent_folder_id, name))''')
+    # Older runs wrote 'uploaded' once the note existed; that state is now 'noted'
+    c.execute("UPDATE attachments SET status = 'noted' WHERE status = 'uploaded' AND hubspot_note_id IS NOT NULL")
     conn.commit()
-    return conn
+    return StateStore(conn, commit_every=commit_every)
+
+# Small key/value table for sync bookkeeping (high-water marks, last refresh times)
+def get_sync_state(conn, key):
+    with DB_LOCK:
+        row = conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def set_sync_state(conn, key, value):
+    with DB_LOCK:
+        conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, str(value)))
+        conn.commit()
+
+# Event log keys of a pipeline item: a deal waiting to be listed, or one of its attachments
+def item_keys(item):
+    if "zoho_deal_id" in item:
+        return {"deal": item["zoho_deal_id"], "attachment": item["zoho_attachment_id"]}
+    return {"deal": item.get("id")}
+
+# Persistent retry queue: items that exhausted their in-line retries wait here with a next-attempt
+# time. A NULL next_attempt_at marks an item currently back in the pipeline
+def schedule_retry(conn, item, stage, error):
+    with DB_LOCK:
+        row = conn.execute("SELECT attempts FROM retry_queue WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                           (item["zoho_deal_id"], item["zoho_attachment_id"])).fetchone()
+        attempts = (row[0] if row else 0) + 1
+        if attempts > RETRY_QUEUE_MAX_ATTEMPTS:
+            conn.execute("DELETE FROM retry_queue WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                         (item["zoho_deal_id"], item["zoho_attachment_id"]))
+            conn.execute("UPDATE attachments SET status = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                         ("failed", item["zoho_deal_id"], item["zoho_attachment_id"]))
+            conn.commit()
+            METRICS.inc("migration_items_failed_total", stage=stage)
+            EVENTS.error("item_failed", f"❌ Giving up on {item['file_name']} after {attempts - 1} attempts ({error})",
+                         stage=stage, attempts=attempts - 1, error=error, **item_keys(item))
+            return
+        next_attempt_at = time.time() + backoff_delay(attempts - 1, RETRY_QUEUE_BASE_DELAY, RETRY_QUEUE_MAX_DELAY)
+        conn.execute("INSERT OR REPLACE INTO retry_queue (zoho_deal_id, zoho_attachment_id, file_name, stage, attempts, next_attempt_at, last_error) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (item["zoho_deal_id"], item["zoho_attachment_id"], item["file_name"], stage, attempts, next_attempt_at, error))
+        conn.commit()
+    METRICS.inc("migration_retries_scheduled_total", stage=stage)
+    EVENTS.warning("retry_scheduled", f"🔁 Scheduled {stage} retry #{attempts} for {item['file_name']} in {next_attempt_at - time.time():.0f}s",
+                   stage=stage, attempts=attempts, error=error, **item_keys(item))
+
+# Claim retries due before `until`, marking them in flight. `accept(zoho_deal_id)` limits a
+# sharded worker to the items it owns
+def take_due_retries(conn, until, accept=None):
+    with conn.transaction():
+        rows = conn.execute("SELECT r.zoho_deal_id, r.zoho_attachment_id, r.file_name, a.status, a.file_path, a.hubspot_attachment_id, a.size, a.sha256, a.created_time "
+                            "FROM retry_queue r LEFT JOIN attachments a ON a.zoho_deal_id = r.zoho_deal_id AND a.zoho_attachment_id = r.zoho_attachment_id "
+                            "WHERE r.next_attempt_at <= ?", (until,)).fetchall()
+        rows = [row for row in rows if accept is None or accept(row[0])]
+        conn.executemany("UPDATE retry_queue SET next_attempt_at = NULL WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                         [(row[0], row[1]) for row in rows])
+    return [{"zoho_deal_id": row[0], "zoho_attachment_id": row[1], "file_name": row[2], "status": row[3],
+             "file_path": row[4], "hs_attachment_id": row[5], "size": row[6], "sha256": row[7], "created_time": row[8]} for row in rows]
+
+def next_retry_at(conn, accept=None):
+    with DB_LOCK:
+        rows = conn.execute("SELECT zoho_deal_id, next_attempt_at FROM retry_queue WHERE next_attempt_at IS NOT NULL").fetchall()
+    due = [next_attempt_at for zoho_deal_id, next_attempt_at in rows if accept is None or accept(zoho_deal_id)]
+    return min(due) if due else None
+
+# Items left in flight by an interrupted run are due again immediately
+def reset_in_flight_retries(conn, accept=None):
+    with conn.transaction():
+        rows = conn.execute("SELECT zoho_deal_id, zoho_attachment_id FROM retry_queue WHERE next_attempt_at IS NULL").fetchall()
+        conn.executemany("UPDATE retry_queue SET next_attempt_at = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                         [(time.time(), zoho_deal_id, zoho_attachment_id) for zoho_deal_id, zoho_attachment_id in rows
+                          if accept is None or accept(zoho_deal_id)])
+
+def deal_shard(zoho_deal_id, shards):
+    return zlib.crc32(str(zoho_deal_id).encode()) % shards
+
+# Take or renew the lease on a deal; fails while another worker holds an unexpired lease
+def claim_deal_lease(conn, zoho_deal_id, owner=WORKER_ID):
+    now = time.time()
+    with conn.transaction():
+        row = conn.execute("SELECT owner, expires_at FROM leases WHERE zoho_deal_id = ?", (zoho_deal_id,)).fetchone()
+        if row and row[0] != owner and row[1] > now:
+            return False
+        conn.execute("INSERT OR REPLACE INTO leases (zoho_deal_id, owner, expires_at) VALUES (?, ?, ?)",
+                     (zoho_deal_id, owner, now + LEASE_SECONDS))
+    return True
+
+def renew_leases(conn, owner=WORKER_ID):
+    with conn.transaction():
+        conn.execute("UPDATE leases SET expires_at = ? WHERE owner = ?", (time.time() + LEASE_SECONDS, owner))
+
+def release_leases(conn, owner=WORKER_ID):
+    with conn.transaction():
+        conn.execute("DELETE FROM leases WHERE owner = ?", (owner,))
+
+def expired_leases(conn):
+    with DB_LOCK:
+        return [row[0] for row in conn.execute("SELECT zoho_deal_id FROM leases WHERE expires_at < ? AND zoho_deal_id NOT LIKE 'shard:%'",
+                                               (time.time(),)).fetchall()]
+
+# Each worker also leases its whole shard, so the deals a dead worker never got to can be handed on.
+# Releasing the lease once the shard is drained marks it finished
+def shard_lease_key(shard, shards):
+    return f"shard:{shard}/{shards}"
+
+def take_shard_lease(conn, shard, shards, owner=WORKER_ID):
+    with conn.transaction():
+        conn.execute("INSERT OR REPLACE INTO leases (zoho_deal_id, owner, expires_at) VALUES (?, ?, ?)",
+                     (shard_lease_key(shard, shards), owner, time.time() + LEASE_SECONDS))
+
+# Our shards are done: drop their leases so the workers still waiting on them can stop
+def release_shard_leases(conn, owner=WORKER_ID):
+    with conn.transaction():
+        conn.execute("DELETE FROM leases WHERE owner = ? AND zoho_deal_id LIKE 'shard:%'", (owner,))
+
+# Shards of this run held by other workers: (shard, expired) for each
+def other_shard_leases(conn, shards, owner=WORKER_ID):
+    with DB_LOCK:
+        rows = conn.execute("SELECT zoho_deal_id, expires_at FROM leases WHERE zoho_deal_id LIKE ? AND owner != ?",
+                            (f"shard:%/{shards}", owner)).fetchall()
+    now = time.time()
+    return [(int(key[len("shard:"):].split("/")[0]), expires_at < now) for key, expires_at in rows]
+
+# Content-hash index: sha256 of every file already uploaded -> its HubSpot file ID
+def find_uploaded_content(conn, sha256):
+    with DB_LOCK:
+        row = conn.execute("SELECT hubspot_file_id FROM content_hashes WHERE sha256 = ?", (sha256,)).fetchone()
+    return row[0] if row else None
+
+def record_uploaded_content(conn, sha256, hubspot_file_id, size):
+    with DB_LOCK:
+        conn.execute("INSERT OR IGNORE INTO content_hashes (sha256, hubspot_file_id, size, created_date) VALUES (?, ?, ?, ?)",
+                     (sha256, hubspot_file_id, size, datetime.now(timezone.utc).isoformat()))
+        conn.commit()
+
+# A file of this size has been uploaded before, so it may be a duplicate worth hashing before upload
+def known_content_size(conn, size):
+    if size is None:
+        return False
+    with DB_LOCK:
+        return conn.execute("SELECT 1 FROM content_hashes WHERE size = ? LIMIT 1", (size,)).fetchone() is not None
+
+# Running totals for the end-of-run deduplication report
+DEDUP_STATS = {"files": 0, "bytes": 0, "calls": 0}
+DEDUP_LOCK = threading.Lock()
+
+def count_deduplicated(size):
+    with DEDUP_LOCK:
+        DEDUP_STATS["files"] += 1
+        DEDUP_STATS["bytes"] += size or 0
+        DEDUP_STATS["calls"] += 1
+
+# Field API names per module from the fields.py bundle; None when there is no bundle
+ZOHO_SCHEMA = {}
+def load_zoho_schema():
+    if "modules" not in ZOHO_SCHEMA:
+        modules = None
+        if os.path.exists(ZOHO_SCHEMA_FILE):
+            with open(ZOHO_SCHEMA_FILE, "r") as f:
+                bundle = json.load(f)
+            modules = {module: {field["api_name"] for field in entry["fields"]} for module, entry in bundle.get("modules", {}).items()}
+            EVENTS.info("schema_loaded", f"Loaded field schema for {len(modules)} modules from {ZOHO_SCHEMA_FILE}")
+        ZOHO_SCHEMA["modules"] = modules
+    return ZOHO_SCHEMA["modules"]
 
-# Fetch deals from Zoho CRM
-def get_zoho_deals():
-    print("--------------------------------Fetching deals from Zoho--------------------------------")
+# The wanted fields that exist in the module. Zoho rejects a whole request over one unknown field,
+# so with a schema bundle the missing ones are dropped (with a warning) instead
+def zoho_fields(module, wanted):
+    schema = load_zoho_schema()
+    if not schema or module not in schema:
+        return wanted
+    missing = [field for field in wanted if field != "id" and field not in schema[module]]
+    if missing:
+        EVENTS.warning("schema_missing_fields", f"⚠️ {module} has no field(s) {', '.join(missing)}; leaving them out", module=module)
+    return [field for field in wanted if field not in missing]
+
+# Fetch deals from Zoho CRM as a lazy stream, so the pipeline starts on the first page.
+# With `modified_since` only deals modified after that Zoho timestamp are returned
+def get_zoho_deals(modified_since=None):
+    if ZOHO_DEAL_SOURCE == "bulk":
+        return iter_zoho_deals_bulk(modified_since)
+    return iter_zoho_deals(modified_since)
+
+# Walk every page of /Deals, switching to page_token once Zoho hands one out (required past 2000 records)
+def iter_zoho_deals(modified_since=None):
+    EVENTS.info("list_deals", "Fetching deals from Zoho", modified_since=modified_since)
     url = f"{ZOHO_API_BASE}/Deals"
-    params = {"fields": "id,Deal_Name,Stage,Amount"}
-    try:
-        response = requests.get(url, headers=get_zoho_headers(), params=params)
-        if response.status_code == 200:
-            return response.json().get("data", [])
+    fields = zoho_fields("Deals", ["id", "Deal_Name", "Stage", "Amount", "Owner", "Modified_Time"])
+    params = {"fields": ",".join(fields), "per_page": ZOHO_PAGE_SIZE, "page": 1}
+    while True:
+        try:
+            response = api_request("zoho", "GET", url, headers=get_zoho_headers_since(modified_since), params=params)
+        except requests.exceptions.RequestException as e:
+            EVENTS.error("list_deals_failed", f"❌ Request failed while fetching deals: {e}")
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        if response.status_code in (204, 304):
+            return
+        if response.status_code != 200:
+            EVENTS.error("list_deals_failed", f"❌ Failed to fetch deals: {response.status_code}", status=response.status_code, response=response.text)
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        body = response.json()
+        yield from body.get("data", [])
+        info = body.get("info", {})
+        if not info.get("more_records"):
+            return
+        if info.get("next_page_token"):
+            params.pop("page", None)
+            params["page_token"] = info["next_page_token"]
         else:
-            print(f"Failed to fetch deals: {response.status_code} - {response.text}")
-            return []
+            params["page"] += 1
+
+# Export deals with the Zoho Bulk Read API: one CSV job per 200k records, rows streamed from the result zip
+def iter_zoho_deals_bulk(modified_since=None):
+    EVENTS.info("list_deals", "Exporting deals with Zoho Bulk Read", modified_since=modified_since)
+    query = {"module": {"api_name": "Deals"}, "fields": zoho_fields("Deals", ["id", "Deal_Name", "Stage", "Amount", "Owner", "Modified_Time"]), "page": 1}
+    if modified_since:
+        query["criteria"] = {"api_name": "Modified_Time", "comparator": "greater_than", "value": modified_since}
+    while True:
+        result = run_zoho_bulk_read(query)
+        if not result:
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        yield from iter_bulk_read_rows(result["job_id"])
+        if not result.get("more_records"):
+            return
+        if result.get("next_page_token"):
+            query.pop("page", None)
+            query["page_token"] = result["next_page_token"]
+        else:
+            query["page"] = result.get("page", query.get("page", 1)) + 1
+
+# Create a Bulk Read job and wait for it to finish; returns the job's result block with its ID
+def run_zoho_bulk_read(query):
+    try:
+        # A second export job after a lost response only costs export quota, so this POST is retried
+        response = api_request("zoho", "POST", f"{ZOHO_BULK_API_BASE}/read", idempotent=True, headers=get_zoho_headers(), json={"query": query})
+        if response.status_code not in (200, 201):
+            EVENTS.error("bulk_read_failed", f"❌ Failed to create bulk read job: {response.status_code}", status=response.status_code, response=response.text)
+            return None
+        job_id = response.json()["data"][0]["details"]["id"]
+        EVENTS.info("bulk_read_created", f"Bulk read job {job_id} created", job=job_id)
+        while True:
+            time.sleep(BULK_POLL_INTERVAL)
+            response = api_request("zoho", "GET", f"{ZOHO_BULK_API_BASE}/read/{job_id}", headers=get_zoho_headers())
+            if response.status_code != 200:
+                EVENTS.error("bulk_read_failed", f"❌ Failed to check bulk read job {job_id}: {response.status_code}",
+                             job=job_id, status=response.status_code, response=response.text)
+                return None
+            job = response.json()["data"][0]
+            state = job.get("state")
+            if state == "COMPLETED":
+                result = job.get("result", {})
+                result["job_id"] = job_id
+                EVENTS.info("bulk_read_completed", f"✅ Bulk read job {job_id} completed ({result.get('count')} records)", job=job_id)
+                return result
+            if state == "FAILURE":
+                EVENTS.error("bulk_read_failed", f"❌ Bulk read job {job_id} failed", job=job_id, response=json.dumps(job))
+                return None
     except requests.exceptions.RequestException as e:
-        print(f"Request failed while fetching deals: {e}")
-        return []
+        EVENTS.error("bulk_read_failed", f"❌ Request failed: {e}")
+        return None
 
-# Fetch attachments for a Zoho deal
-def get_zoho_attachments(deal_id):
-    print(f"--------------------------------Fetching attachments for Zoho Deal ID: {deal_id}--------------------------------")
+# Download a Bulk Read result zip to a temporary file and stream its CSV rows
+def iter_bulk_read_rows(job_id):
+    with tempfile.TemporaryFile() as archive:
+        try:
+            with api_request("zoho", "GET", f"{ZOHO_BULK_API_BASE}/read/{job_id}/result", headers=get_zoho_headers(), stream=True) as response:
+                if response.status_code != 200:
+                    EVENTS.error("bulk_read_failed", f"❌ Failed to download bulk read result {job_id}: {response.status_code}",
+                                 job=job_id, status=response.status_code, response=response.text)
+                    ZOHO_LISTING_INCOMPLETE.set()
+                    return
+                for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    archive.write(chunk)
+        except requests.exceptions.RequestException as e:
+            EVENTS.error("bulk_read_failed", f"❌ Request failed: {e}", job=job_id)
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        archive.seek(0)
+        with zipfile.ZipFile(archive) as bundle:
+            for member in bundle.namelist():
+                with bundle.open(member) as raw:
+                    for row in csv.DictReader(io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")):
+                        # Bulk exports label the record ID column "Id"
+                        if "id" not in row and "Id" in row:
+                            row["id"] = row.pop("Id")
+                        yield row
+
+# Fetch attachments for a Zoho deal (only those added after `modified_since` when given);
+# None when the listing failed
+def get_zoho_attachments(deal_id, modified_since=None):
+    EVENTS.debug("list_attachments", f"Fetching attachments for Zoho Deal ID: {deal_id}", deal=deal_id)
     url = f"{ZOHO_API_BASE}/Deals/{deal_id}/Attachments"
     params = {"fields": "id,File_Name,Size,Created_Time"}
     try:
-        response = requests.get(url, headers=get_zoho_headers(), params=params)
+        response = api_request("zoho", "GET", url, headers=get_zoho_headers_since(modified_since), params=params)
         if response.status_code == 200:
             return response.json().get("data", [])
-        elif response.status_code == 204:
+        elif response.status_code in (204, 304):
             return []
         else:
-            print(f"Failed to fetch attachments: {response.status_code} - {response.text}")
-            return []
+            EVENTS.error("list_attachments_failed", f"❌ Failed to fetch attachments: {response.status_code}",
+                         deal=deal_id, status=response.status_code, response=response.text)
+            return None
     except requests.exceptions.RequestException as e:
-        print(f"Request failed: {e}")
+        EVENTS.error("list_attachments_failed", f"❌ Request failed: {e}", deal=deal_id)
+        return None
+
+# Every attachment on a deal through COQL, paged by id so no offset limit applies
+def iter_zoho_attachments_coql(created_since=None):
+    EVENTS.info("discover_attachments", "Discovering deal attachments with COQL", created_since=created_since)
+    last_id = 0
+    while True:
+        where = f"$se_module = 'Deals' and id > {last_id}"
+        if created_since:
+            where += f" and Created_Time > '{created_since}'"
+        query = f"select id, Parent_Id, File_Name, Size, Created_Time from Attachments where {where} order by id asc limit {COQL_PAGE_SIZE}"
+        try:
+            response = api_request("zoho", "POST", f"{ZOHO_API_BASE}/coql", idempotent=True, headers=get_zoho_headers(), json={"select_query": query})
+        except requests.exceptions.RequestException as e:
+            EVENTS.error("discover_attachments_failed", f"❌ Request failed while discovering attachments: {e}")
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        if response.status_code == 204:
+            return
+        if response.status_code != 200:
+            EVENTS.error("discover_attachments_failed", f"❌ Failed to discover attachments: {response.status_code}",
+                         status=response.status_code, response=response.text)
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        body = response.json()
+        rows = body.get("data", [])
+        yield from rows
+        if not rows or not body.get("info", {}).get("more_records"):
+            return
+        last_id = rows[-1]["id"]
+
+# Every attachment on a deal through a Bulk Read export of the Attachments module
+def iter_zoho_attachments_bulk(created_since=None):
+    EVENTS.info("discover_attachments", "Discovering deal attachments with Zoho Bulk Read", created_since=created_since)
+    criteria = {"api_name": "$se_module", "comparator": "equal", "value": "Deals"}
+    if created_since:
+        criteria = {"group_operator": "and", "group": [
+            criteria, {"api_name": "Created_Time", "comparator": "greater_than", "value": created_since}]}
+    query = {"module": {"api_name": "Attachments"}, "fields": ["id", "Parent_Id", "File_Name", "Size", "Created_Time"],
+             "criteria": criteria, "page": 1}
+    while True:
+        result = run_zoho_bulk_read(query)
+        if not result:
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        yield from iter_bulk_read_rows(result["job_id"])
+        if not result.get("more_records"):
+            return
+        if result.get("next_page_token"):
+            query.pop("page", None)
+            query["page_token"] = result["next_page_token"]
+        else:
+            query["page"] = result.get("page", query.get("page", 1)) + 1
+
+# Every deal attachment in a few paged calls: Bulk Read when ZOHO_ATTACHMENT_SOURCE=bulk, else COQL
+def iter_zoho_deal_attachments(created_since=None):
+    if ZOHO_ATTACHMENT_SOURCE == "bulk":
+        return iter_zoho_attachments_bulk(created_since)
+    return iter_zoho_attachments_coql(created_since)
+
+# COQL returns the parent as a lookup object, Bulk Read as a plain ID column
+def attachment_parent_id(row):
+    parent = row.get("Parent_Id") or row.get("Parent_Id.id")
+    return parent.get("id") if isinstance(parent, dict) else parent
+
+# Build the work list: every deal attachment goes into the attachments table as 'listed' (rows
+# already there keep their state). With `created_since` only attachments added after it are fetched.
+# Returns the newest Created_Time seen
+def discover_zoho_attachments(conn, created_since=None):
+    rows = iter_zoho_deal_attachments(created_since)
+    latest = {"latest": created_since}
+    created_date = datetime.now(timezone.utc).isoformat()
+    batch, count, deals = [], 0, set()
+    for row in track_high_water_mark(({**row, "Modified_Time": row.get("Created_Time")} for row in rows), latest):
+        zoho_deal_id = attachment_parent_id(row)
+        if not zoho_deal_id:
+            continue
+        batch.append((zoho_deal_id, row.get("id"), row.get("File_Name") or f"attachment_{row.get('id')}", attachment_size(row),
+                      row.get("Created_Time"), "listed", created_date))
+        deals.add(zoho_deal_id)
+        if len(batch) >= 1000:
+            count += store_work_list(conn, batch)
+            batch = []
+    count += store_work_list(conn, batch)
+    EVENTS.info("attachments_discovered", f"✅ Discovered {count} new attachments on {len(deals)} deals", attachments=count, deals=len(deals))
+    return latest["latest"]
+
+# Add discovered attachments to the work list; returns how many were new
+def store_work_list(conn, rows):
+    if not rows:
+        return 0
+    with DB_LOCK:
+        inserted = conn.executemany("INSERT OR IGNORE INTO attachments (zoho_deal_id, zoho_attachment_id, file_name, size, created_time, status, created_date) "
+                                    "VALUES (?, ?, ?, ?, ?, ?, ?)", rows).rowcount
+        conn.commit()
+    return inserted
+
+# Deals from the stored work list that still have attachments to migrate, each carrying its attachments
+# so the list stage needs no API call. Deals with the largest files come first, so the longest
+# transfers start at the beginning of the run rather than at its tail
+def load_work_list(conn):
+    with DB_LOCK:
+        rows = conn.execute("SELECT zoho_deal_id, zoho_attachment_id, file_name, size, created_time, status FROM attachments "
+                            "WHERE status NOT IN ('noted', 'failed')").fetchall()
+    deals = {}
+    for zoho_deal_id, zoho_attachment_id, file_name, size, created_time, status in rows:
+        deals.setdefault(zoho_deal_id, {"id": zoho_deal_id, "attachments": []})["attachments"].append(
+            {"id": zoho_attachment_id, "File_Name": file_name, "Size": size, "Created_Time": created_time, "status": status})
+    return sorted(deals.values(), key=lambda deal: -max(attachment["Size"] or 0 for attachment in deal["attachments"]))
+
+# Run attachment discovery, moving its own high-water mark (attachment Created_Time) on a clean pass
+def discover_attachments(conn, delta):
+    created_since = get_sync_state(conn, "zoho_attachments_created_at") if delta else None
+    if created_since:
+        EVENTS.info("delta_discovery", f"Delta discovery: attachments added since {created_since}", created_since=created_since)
+    ZOHO_LISTING_INCOMPLETE.clear()
+    latest = discover_zoho_attachments(conn, created_since)
+    if ZOHO_LISTING_INCOMPLETE.is_set():
+        EVENTS.warning("discover_attachments_incomplete", "⚠️ Attachment discovery did not finish; the stored work list is used as far as it goes")
+    elif latest and latest != created_since:
+        set_sync_state(conn, "zoho_attachments_created_at", latest)
+
+# Sync-state key holding the delta high-water mark; every shard layout keeps its own
+def delta_mark_key(shard=0, shards=1):
+    return "zoho_deals_modified_at" if shards == 1 else f"zoho_deals_modified_at:{shard}/{shards}"
+
+# Pass deals through unchanged while keeping the newest Modified_Time seen in `mark`
+def track_high_water_mark(deals, mark):
+    for deal in deals:
+        modified = deal.get("Modified_Time")
+        if modified:
+            try:
+                if not mark.get("latest") or datetime.fromisoformat(modified) > datetime.fromisoformat(mark["latest"]):
+                    mark["latest"] = modified
+            except ValueError:
+                pass
+        yield deal
+
+# Work out the file name for a Zoho attachment download from its response headers
+def attachment_filename(response, attachment_id, file_name):
+    content_disposition = response.headers.get("Content-Disposition", "")
+    if "filename=" in content_disposition:
+        return content_disposition.split("filename=")[1].strip('"; ')
+    content_type = response.headers.get("Content-Type", "").lower().split(";")[0].strip()
+    extension_map = {
+        "application/pdf": ".pdf", "application/msword": ".doc",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
+        "video/mp4": ".mp4", "video/quicktime": ".mov", "audio/mpeg": ".mp3",
+        "image/png": ".png", "image/jpeg": ".jpg", "application/x-download": ".xlsx",
+        "text/csv": ".csv", "application/xml": ".xml"
+    }
+    extension = extension_map.get(content_type, ".bin")
+    return f"attachment_{attachment_id}{extension}" if not file_name.endswith(extension) else file_name
+
+# Attachment size in bytes as reported by the Zoho listing, or None
+def attachment_size(attachment):
+    try:
+        return int(attachment.get("Size"))
+    except (TypeError, ValueError):
+        return None
+
+# Where an attachment is staged: ATTACHMENTS_FOLDER/ab/cd/<deal>_<attachment>, sharded by a hash of
+# the key so no directory grows past a few hundred entries. The downloaded file adds the original
+# extension; the partial download adds ".part"
+def staging_path(deal_id, attachment_id):
+    key = f"{deal_id}_{attachment_id}"
+    shard = hashlib.sha1(key.encode()).hexdigest()
+    return os.path.join(ATTACHMENTS_FOLDER, shard[:2], shard[2:4], key)
+
+# Byte quota over the staged files. A download reserves its size before it starts and waits (up to
+# STAGING_WAIT_SECONDS) while the cache is full; making room evicts uploaded files, least recently
+# used first. Running totals are kept in memory so staging a file costs a few indexed queries
+class StagingCache:
+    def __init__(self, conn, quota=STAGING_QUOTA_BYTES, min_free=STAGING_MIN_FREE_BYTES):
+        self.conn = conn
+        self.quota = quota
+        self.min_free = min_free
+        self.cond = threading.Condition()
+        os.makedirs(ATTACHMENTS_FOLDER, exist_ok=True)
+        with DB_LOCK:
+            # Files whose item got past the upload (or gave up) while a previous run was stopping
+            conn.execute("UPDATE staged_files SET pinned = 0 WHERE pinned = 1 AND EXISTS (SELECT 1 FROM attachments a "
+                         "WHERE a.zoho_deal_id = staged_files.zoho_deal_id AND a.zoho_attachment_id = staged_files.zoho_attachment_id "
+                         "AND a.status IN ('archived', 'uploaded', 'noted', 'failed'))")
+            conn.commit()
+        self.resync()
+
+    # Re-read the total from the state store; other worker processes share the folder and the table
+    def resync(self):
+        with DB_LOCK:
+            self.used = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM staged_files").fetchone()[0]
+        self.synced_at = time.time()
+
+    def has_room(self, size):
+        if time.time() - self.synced_at > 5:
+            self.resync()
+        return self.used + size <= self.quota and shutil.disk_usage(ATTACHMENTS_FOLDER).free - size >= self.min_free
+
+    # Pin space for an item about to be downloaded; False when no room could be made in time
+    def reserve(self, item):
+        deal_id, attachment_id = item["zoho_deal_id"], item["zoho_attachment_id"]
+        size = item.get("size") or 0
+        deadline = time.time() + STAGING_WAIT_SECONDS
+        with self.cond:
+            with DB_LOCK:
+                row = self.conn.execute("SELECT size FROM staged_files WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                        (deal_id, attachment_id)).fetchone()
+            if row:
+                # Already staged (e.g. a partial download being resumed): pin it again
+                self.touch(deal_id, attachment_id, pinned=1)
+                return True
+            while not self.has_room(size):
+                if self.evict_one():
+                    continue
+                self.resync()
+                if self.has_room(size):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    EVENTS.warning("staging_full", f"⚠️ Staging cache full ({self.used / 1048576:.0f} MB used), {item['file_name']} goes to the retry queue",
+                                   used_bytes=self.used)
+                    return False
+                self.cond.wait(min(remaining, 5))
+            with DB_LOCK:
+                self.conn.execute("INSERT INTO staged_files (zoho_deal_id, zoho_attachment_id, path, size, pinned, last_used) VALUES (?, ?, ?, ?, 1, ?)",
+                                  (deal_id, attachment_id, staging_path(deal_id, attachment_id), size, time.time()))
+                self.conn.commit()
+            self.used += size
+            return True
+
+    # Record where the download ended up and its real size, which may differ from the listed one
+    def downloaded(self, item, file_path):
+        size = os.path.getsize(file_path)
+        with self.cond:
+            with DB_LOCK:
+                row = self.conn.execute("SELECT size FROM staged_files WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                        (item["zoho_deal_id"], item["zoho_attachment_id"])).fetchone()
+                if not row:
+                    return
+                self.conn.execute("UPDATE staged_files SET path = ?, size = ?, last_used = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                  (file_path, size, time.time(), item["zoho_deal_id"], item["zoho_attachment_id"]))
+                self.conn.commit()
+            self.used += size - row[0]
+
+    # The item no longer needs its file: it becomes evictable. Files staged before the cache existed are removed
+    def release(self, item):
+        with self.cond:
+            if not self.touch(item["zoho_deal_id"], item["zoho_attachment_id"], pinned=0):
+                if item.get("file_path") and os.path.exists(item["file_path"]):
+                    os.remove(item["file_path"])
+            self.cond.notify_all()
+
+    def touch(self, deal_id, attachment_id, pinned):
+        with DB_LOCK:
+            updated = self.conn.execute("UPDATE staged_files SET pinned = ?, last_used = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                        (pinned, time.time(), deal_id, attachment_id)).rowcount
+            self.conn.commit()
+        return updated
+
+    # Delete the least recently used unpinned file; False when everything left is pinned
+    def evict_one(self):
+        with DB_LOCK:
+            row = self.conn.execute("SELECT zoho_deal_id, zoho_attachment_id, path, size FROM staged_files WHERE pinned = 0 ORDER BY last_used LIMIT 1").fetchone()
+        if not row:
+            return False
+        self.remove(*row)
+        return True
+
+    # The item's file will not be read again (e.g. it is in an archive now): free its space at once
+    def discard(self, item):
+        with self.cond:
+            with DB_LOCK:
+                row = self.conn.execute("SELECT zoho_deal_id, zoho_attachment_id, path, size FROM staged_files WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                        (item["zoho_deal_id"], item["zoho_attachment_id"])).fetchone()
+            if row:
+                self.remove(*row)
+            elif item.get("file_path") and os.path.exists(item["file_path"]):
+                os.remove(item["file_path"])
+            self.cond.notify_all()
+
+    def remove(self, deal_id, attachment_id, path, size):
+        with DB_LOCK:
+            self.conn.execute("DELETE FROM staged_files WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", (deal_id, attachment_id))
+            self.conn.commit()
+        for stale in (path, staging_path(deal_id, attachment_id) + ".part"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        clear_download_progress(self.conn, deal_id, attachment_id)
+        self.used -= size
+
+def load_download_progress(conn, deal_id, attachment_id):
+    if conn is None:
         return []
+    with DB_LOCK:
+        rows = conn.execute("SELECT range_start, range_end, written FROM download_progress WHERE zoho_deal_id = ? AND zoho_attachment_id = ? ORDER BY range_start",
+                            (deal_id, attachment_id)).fetchall()
+    return [{"start": start, "end": end, "written": written} for start, end, written in rows]
+
+def save_download_progress(conn, deal_id, attachment_id, parts):
+    if conn is None:
+        return
+    with DB_LOCK:
+        conn.executemany("INSERT OR REPLACE INTO download_progress (zoho_deal_id, zoho_attachment_id, range_start, range_end, written) VALUES (?, ?, ?, ?, ?)",
+                         [(deal_id, attachment_id, part["start"], part["end"], part["written"]) for part in parts])
+        conn.commit()
+
+def clear_download_progress(conn, deal_id, attachment_id):
+    if conn is None:
+        return
+    with DB_LOCK:
+        conn.execute("DELETE FROM download_progress WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", (deal_id, attachment_id))
+        conn.commit()
+
+# Fetch one byte range of an attachment into the partial file, picking up from the last byte written
+# with a Range request whenever the connection drops. `part` is updated in place and `checkpoint`
+# is called every RANGE_CHECKPOINT_BYTES. Returns "done", "failed", or "restart" when the server
+# ignored the Range header (the range then has to be fetched from byte zero)
+def fetch_attachment_range(url, file_path, part, meta, checkpoint, hasher=None):
+    attempt = 0
+    while True:
+        offset = part["start"] + part["written"]
+        if part["end"] is not None and offset > part["end"]:
+            return "done"
+        headers = get_zoho_headers()
+        if offset or part["end"] is not None:
+            headers["Range"] = f"bytes={offset}-{'' if part['end'] is None else part['end']}"
+        try:
+            with api_request("zoho", "GET", url, headers=headers, stream=True) as response:
+                if response.status_code == 204:
+                    meta["empty"] = True
+                    return "failed"
+                if response.status_code == 200 and "Range" in headers:
+                    return "restart"
+                # A resume that asks for the bytes after the last one: everything was already written
+                # (a crash between the last checkpoint and the rename, or a drop right at the end)
+                if response.status_code == 416 and part["end"] is None and offset:
+                    total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+                    total = int(total) if total.isdigit() else meta.get("size")
+                    if total is not None and total != offset:
+                        return "restart"
+                    meta["total"] = total
+                    return "done"
+                if response.status_code not in (200, 206):
+                    EVENTS.error("download_failed", f"❌ Download of {meta['file_name']} failed: {response.status_code}",
+                                 deal=meta["deal_id"], attachment=meta["attachment_id"], status=response.status_code, response=response.text)
+                    return "failed"
+                if "filename" not in meta:
+                    meta["filename"] = attachment_filename(response, meta["attachment_id"], meta["file_name"])
+                if response.status_code == 206 and "/" in response.headers.get("Content-Range", ""):
+                    total = response.headers["Content-Range"].rsplit("/", 1)[1]
+                    if total.isdigit():
+                        meta["total"] = int(total)
+                unsaved = 0
+                with open(file_path, "r+b") as f:
+                    f.seek(offset)
+                    if part["end"] is None:
+                        f.truncate()  # Drop bytes written after the last checkpoint
+                    try:
+                        for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                            f.write(chunk)
+                            if hasher is not None:
+                                hasher.update(chunk)
+                            part["written"] += len(chunk)
+                            unsaved += len(chunk)
+                            if unsaved >= RANGE_CHECKPOINT_BYTES:
+                                f.flush()
+                                checkpoint()
+                                unsaved = 0
+                    finally:
+                        f.flush()
+                        if unsaved:
+                            checkpoint()
+            return "done"
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            attempt += 1
+            if attempt > API_MAX_RETRIES:
+                EVENTS.error("download_failed", f"❌ Download interrupted {attempt} times, keeping {part['written']} bytes for the next attempt: {e}",
+                             deal=meta["deal_id"], attachment=meta["attachment_id"])
+                return "failed"
+            EVENTS.warning("download_interrupted", f"🔁 Download interrupted at byte {part['start'] + part['written']}, resuming ({e})",
+                           deal=meta["deal_id"], attachment=meta["attachment_id"])
+            time.sleep(backoff_delay(attempt))
 
-# Download attachment from Zoho CRM
-def download_zoho_attachment(deal_id, attachment_id, file_name):
-    print(f"--------------------------------Downloading attachment: {file_name}--------------------------------")
+# Download attachment from Zoho CRM to its staging path; returns (file_path, sha256) or (None, None).
+# Bytes land in a partial file whose progress is kept in `conn`, so a dropped connection or a
+# crashed run resumes with a Range request instead of starting over. Files of at least
+# PARALLEL_RANGE_THRESHOLD bytes are fetched as PARALLEL_RANGE_PARTS ranges at once
+def download_zoho_attachment(deal_id, attachment_id, file_name, conn=None, size=None):
+    EVENTS.debug("download", f"Downloading attachment: {file_name}", size=size)
     url = f"{ZOHO_API_BASE}/Attachments/{attachment_id}"
-    try:
-        response = requests.get(url, headers=get_zoho_headers(), stream=True)
-        if response.status_code == 200:
-            content_disposition = response.headers.get("Content-Disposition", "")
-            if "filename=" in content_disposition:
-                filename = content_disposition.split("filename=")[1].strip('"; ')
-            else:
-                content_type = response.headers.get("Content-Type", "").lower().split(";")[0].strip()
-                extension_map = {
-                    "application/pdf": ".pdf", "application/msword": ".doc",
-                    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": ".docx",
-                    "video/mp4": ".mp4", "video/quicktime": ".mov", "audio/mpeg": ".mp3",
-                    "image/png": ".png", "image/jpeg": ".jpg", "application/x-download": ".xlsx",
-                    "text/csv": ".csv", "application/xml": ".xml"
-                }
-                extension = extension_map.get(content_type, ".bin")
-                filename = f"attachment_{attachment_id}{extension}" if not file_name.endswith(extension) else file_name
-
-            base, ext = os.path.splitext(filename)
-            counter = 1
-            while os.path.exists(os.path.join(ATTACHMENTS_FOLDER, filename)):
-                filename = f"{base}_{counter}{ext}"
-                counter += 1
-
-            file_path = os.path.join(ATTACHMENTS_FOLDER, filename)
-            os.makedirs(ATTACHMENTS_FOLDER, exist_ok=True)
-            with open(file_path, "wb") as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-            print(f"✅ Downloaded: {file_path}")
-            return file_path
-        elif response.status_code == 204:
-            print("⚠️ No content. Skipping.")
-            return None
+    partial_path = staging_path(deal_id, attachment_id) + ".part"
+    os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+    parts = load_download_progress(conn, deal_id, attachment_id) if os.path.exists(partial_path) else []
+    if parts:
+        EVENTS.info("download_resumed", f"🔁 Resuming {file_name} from {sum(part['written'] for part in parts)} bytes")
+    else:
+        clear_download_progress(conn, deal_id, attachment_id)
+        open(partial_path, "wb").close()
+        if size and size >= PARALLEL_RANGE_THRESHOLD and PARALLEL_RANGE_PARTS > 1:
+            step = -(-size // PARALLEL_RANGE_PARTS)
+            parts = [{"start": start, "end": min(start + step, size) - 1, "written": 0} for start in range(0, size, step)]
         else:
-            print(f"❌ Failed: {response.status_code} - {response.text}")
-            return None
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
-        return None
+            parts = [{"start": 0, "end": None, "written": 0}]
+        save_download_progress(conn, deal_id, attachment_id, parts)
+    meta = {"deal_id": deal_id, "attachment_id": attachment_id, "file_name": file_name, "size": size}
+    checkpoint = lambda: save_download_progress(conn, deal_id, attachment_id, parts)
+
+    hasher = None
+    result = None
+    if len(parts) > 1 or parts[0]["end"] is not None:
+        results = [None] * len(parts)
+        def fetch(index):
+            results[index] = fetch_attachment_range(url, partial_path, parts[index], meta, checkpoint)
+        threads = [threading.Thread(target=fetch, args=(i,), name=f"range-{attachment_id}-{i}", daemon=True) for i in range(len(parts))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        result = "failed" if "failed" in results else "done"
+        if "restart" in results:
+            EVENTS.warning("range_unsupported", "⚠️ Server does not support Range requests, downloading in one piece")
+            parts = [{"start": 0, "end": None, "written": 0}]
+            clear_download_progress(conn, deal_id, attachment_id)
+            open(partial_path, "wb").close()
+            save_download_progress(conn, deal_id, attachment_id, parts)
+
+    if len(parts) == 1 and parts[0]["end"] is None:
+        # One sequential range: hash as the bytes arrive, starting with what a previous run wrote
+        part = parts[0]
+        hasher = hashlib.sha256()
+        remaining = part["written"]
+        with open(partial_path, "rb") as f:
+            while remaining:
+                chunk = f.read(min(STREAM_CHUNK_SIZE, remaining))
+                if not chunk:
+                    part["written"] -= remaining
+                    break
+                hasher.update(chunk)
+                remaining -= len(chunk)
+        result = fetch_attachment_range(url, partial_path, part, meta, checkpoint, hasher)
+        if result == "restart":
+            EVENTS.warning("range_unsupported", "⚠️ Server ignored the Range request or the file changed, downloading from the start")
+            part["written"] = 0
+            open(partial_path, "wb").close()
+            hasher = hashlib.sha256()
+            result = fetch_attachment_range(url, partial_path, part, meta, checkpoint, hasher)
 
-# Upload file to HubSpot and get attachment ID
-def upload_to_hubspot(file_path):
-    print(f"--------------------------------Uploading to HubSpot: {os.path.basename(file_path)}--------------------------------")
-    url = "https://api.hubapi.com/files/v3/files"  # HubSpot Files API endpoint
+    if meta.get("empty"):
+        EVENTS.warning("empty_attachment", f"⚠️ No content in {file_name}. Skipping.")
+        clear_download_progress(conn, deal_id, attachment_id)
+        os.remove(partial_path)
+        return None, None
+    if result != "done":
+        return None, None
+    downloaded = os.path.getsize(partial_path)
+    if meta.get("total") is not None and downloaded != meta["total"]:
+        EVENTS.error("download_truncated", f"❌ Downloaded {downloaded} of {meta['total']} bytes, starting over on the next attempt",
+                     downloaded=downloaded, total=meta["total"])
+        clear_download_progress(conn, deal_id, attachment_id)
+        os.remove(partial_path)
+        return None, None
+    if hasher is None:
+        hasher = hashlib.sha256()
+        with open(partial_path, "rb") as f:
+            for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+
+    # Keep the extension so the upload can still guess the MIME type from the path
+    file_path = staging_path(deal_id, attachment_id) + os.path.splitext(meta.get("filename") or file_name)[1][:16]
+    os.replace(partial_path, file_path)
+    clear_download_progress(conn, deal_id, attachment_id)
+    EVENTS.debug("downloaded", f"✅ Downloaded: {file_path}", bytes=downloaded)
+    return file_path, hasher.hexdigest()
+
+# Upload file to HubSpot and get attachment ID; `file_name` is the name HubSpot shows (default: the file's own)
+def upload_to_hubspot(file_path, file_name=None, folder_id=None):
+    file_name = file_name or os.path.basename(file_path)
+    EVENTS.debug("upload", f"Uploading to HubSpot: {file_name}", folder=folder_id)
+    url = HUBSPOT_UPLOAD_URL  # HubSpot Files API endpoint
     headers = {
-        "Authorization": f"Bearer {load_hubspot_tokens()}",
+        "Authorization": f"Bearer {HUBSPOT_TOKENS.get()}",
         "accept": "application/json"
     }
     
@@ -365,69 +1837,698 @@ def upload_to_hubspot(file_path):
     # Prepare the file for upload using multipart/form-data
     with open(file_path, "rb") as file:
         files = {
-            "file": (os.path.basename(file_path), file, content_type)
+            "file": (file_name, file, content_type)
         }
+        data = {"folderId": folder_id} if folder_id else None
         try:
-            response = requests.post(url, headers=headers, files=files)
+            response = api_request("hubspot", "POST", url, headers=headers, files=files, data=data)
             if response.status_code == 201:  # 201 Created for successful upload
                 data = response.json()
                 hs_attachment_id = data.get("id")
-                print(f"✅ Uploaded. HubSpot Attachment ID: {hs_attachment_id}")
+                EVENTS.debug("uploaded", f"✅ Uploaded. HubSpot Attachment ID: {hs_attachment_id}", hubspot_file=hs_attachment_id)
                 return hs_attachment_id
             else:
-                print(f"❌ Failed: {response.status_code} - {response.text}")
+                EVENTS.error("upload_failed", f"❌ Upload of {file_name} failed: {response.status_code}",
+                             status=response.status_code, response=response.text)
                 return None
         except requests.exceptions.RequestException as e:
-            print(f"❌ Request failed: {e}")
+            EVENTS.error("upload_failed", f"❌ Upload of {file_name} failed: {e}")
             return None
 
-# Fetch HubSpot deal ID using zoho_deal_id custom property with pagination
-def get_hubspot_deal_id(zoho_deal_id):
-    print(f"--------------------------------Fetching HubSpot Deal ID for Zoho Deal ID: {zoho_deal_id}--------------------------------")
-    url = HUBSPOT_DEALS_API
+# multipart/form-data body that pulls the file part from a live download as the upload reads it,
+# so only one chunk is ever held in memory. len() is known when Zoho sends a Content-Length.
+# `chunks` may also be a function returning the chunk iterator; such a body can be rewound and resent.
+# `fields` are plain form fields (e.g. folderId) sent ahead of the file part. `capture`, when given,
+# receives the first `capture_limit` bytes of the file
+class StreamingMultipartBody:
+    def __init__(self, chunks, filename, content_type, content_length=None, digest=None, fields=None, capture=None, capture_limit=0):
+        self.source = chunks if callable(chunks) else None
+        if self.source:
+            chunks = self.source()
+        self.digest = digest
+        self.capture = capture
+        self.capture_limit = capture_limit
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        safe_name = filename.replace('"', "'")
+        form_fields = "".join(f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+                              for name, value in (fields or {}).items())
+        self.head = (form_fields + f"--{self.boundary}\r\n"
+                     f'Content-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+                     f"Content-Type: {content_type}\r\n\r\n").encode()
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode()
+        self.chunks = chunks
+        self.content_length = content_length
+        self.sent = 0
+        self.pending = self.head
+        self.finished = False
+
+    def __len__(self):
+        return len(self.head) + self.content_length + len(self.tail)
+
+    # Start over before a retry. A body reading a live download cannot, so those are sent with retries=0
+    def rewind(self):
+        if self.source:
+            self.chunks = self.source()
+            self.sent = 0
+            self.pending = self.head
+            self.finished = False
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def read(self, size=-1):
+        while not self.pending and not self.finished:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                if self.content_length is not None and self.sent != self.content_length:
+                    raise IOError(f"Download ended after {self.sent} of {self.content_length} bytes")
+                self.pending = self.tail
+                self.finished = True
+            else:
+                self.sent += len(chunk)
+                self.pending = chunk
+                if self.digest is not None:
+                    self.digest.update(chunk)
+                if self.capture is not None and len(self.capture) < self.capture_limit:
+                    self.capture += chunk[:self.capture_limit - len(self.capture)]
+        if size is None or size < 0:
+            size = len(self.pending)
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+# Stream a Zoho attachment straight into the HubSpot Files API without staging it on disk.
+# Returns (hs_attachment_id, sha256 hex, stage). A streamed body cannot be replayed, so after a
+# retryable failure `stage` is True: the caller should fetch the file into the staging cache and
+# upload it from there. `capture`, a bytearray, ends up holding the first AI_CAPTURE_BYTES of the
+# file for tagging
+def stream_attachment_to_hubspot(deal_id, attachment_id, file_name, folder_id=None, capture=None):
+    EVENTS.debug("transfer", f"Streaming attachment to HubSpot: {file_name}", folder=folder_id)
+    url = f"{ZOHO_API_BASE}/Attachments/{attachment_id}"
+    try:
+        with api_request("zoho", "GET", url, headers=get_zoho_headers(), stream=True) as download:
+            if download.status_code == 204:
+                EVENTS.warning("empty_attachment", f"⚠️ No content in {file_name}. Skipping.")
+                return None, None, False
+            if download.status_code != 200:
+                EVENTS.error("download_failed", f"❌ Download of {file_name} failed: {download.status_code}",
+                             status=download.status_code, response=download.text)
+                return None, None, False
+            filename = attachment_filename(download, attachment_id, file_name)
+            content_type = download.headers.get("Content-Type", "").split(";")[0].strip()
+            if not content_type or content_type == "application/x-download":
+                content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            # A compressed transfer decodes to an unknown size, so only trust Content-Length for identity encoding
+            content_length = download.headers.get("Content-Length")
+            if content_length and not download.headers.get("Content-Encoding"):
+                content_length = int(content_length)
+            else:
+                content_length = None
+            digest = hashlib.sha256()
+            body = StreamingMultipartBody(download.iter_content(chunk_size=STREAM_CHUNK_SIZE), filename, content_type, content_length, digest,
+                                          fields={"folderId": folder_id} if folder_id else None,
+                                          capture=capture, capture_limit=AI_CAPTURE_BYTES)
+            headers = {
+                "Authorization": f"Bearer {HUBSPOT_TOKENS.get()}",
+                "accept": "application/json",
+                "Content-Type": body.content_type
+            }
+            if content_length is not None:
+                data = body
+            else:
+                data = iter(body)  # Unknown size: send with chunked transfer encoding
+            response = api_request("hubspot", "POST", HUBSPOT_UPLOAD_URL, retries=0, headers=headers, data=data)
+        if response.status_code == 201:
+            hs_attachment_id = response.json().get("id")
+            EVENTS.debug("transferred", f"✅ Streamed {body.sent} bytes. HubSpot Attachment ID: {hs_attachment_id}",
+                         bytes=body.sent, hubspot_file=hs_attachment_id)
+            return hs_attachment_id, digest.hexdigest(), False
+        if response.status_code != 429 and response.status_code < 500:
+            EVENTS.error("upload_failed", f"❌ Upload of {file_name} failed: {response.status_code}",
+                         status=response.status_code, response=response.text)
+            return None, None, False
+        EVENTS.warning("transfer_fallback", f"⚠️ Streaming upload failed ({response.status_code}), staging on disk to retry",
+                       status=response.status_code)
+    except (requests.exceptions.RequestException, IOError) as e:
+        EVENTS.warning("transfer_fallback", f"⚠️ Streaming transfer failed ({e}), staging on disk to retry")
+    return None, None, True
+
+# Two-phase mode: `extract` appends every downloaded attachment to append-only tar chunks in
+# ARCHIVE_FOLDER and records it in a JSONL manifest (deal, attachment, name, size, sha256, the deal
+# owner's Zoho ID and email, and where its bytes start in the chunk); `load` uploads straight out of
+# the chunks using those offsets
+TAR_BLOCK = 512
+
+def archive_padding(size):
+    return -size % TAR_BLOCK
+
+# Manifest entries and the length of the file up to the last complete line; a line cut short by a
+# crash is ignored
+def read_manifest(path):
+    entries, valid = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                break
+            valid += len(line)
+    return entries, valid
+
+# Every extract process's manifest, keyed by (deal, attachment)
+def load_archive_manifests(folder=ARCHIVE_FOLDER):
+    entries = {}
+    for name in sorted(os.listdir(folder)) if os.path.isdir(folder) else []:
+        if name.endswith(".manifest.jsonl"):
+            for entry in read_manifest(os.path.join(folder, name))[0]:
+                entries[(entry["zoho_deal_id"], entry["zoho_attachment_id"])] = entry
+    return entries
+
+# Deals in archive order, each carrying its archived attachments and owner, so `load` reads the chunks
+# front to back and never asks Zoho
+def iter_archived_deals(entries):
+    deals, owners = {}, {}
+    for entry in sorted(entries.values(), key=lambda entry: (entry["archive"], entry["offset"])):
+        deals.setdefault(entry["zoho_deal_id"], []).append({"id": entry["zoho_attachment_id"], "File_Name": entry["file_name"], "Size": entry["size"],
+                                                            "Created_Time": entry.get("created_time")})
+        owners[entry["zoho_deal_id"]] = entry.get("owner")
+    for zoho_deal_id, attachments in deals.items():
+        yield {"id": zoho_deal_id, "attachments": attachments, "Owner": {"id": owners[zoho_deal_id]}}
+
+# Copy `size` bytes between files inside the kernel where the platform allows it
+def copy_file_data(source, target, size):
+    copied = 0
+    if hasattr(os, "sendfile"):
+        with contextlib.suppress(OSError):
+            while copied < size:
+                sent = os.sendfile(target.fileno(), source.fileno(), copied, size - copied)
+                if not sent:
+                    break
+                copied += sent
+    source.seek(copied)
+    shutil.copyfileobj(source, target, 1024 * 1024)
+
+# Append-only archive writer for one extract process: <prefix>-00001.tar, -00002.tar, ... each
+# closed once it passes ARCHIVE_MAX_BYTES. A member's manifest line is written only after its
+# bytes, and on reopen the last chunk is cut back to the end of its last manifest entry, which
+# drops a member torn by a crash
+class ArchiveWriter:
+    def __init__(self, prefix, folder=ARCHIVE_FOLDER, max_bytes=ARCHIVE_MAX_BYTES):
+        self.folder = folder
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        manifest_path = os.path.join(folder, f"{prefix}.manifest.jsonl")
+        entries, valid = read_manifest(manifest_path) if os.path.exists(manifest_path) else ([], 0)
+        self.archived = {(entry["zoho_deal_id"], entry["zoho_attachment_id"]) for entry in entries}
+        self.manifest = open(manifest_path, "ab")
+        self.manifest.truncate(valid)
+        chunks = [name for name in os.listdir(folder) if re.fullmatch(rf"{re.escape(prefix)}-\d{{5}}\.tar", name)]
+        self.sequence = max((int(name[-9:-4]) for name in chunks), default=1)
+        end = max((entry["offset"] + entry["size"] + archive_padding(entry["size"])
+                   for entry in entries if entry["archive"] == self.chunk_name()), default=0)
+        self.open_chunk(end)
+        if self.position >= self.max_bytes:
+            self.roll()
+
+    def chunk_name(self):
+        return f"{self.prefix}-{self.sequence:05d}.tar"
+
+    # Unbuffered, so sendfile and plain writes share one file offset
+    def open_chunk(self, end=0):
+        path = os.path.join(self.folder, self.chunk_name())
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b", buffering=0)
+        self.file.truncate(end)
+        self.file.seek(end)
+        self.position = end
+
+    # Finish the chunk with the tar end-of-archive blocks, so it is a valid tar on its own
+    def finish_chunk(self):
+        self.file.write(b"\0" * TAR_BLOCK * 2)
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+    def roll(self):
+        self.finish_chunk()
+        self.sequence += 1
+        self.open_chunk()
+
+    # Append a staged file and record it in the manifest; returns the manifest entry
+    def append(self, item, file_path):
+        size = os.path.getsize(file_path)
+        info = tarfile.TarInfo(f"{item['zoho_deal_id']}/{item['zoho_attachment_id']}/{item['file_name']}")
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT)
+        with self.lock:
+            if self.position and self.position + len(header) + size > self.max_bytes:
+                self.roll()
+            offset = self.position + len(header)
+            self.file.write(header)
+            with open(file_path, "rb") as source:
+                copy_file_data(source, self.file, size)
+            if self.file.tell() != offset + size:
+                self.file.truncate(self.position)
+                self.file.seek(self.position)
+                raise IOError(f"{file_path} changed while it was archived")
+            self.file.write(b"\0" * archive_padding(size))
+            owner = DEAL_OWNERS.get(item["zoho_deal_id"])
+            entry = {"zoho_deal_id": item["zoho_deal_id"], "zoho_attachment_id": item["zoho_attachment_id"], "file_name": item["file_name"],
+                     "size": size, "sha256": item.get("sha256"), "created_time": item.get("created_time"), "archive": self.chunk_name(), "offset": offset,
+                     "owner": owner, "owner_email": OWNER_EMAILS.get(owner)}
+            self.manifest.write((json.dumps(entry) + "\n").encode())
+            self.manifest.flush()
+            self.position = offset + size + archive_padding(size)
+            self.archived.add((item["zoho_deal_id"], item["zoho_attachment_id"]))
+        return entry
+
+    def close(self):
+        with self.lock:
+            self.finish_chunk()
+            os.fsync(self.manifest.fileno())
+            self.manifest.close()
+
+# Read-only memory maps of the archive chunks, opened once and shared by the load workers
+class ArchiveReader:
+    def __init__(self, folder=ARCHIVE_FOLDER):
+        self.folder = folder
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def view(self, archive):
+        with self.lock:
+            if archive not in self.maps:
+                with open(os.path.join(self.folder, archive), "rb") as f:
+                    self.maps[archive] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.maps[archive])
+
+    def close(self):
+        with self.lock:
+            for mapping in self.maps.values():
+                # A view still held by a finished upload keeps the map open until it is collected
+                with contextlib.suppress(BufferError):
+                    mapping.close()
+            self.maps = {}
+
+# Upload one archived file out of its mapped chunk. The body is sent as slices of the mapping, so the
+# file is never copied into Python buffers, and it can be replayed when api_request retries
+def upload_archive_member(reader, entry, file_name, folder_id=None):
+    EVENTS.debug("upload", f"Uploading to HubSpot from {entry['archive']}: {file_name}", archive=entry["archive"], folder=folder_id)
+    member = reader.view(entry["archive"])[entry["offset"]:entry["offset"] + entry["size"]]
+    content_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    body = StreamingMultipartBody(lambda: (member[position:position + STREAM_CHUNK_SIZE] for position in range(0, len(member), STREAM_CHUNK_SIZE)),
+                                  file_name, content_type, entry["size"], fields={"folderId": folder_id} if folder_id else None)
+    headers = {
+        "Authorization": f"Bearer {HUBSPOT_TOKENS.get()}",
+        "accept": "application/json",
+        "Content-Type": body.content_type
+    }
+    try:
+        response = api_request("hubspot", "POST", HUBSPOT_UPLOAD_URL, headers=headers, data=body)
+        if response.status_code == 201:
+            hs_attachment_id = response.json().get("id")
+            EVENTS.debug("uploaded", f"✅ Uploaded. HubSpot Attachment ID: {hs_attachment_id}", hubspot_file=hs_attachment_id)
+            return hs_attachment_id
+        EVENTS.error("upload_failed", f"❌ Upload of {file_name} failed: {response.status_code}",
+                     status=response.status_code, response=response.text)
+        return None
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("upload_failed", f"❌ Upload of {file_name} failed: {e}")
+        return None
+
+# Subfolders, below the chosen folder, that an attachment is uploaded into
+def hubspot_folder_path(item):
+    if HUBSPOT_FOLDER_LAYOUT == "deal":
+        return [f"Deal {item['zoho_deal_id']}"]
+    if HUBSPOT_FOLDER_LAYOUT == "month":
+        try:
+            created = datetime.fromisoformat(item["created_time"]) if item.get("created_time") else None
+        except ValueError:
+            created = None
+        # Attachments listed before Created_Time was stored are filed under the month they are uploaded
+        created = created or datetime.now(timezone.utc)
+        return [created.strftime("%Y"), created.strftime("%m")]
+    return []
+
+# The ID of the folder called `name` directly under `parent_folder_id`, or None
+def find_hubspot_folder(name, parent_folder_id):
+    params = {"parentFolderIds": parent_folder_id, "name": name}
+    response = api_request("hubspot", "GET", f"{HUBSPOT_FOLDERS_API}/search", headers=get_hubspot_headers(), params=params)
+    if response.status_code != 200:
+        raise Exception(f"Folder search failed: {response.status_code} - {response.text}")
+    for folder in response.json().get("results", []):
+        if folder.get("name") == name and str(folder.get("parentFolderId")) == str(parent_folder_id):
+            return folder.get("id")
+    return None
+
+# Create folder `name` under `parent_folder_id` and return its ID. When HubSpot refuses because the
+# folder exists (made by an earlier run or another worker), the existing folder is used
+def create_hubspot_folder(name, parent_folder_id):
+    payload = {"name": name, "parentFolderId": parent_folder_id}
+    response = api_request("hubspot", "POST", HUBSPOT_FOLDERS_API, headers=get_hubspot_headers(), json=payload)
+    if response.status_code in (200, 201):
+        return response.json().get("id")
+    if response.status_code in (400, 409):
+        folder_id = find_hubspot_folder(name, parent_folder_id)
+        if folder_id:
+            return folder_id
+    raise Exception(f"Failed to create folder {name}: {response.status_code} - {response.text}")
+
+# Folder IDs by (parent folder ID, name), kept in the hubspot_folders table. A folder is looked up or
+# created the first time an upload needs it; every later upload into it makes no folder call
+class HubSpotFolders:
+    def __init__(self, conn, root_folder_id):
+        self.conn = conn
+        self.root_folder_id = str(root_folder_id)
+        self.lock = threading.Lock()
+        with DB_LOCK:
+            self.ids = {(parent_folder_id, name): folder_id for parent_folder_id, name, folder_id
+                        in conn.execute("SELECT parent_folder_id, name, folder_id FROM hubspot_folders").fetchall()}
+
+    # Folder ID an item is uploaded into; None when a folder on the way could not be created
+    def folder_for(self, item):
+        folder_id = self.root_folder_id
+        for name in hubspot_folder_path(item):
+            folder_id = self.resolve(folder_id, name)
+            if not folder_id:
+                return None
+        return folder_id
+
+    def resolve(self, parent_folder_id, name):
+        key = (parent_folder_id, name)
+        if key in self.ids:
+            return self.ids[key]
+        # Misses are resolved one at a time, so uploads racing into a new folder create it once
+        with self.lock:
+            if key in self.ids:
+                return self.ids[key]
+            with DB_LOCK:
+                row = self.conn.execute("SELECT folder_id FROM hubspot_folders WHERE parent_folder_id = ? AND name = ?", key).fetchone()
+            if row:
+                # Stored by another worker process since we loaded the table
+                self.ids[key] = row[0]
+                return row[0]
+            try:
+                with METRICS.timed("folder"):
+                    folder_id = str(create_hubspot_folder(name, parent_folder_id))
+            except Exception as e:
+                EVENTS.error("folder_failed", f"❌ Could not create HubSpot folder {name}: {e}", parent_folder=parent_folder_id)
+                return None
+            with DB_LOCK:
+                self.conn.execute("INSERT OR IGNORE INTO hubspot_folders (parent_folder_id, name, folder_id) VALUES (?, ?, ?)", (*key, folder_id))
+                folder_id = self.conn.execute("SELECT folder_id FROM hubspot_folders WHERE parent_folder_id = ? AND name = ?", key).fetchone()[0]
+                self.conn.commit()
+            self.ids[key] = folder_id
+            EVENTS.debug("folder_ready", f"📁 HubSpot folder {name} ready (ID: {folder_id})", folder=folder_id)
+            return folder_id
+
+# Persist zoho_deal_id -> hubspot_deal_id pairs and mirror them into DEAL_INDEX
+def store_deal_mappings(conn, mappings):
+    if not mappings:
+        return
+    updated_at = datetime.now(timezone.utc).isoformat()
+    with DB_LOCK:
+        conn.executemany("INSERT OR REPLACE INTO deal_map (zoho_deal_id, hubspot_deal_id, updated_at) VALUES (?, ?, ?)",
+                         [(zoho_deal_id, hubspot_deal_id, updated_at) for zoho_deal_id, hubspot_deal_id in mappings])
+        conn.commit()
+    DEAL_INDEX.update(mappings)
+
+# Run one page of the HubSpot CRM deal search
+def search_hubspot_deals(filters, after=None, sorts=None):
+    payload = {
+        "filterGroups": [{"filters": filters}],
+        "properties": ["zoho_deal_id", "hs_lastmodifieddate"],
+        "limit": 100
+    }
+    if sorts:
+        payload["sorts"] = sorts
+    if after:
+        payload["after"] = after
+    response = api_request("hubspot_search", "POST", HUBSPOT_DEALS_SEARCH_API, idempotent=True, headers=get_hubspot_headers(), json=payload)
+    if response.status_code != 200:
+        raise Exception(f"Deal search failed: {response.status_code} - {response.text}")
+    return response.json()
+
+# Full pass over every HubSpot deal, 100 per page, collecting the zoho_deal_id property
+def scan_all_hubspot_deals():
     params = {
         "properties": "zoho_deal_id",
         "limit": 100,
         "archived": False
     }
-    after = 0
+    mappings = []
+    while True:
+        response = api_request("hubspot", "GET", HUBSPOT_DEALS_API, headers=get_hubspot_headers(), params=params)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch deals: {response.status_code} - {response.text}")
+        data = response.json()
+        for deal in data.get("results", []):
+            zoho_deal_id = deal.get("properties", {}).get("zoho_deal_id")
+            if zoho_deal_id:
+                mappings.append((zoho_deal_id, deal["id"]))
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            return mappings
+        params["after"] = after
+
+# Deals modified since `since_ms`, walked in hs_lastmodifieddate order so the 10k search cap can be stepped over
+def scan_modified_hubspot_deals(since_ms):
+    mappings = []
+    lower_bound = since_ms
+    while True:
+        filters = [
+            {"propertyName": "zoho_deal_id", "operator": "HAS_PROPERTY"},
+            {"propertyName": "hs_lastmodifieddate", "operator": "GTE", "value": str(lower_bound)}
+        ]
+        sorts = [{"propertyName": "hs_lastmodifieddate", "direction": "ASCENDING"}]
+        after = None
+        seen = 0
+        last_modified = None
+        while True:
+            data = search_hubspot_deals(filters, after=after, sorts=sorts)
+            results = data.get("results", [])
+            for deal in results:
+                properties = deal.get("properties", {})
+                if properties.get("zoho_deal_id"):
+                    mappings.append((properties["zoho_deal_id"], deal["id"]))
+                last_modified = properties.get("hs_lastmodifieddate") or last_modified
+            seen += len(results)
+            after = data.get("paging", {}).get("next", {}).get("after")
+            if not after:
+                return mappings
+            if seen + 100 > HUBSPOT_SEARCH_MAX_RESULTS:
+                break
+        # Restart the search from the last modification time we reached
+        next_bound = int(datetime.fromisoformat(last_modified.replace("Z", "+00:00")).timestamp() * 1000)
+        if next_bound <= lower_bound:
+            raise Exception(f"More than {HUBSPOT_SEARCH_MAX_RESULTS} deals share hs_lastmodifieddate {last_modified}")
+        lower_bound = next_bound
+
+# Build or incrementally refresh the zoho_deal_id -> hubspot_deal_id index in migration.db
+def build_deal_index(conn):
+    EVENTS.info("deal_index", "Building HubSpot deal index")
+    DEAL_INDEX.clear()
+    with DB_LOCK:
+        DEAL_INDEX.update(conn.execute("SELECT zoho_deal_id, hubspot_deal_id FROM deal_map").fetchall())
+    synced_at = get_sync_state(conn, "deal_index_synced_at")
+    # Leave a minute of overlap so deals modified mid-pass are picked up next time
+    pass_started_ms = int(time.time() * 1000) - 60000
+    try:
+        if synced_at:
+            mappings = scan_modified_hubspot_deals(int(synced_at))
+        else:
+            mappings = scan_all_hubspot_deals()
+    except Exception as e:
+        EVENTS.error("deal_index_failed", f"❌ Deal index refresh failed, using {len(DEAL_INDEX)} cached mappings: {e}")
+        return DEAL_INDEX
+    store_deal_mappings(conn, mappings)
+    set_sync_state(conn, "deal_index_synced_at", pass_started_ms)
+    EVENTS.info("deal_index_ready", f"✅ Deal index ready: {len(DEAL_INDEX)} deals ({len(mappings)} refreshed)",
+                deals=len(DEAL_INDEX), refreshed=len(mappings))
+    return DEAL_INDEX
+
+# Resolve a HubSpot deal ID from the index, falling back to one targeted search on a miss
+def get_hubspot_deal_id(zoho_deal_id, conn=None):
+    if zoho_deal_id in DEAL_INDEX:
+        return DEAL_INDEX[zoho_deal_id]
+    if time.time() - DEAL_MISSES.get(zoho_deal_id, 0) < DEAL_MISS_TTL:
+        return None
+    EVENTS.debug("deal_lookup", f"Looking up HubSpot Deal ID for Zoho Deal ID: {zoho_deal_id}", deal=zoho_deal_id)
+    filters = [{"propertyName": "zoho_deal_id", "operator": "EQ", "value": zoho_deal_id}]
+    try:
+        results = search_hubspot_deals(filters).get("results", [])
+    except Exception as e:
+        EVENTS.error("deal_lookup_failed", f"❌ Deal lookup failed: {e}", deal=zoho_deal_id)
+        return None
+    if not results:
+        # Remember the miss briefly; the deal may be created in HubSpot later
+        DEAL_MISSES[zoho_deal_id] = time.time()
+        EVENTS.warning("deal_not_found", f"⚠️ No matching HubSpot deal found for Zoho Deal ID: {zoho_deal_id}", deal=zoho_deal_id)
+        return None
+    hubspot_deal_id = results[0]["id"]
+    if conn is not None:
+        store_deal_mappings(conn, [(zoho_deal_id, hubspot_deal_id)])
+    else:
+        DEAL_INDEX[zoho_deal_id] = hubspot_deal_id
+    EVENTS.debug("deal_found", f"✅ Found HubSpot Deal ID: {hubspot_deal_id} for Zoho Deal ID: {zoho_deal_id}",
+                 deal=zoho_deal_id, hubspot_deal=hubspot_deal_id)
+    return hubspot_deal_id
+
+# Every Zoho CRM user as (id, email); deactivated users are included since they can still own deals
+def iter_zoho_users():
+    params = {"type": "AllUsers", "per_page": ZOHO_PAGE_SIZE, "page": 1}
     while True:
-        if after:
-            params["after"] = after
+        response = api_request("zoho", "GET", f"{ZOHO_API_BASE}/users", headers=get_zoho_headers(), params=params)
+        if response.status_code == 204:
+            return
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch Zoho users: {response.status_code} - {response.text}")
+        data = response.json()
+        for user in data.get("users", []):
+            yield user.get("id"), user.get("email")
+        if not data.get("info", {}).get("more_records"):
+            return
+        params["page"] += 1
+
+# Every HubSpot owner as (id, email), 100 per page
+def iter_hubspot_owners():
+    params = {"limit": 100}
+    while True:
+        response = api_request("hubspot", "GET", HUBSPOT_OWNERS_API, headers=get_hubspot_headers(), params=params)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch owners: {response.status_code} - {response.text}")
+        data = response.json()
+        for owner in data.get("results", []):
+            yield owner.get("id"), owner.get("email")
+        after = data.get("paging", {}).get("next", {}).get("after")
+        if not after:
+            return
+        params["after"] = after
+
+# Match every Zoho user to the HubSpot owner with the same email (case-insensitive). The stored map is
+# reused until it is OWNER_MAP_TTL old, so most runs make no owner calls at all. `extract` leaves out
+# the HubSpot side and only refreshes the Zoho users and their emails. `load` leaves out the Zoho side:
+# it matches the stored users, and those the manifests brought in, against HubSpot owners on every run
+def build_owner_map(conn, zoho=True, hubspot=True):
+    EVENTS.info("owner_map", "Building owner map")
+    OWNER_MAP.clear()
+    OWNER_EMAILS.clear()
+    DEAL_OWNERS.clear()
+    with DB_LOCK:
+        stored = conn.execute("SELECT zoho_user_id, email, hubspot_owner_id FROM owner_map").fetchall()
+        DEAL_OWNERS.update(conn.execute("SELECT zoho_deal_id, zoho_user_id FROM deal_owners").fetchall())
+    OWNER_MAP.update((user_id, owner_id) for user_id, email, owner_id in stored)
+    OWNER_EMAILS.update((user_id, email) for user_id, email, owner_id in stored)
+    loaded_at = get_sync_state(conn, "owner_map_loaded_at")
+    if zoho and loaded_at and time.time() - float(loaded_at) < OWNER_MAP_TTL:
+        EVENTS.info("owner_map_ready", f"✅ Owner map ready: {len(OWNER_MAP)} Zoho users (cached)", users=len(OWNER_MAP))
+        return OWNER_MAP
+    try:
+        users = list(iter_zoho_users()) if zoho else list(OWNER_EMAILS.items())
+        if hubspot:
+            owners = {email.lower(): owner_id for owner_id, email in iter_hubspot_owners() if email}
+            rows = [(user_id, email, owners.get(email.lower()) if email else None) for user_id, email in users]
+        else:
+            rows = [(user_id, email, OWNER_MAP.get(user_id)) for user_id, email in users]
+    except Exception as e:
+        EVENTS.error("owner_map_failed", f"❌ Owner map refresh failed, using {len(OWNER_MAP)} cached users: {e}")
+        return OWNER_MAP
+    with DB_LOCK:
+        conn.execute("DELETE FROM owner_map")
+        conn.executemany("INSERT INTO owner_map (zoho_user_id, email, hubspot_owner_id) VALUES (?, ?, ?)", rows)
+        conn.commit()
+    OWNER_MAP.clear()
+    OWNER_MAP.update((user_id, owner_id) for user_id, email, owner_id in rows)
+    OWNER_EMAILS.clear()
+    OWNER_EMAILS.update((user_id, email) for user_id, email, owner_id in rows)
+    if zoho and hubspot:
+        set_sync_state(conn, "owner_map_loaded_at", time.time())
+    if not hubspot:
+        EVENTS.info("owner_map_ready", f"✅ Stored {len(rows)} Zoho users for the archive manifests", users=len(rows))
+        return OWNER_MAP
+    unmatched = [email or user_id for user_id, email, owner_id in rows if not owner_id]
+    EVENTS.info("owner_map_ready", f"✅ Owner map ready: {len(rows) - len(unmatched)} of {len(rows)} Zoho users matched to HubSpot owners",
+                users=len(rows), matched=len(rows) - len(unmatched))
+    if unmatched:
+        EVENTS.warning("owners_unmatched", f"⚠️ No HubSpot owner for {', '.join(unmatched[:10])}{' ...' if len(unmatched) > 10 else ''}; "
+                       f"notes on their deals get DEFAULT_HUBSPOT_OWNER_ID", unmatched=unmatched)
+    return OWNER_MAP
+
+# Owner of a listed deal: a lookup object in the records API, a plain user ID column in Bulk Read
+def deal_owner_id(deal):
+    owner = deal.get("Owner") or deal.get("Owner.id")
+    return owner.get("id") if isinstance(owner, dict) else owner
+
+# Persist zoho_deal_id -> zoho_user_id pairs that are new or changed and mirror them into DEAL_OWNERS
+def store_deal_owners(conn, owners):
+    changed = [(zoho_deal_id, user_id) for zoho_deal_id, user_id in owners if user_id and DEAL_OWNERS.get(zoho_deal_id) != user_id]
+    if not changed:
+        return
+    with DB_LOCK:
+        conn.executemany("INSERT OR REPLACE INTO deal_owners (zoho_deal_id, zoho_user_id) VALUES (?, ?)", changed)
+        conn.commit()
+    DEAL_OWNERS.update(changed)
+
+# Zoho users (id, email) that came with archived deals, for a `load` host that never read Zoho users.
+# A user already stored keeps its row
+def store_archived_users(conn, users):
+    with DB_LOCK:
+        conn.executemany("INSERT OR IGNORE INTO owner_map (zoho_user_id, email) VALUES (?, ?)", users)
+        conn.commit()
+
+# Owners of deals that were never listed (attachments discovered with COQL or Bulk Read, or loaded
+# from an archive), read 100 deals per call
+def fetch_deal_owners(conn, deal_ids):
+    missing = [zoho_deal_id for zoho_deal_id in dict.fromkeys(deal_ids) if zoho_deal_id not in DEAL_OWNERS]
+    if not missing:
+        return
+    EVENTS.info("deal_owners", f"Fetching owners of {len(missing)} deals", deals=len(missing))
+    for start in range(0, len(missing), ZOHO_IDS_PER_REQUEST):
+        params = {"ids": ",".join(missing[start:start + ZOHO_IDS_PER_REQUEST]), "fields": "Owner"}
         try:
-            response = requests.get(url, headers=get_hubspot_headers(), params=params)
-            if response.status_code == 200:
-                data = response.json()
-                results = data.get("results", [])
-                for deal in results:
-                    properties = deal.get("properties", {})
-                    if properties.get("zoho_deal_id") == zoho_deal_id:
-                        print(f"✅ Found HubSpot Deal ID: {deal['id']} for Zoho Deal ID: {zoho_deal_id}")
-                        return deal["id"]
-                after = data.get("paging", {}).get("next", {}).get("after")
-                if not after:
-                    break
-            else:
-                print(f"❌ Failed to fetch deals: {response.status_code} - {response.text}")
-                return None
+            response = api_request("zoho", "GET", f"{ZOHO_API_BASE}/Deals", headers=get_zoho_headers(), params=params)
         except requests.exceptions.RequestException as e:
-            print(f"❌ Request failed: {e}")
-            return None
-    print(f"⚠️ No matching HubSpot deal found for Zoho Deal ID: {zoho_deal_id}")
-    return None
+            EVENTS.error("deal_owners_failed", f"❌ Request failed while fetching deal owners: {e}")
+            return
+        if response.status_code == 204:
+            continue
+        if response.status_code != 200:
+            EVENTS.error("deal_owners_failed", f"❌ Failed to fetch deal owners: {response.status_code}",
+                         status=response.status_code, response=response.text)
+            return
+        store_deal_owners(conn, [(deal.get("id"), deal_owner_id(deal)) for deal in response.json().get("data", [])])
 
-# Create note with attachment and associate with HubSpot deal
-def create_note_with_attachment(hs_attachment_id, hubspot_deal_id, zoho_deal_id):
-    print(f"--------------------------------Creating note with attachment ID: {hs_attachment_id}--------------------------------")
-    timestamp_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+# HubSpot owner for notes on a deal, resolved from the cached maps without an API call
+def hubspot_owner_for_deal(zoho_deal_id):
+    return OWNER_MAP.get(DEAL_OWNERS.get(zoho_deal_id)) or DEFAULT_HUBSPOT_OWNER_ID
+
+# Note body: the Zoho deal reference, then the document type and summary of each tagged file
+def build_note_body(zoho_deal_id, tags=()):
     note_body = f"Zoho Deal ID: {zoho_deal_id}"
-    payload = {
-        "properties": {
-            "hs_timestamp": timestamp_ms,
-            "hs_note_body": note_body,
-            "hubspot_owner_id": "671151283",
-            "hs_attachment_ids": hs_attachment_id
-        },
+    for file_name, document_type, summary in tags:
+        note_body += f"<br><br><strong>{html.escape(file_name)}</strong> ({html.escape(document_type)})<br>{html.escape(summary)}"
+    return note_body
+
+# Build the note properties and deal association; hs_attachment_ids may hold several IDs joined with ";"
+def build_note_payload(hs_attachment_ids, hubspot_deal_id, zoho_deal_id):
+    timestamp_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    note_body = build_note_body(zoho_deal_id)
+    properties = {
+        "hs_timestamp": timestamp_ms,
+        "hs_note_body": note_body,
+        "hubspot_owner_id": hubspot_owner_for_deal(zoho_deal_id),
+        "hs_attachment_ids": hs_attachment_ids
+    }
+    if not properties["hubspot_owner_id"]:
+        del properties["hubspot_owner_id"]
+    return {
+        "properties": properties,
         "associations": [
             {
                 "to": {"id": hubspot_deal_id},
@@ -435,23 +2536,1218 @@ def create_note_with_attachment(hs_attachment_id, hubspot_deal_id, zoho_deal_id)
             }
         ]
     }
+
+# Create note with attachment and associate with HubSpot deal
+def create_note_with_attachment(hs_attachment_id, hubspot_deal_id, zoho_deal_id):
+    EVENTS.debug("note", f"Creating note with attachment ID: {hs_attachment_id}", hubspot_file=hs_attachment_id)
+    payload = build_note_payload(hs_attachment_id, hubspot_deal_id, zoho_deal_id)
     try:
-        response = requests.post(HUBSPOT_NOTES_API, headers=get_hubspot_headers(), json=payload)
+        response = api_request("hubspot", "POST", HUBSPOT_NOTES_API, headers=get_hubspot_headers(), json=payload)
         if response.status_code == 201:
             note_data = response.json()
             note_id = note_data.get("id")
-            print(f"✅ Created note (Note ID: {note_id}) for Deal ID: {hubspot_deal_id}")
+            EVENTS.debug("noted", f"✅ Created note (Note ID: {note_id}) for Deal ID: {hubspot_deal_id}", note=note_id)
             return note_id
         else:
-            print(f"❌ Failed: {response.status_code} - {response.text}")
+            EVENTS.error("note_failed", f"❌ Note for HubSpot file {hs_attachment_id} failed: {response.status_code}",
+                         status=response.status_code, response=response.text)
             return None
     except requests.exceptions.RequestException as e:
-        print(f"❌ Request failed: {e}")
+        EVENTS.error("note_failed", f"❌ Note for HubSpot file {hs_attachment_id} failed: {e}")
+        return None
+
+# Create up to 100 notes in one call. `notes` is a list of (trace_id, payload); returns {trace_id: note_id}
+# for the notes HubSpot created. Results are matched back through objectWriteTraceId, not position
+def create_notes_batch(notes):
+    EVENTS.debug("note_batch", f"Creating {len(notes)} notes in one batch", notes=len(notes))
+    inputs = [dict(payload, objectWriteTraceId=trace_id) for trace_id, payload in notes]
+    try:
+        response = api_request("hubspot", "POST", HUBSPOT_NOTES_BATCH_API, headers=get_hubspot_headers(), json={"inputs": inputs})
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("note_batch_failed", f"❌ Batch of {len(notes)} notes failed: {e}")
+        return {}
+    if response.status_code not in (200, 201, 207):
+        EVENTS.error("note_batch_failed", f"❌ Batch of {len(notes)} notes failed: {response.status_code}",
+                     status=response.status_code, response=response.text)
+        return {}
+    data = response.json()
+    results = data.get("results", [])
+    if results and all("objectWriteTraceId" in result for result in results):
+        created = {result["objectWriteTraceId"]: result["id"] for result in results}
+    elif len(results) == len(notes) and not data.get("errors"):
+        created = {trace_id: result["id"] for (trace_id, _), result in zip(notes, results)}
+    else:
+        EVENTS.error("note_batch_failed", "❌ Could not match batch results to notes", response=response.text)
+        return {}
+    for error in data.get("errors", []):
+        EVENTS.error("note_batch_error", f"❌ Note batch error: {error.get('message')}", response=json.dumps(error))
+    EVENTS.debug("notes_created", f"✅ Created {len(created)} of {len(notes)} notes", created=len(created), notes=len(notes))
+    return created
+
+# Collects uploaded attachments per deal and emits one note per deal through batch/create.
+# A deal's note is ready once all its listed attachments arrived or NOTE_MAX_ATTACHMENTS is reached;
+# ready notes go out NOTE_BATCH_SIZE at a time, and anything older than NOTE_FLUSH_SECONDS is flushed
+class NoteBatcher:
+    def __init__(self, conn, max_attachments=NOTE_MAX_ATTACHMENTS, batch_size=NOTE_BATCH_SIZE, flush_seconds=NOTE_FLUSH_SECONDS):
+        self.conn = conn
+        self.max_attachments = max_attachments
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.pending = {}  # zoho_deal_id -> (first added time, [items])
+        self.ready = []  # Lists of items, one list per note
+        self.last_flush = time.time()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self.flush_on_timeout, name="note-batcher", daemon=True)
+        self.timer.start()
+
+    def add(self, item):
+        zoho_deal_id = item["zoho_deal_id"]
+        with self.lock:
+            added_at, items = self.pending.setdefault(zoho_deal_id, (time.time(), []))
+            items.append(item)
+            if len(items) >= self.max_attachments or len(items) == item.get("deal_attachment_count"):
+                self.ready.append(items)
+                del self.pending[zoho_deal_id]
+            batch = self.take_ready(self.batch_size)
+        if batch:
+            self.create_notes(batch)
+
+    # Pop up to `limit` ready notes once a full batch is waiting (limit=None takes everything)
+    def take_ready(self, limit):
+        if limit is not None and len(self.ready) < limit:
+            return []
+        batch = self.ready[:limit] if limit else self.ready[:]
+        del self.ready[:len(batch)]
+        self.last_flush = time.time()
+        return batch
+
+    def flush_on_timeout(self):
+        while not self.stopped.wait(1):
+            with self.lock:
+                now = time.time()
+                for zoho_deal_id, (added_at, items) in list(self.pending.items()):
+                    if now - added_at >= self.flush_seconds:
+                        self.ready.append(items)
+                        del self.pending[zoho_deal_id]
+                if not self.ready or now - self.last_flush < self.flush_seconds:
+                    continue
+                batch = self.take_ready(None)
+            self.create_notes(batch)
+
+    # Emit everything still held, complete or not
+    def flush(self):
+        with self.lock:
+            for added_at, items in self.pending.values():
+                self.ready.append(items)
+            self.pending.clear()
+            batch = self.take_ready(None)
+        self.create_notes(batch)
+
+    # Called once the note stage has drained
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+
+    # Runs on whichever thread filled the batch, so records are keyed by the notes' own deals, not its item
+    @EVENTS.context(deal=None, attachment=None)
+    def create_notes(self, groups):
+        notes = []
+        by_trace = {}
+        for items in groups:
+            zoho_deal_id = items[0]["zoho_deal_id"]
+            with METRICS.timed("deal_lookup"), EVENTS.context(deal=zoho_deal_id):
+                hubspot_deal_id = get_hubspot_deal_id(zoho_deal_id, self.conn)
+            if not hubspot_deal_id:
+                for item in items:
+                    schedule_retry(self.conn, item, "note", "no matching HubSpot deal")
+                continue
+            # Deduplicated files can repeat an ID within a deal; a note lists each file once
+            hs_attachment_ids = ";".join(dict.fromkeys(item["hs_attachment_id"] for item in items))
+            trace_id = f"{zoho_deal_id}-{uuid.uuid4().hex[:8]}"
+            notes.append((trace_id, build_note_payload(hs_attachment_ids, hubspot_deal_id, zoho_deal_id)))
+            by_trace[trace_id] = (hubspot_deal_id, items)
+        for start in range(0, len(notes), self.batch_size):
+            chunk = notes[start:start + self.batch_size]
+            with METRICS.timed("note"):
+                created = create_notes_batch(chunk)
+            rows = []
+            for trace_id, note_id in created.items():
+                hubspot_deal_id, items = by_trace[trace_id]
+                rows.extend((item["hs_attachment_id"], hubspot_deal_id, note_id, "noted", item["zoho_deal_id"], item["zoho_attachment_id"])
+                            for item in items)
+                for item in items:
+                    EVENTS.debug("noted", f"✅ Noted {item['file_name']} (Note ID: {note_id})",
+                                 deal=item["zoho_deal_id"], attachment=item["zoho_attachment_id"], note=note_id)
+            with DB_LOCK:
+                self.conn.executemany("UPDATE attachments SET hubspot_attachment_id = ?, hubspot_deal_id = ?, hubspot_note_id = ?, status = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                      rows)
+                self.conn.executemany("DELETE FROM retry_queue WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                                      [row[4:] for row in rows])
+                self.conn.commit()
+            METRICS.inc("migration_items_completed_total", len(rows))
+            for trace_id, payload in chunk:
+                if trace_id not in created:
+                    for item in by_trace[trace_id][1]:
+                        schedule_retry(self.conn, item, "note", "batch note creation failed")
+
+TEXT_EXTENSIONS = {".txt", ".csv", ".tsv", ".md", ".json", ".xml", ".html", ".htm", ".log", ".eml"}
+# Office Open XML files are zip archives; these members hold their text
+OFFICE_TEXT_MEMBERS = {".docx": r"word/document\.xml", ".xlsx": r"xl/sharedStrings\.xml", ".pptx": r"ppt/slides/slide\d+\.xml"}
+IMAGE_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".gif": "image/gif", ".webp": "image/webp"}
+
+# Message content for one file: the text of text and Office files, the file itself for PDFs and
+# images, None for anything else. `read(n)` returns the file's first n bytes, or all of them for None
+def extract_document(file_name, size, read):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in TEXT_EXTENSIONS:
+        text = read(AI_TEXT_CHARS * 4).decode("utf-8", errors="replace")[:AI_TEXT_CHARS]
+        return {"type": "text", "text": text} if text.strip() else None
+    if size > AI_DOCUMENT_MAX_BYTES:
         return None
+    if extension in OFFICE_TEXT_MEMBERS:
+        try:
+            with zipfile.ZipFile(io.BytesIO(read())) as bundle:
+                parts = [bundle.read(name).decode("utf-8", errors="replace") for name in sorted(bundle.namelist())
+                         if re.fullmatch(OFFICE_TEXT_MEMBERS[extension], name)]
+        except zipfile.BadZipFile:
+            return None
+        text = re.sub(r"\s+", " ", re.sub(r"<[^>]+>", " ", " ".join(parts))).strip()[:AI_TEXT_CHARS]
+        return {"type": "text", "text": text} if text else None
+    if extension == ".pdf":
+        return {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": base64.b64encode(read()).decode()}}
+    if extension in IMAGE_TYPES:
+        return {"type": "image", "source": {"type": "base64", "media_type": IMAGE_TYPES[extension], "data": base64.b64encode(read()).decode()}}
+    return None
+
+# One Message Batches request; the content hash is the custom_id, so results map straight to ai_tags
+def tagging_request(sha256, file_name, content):
+    prompt = (f"File name: {file_name}\nThis file is attached to a deal in our CRM. Reply with JSON only: "
+              f'{{"document_type": one of {", ".join(AI_DOCUMENT_TYPES)}, "summary": what the file is about in at most two sentences}}')
+    return {
+        "custom_id": sha256,
+        "params": {
+            "model": AI_TAGGING_MODEL,
+            "max_tokens": AI_MAX_TOKENS,
+            "messages": [{"role": "user", "content": [content, {"type": "text", "text": prompt}]}]
+        }
+    }
+
+# (document_type, summary) from a model reply; a reply that is not the requested JSON becomes the summary
+def parse_tagging_reply(text):
+    match = re.search(r"\{.*\}", text, re.S)
+    try:
+        reply = json.loads(match.group(0)) if match else {}
+    except ValueError:
+        reply = {}
+    document_type = reply.get("document_type") if reply.get("document_type") in AI_DOCUMENT_TYPES else "Other"
+    return document_type, str(reply.get("summary") or text).strip()[:500]
+
+# ANTHROPIC_API_KEY (and ANTHROPIC_BASE_URL, e.g. for the bench.py stand-in) are read by the SDK.
+# The package is only needed with AI_TAGGING=1
+def get_anthropic_client():
+    try:
+        import anthropic
+    except ImportError:
+        raise Exception("AI tagging needs the anthropic package: pip install anthropic")
+    return anthropic.Anthropic(max_retries=API_MAX_RETRIES)
+
+# Rows are (sha256, status, batch_id, document_type, summary)
+def store_tags(conn, rows):
+    if not rows:
+        return
+    updated_at = datetime.now(timezone.utc).isoformat()
+    with DB_LOCK:
+        conn.executemany("INSERT OR REPLACE INTO ai_tags (sha256, status, batch_id, document_type, summary, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(*row, updated_at) for row in rows])
+        conn.commit()
+
+# Collects files from the upload stage and sends them as Message Batches of AI_BATCH_SIZE files (or
+# AI_BATCH_MAX_BYTES), so the pipeline never waits on a model. Content that already has a tag, or is
+# on its way to one, is never sent again
+class DocumentTagger:
+    def __init__(self, conn, client=None):
+        self.conn = conn
+        self.client = client or get_anthropic_client()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        with DB_LOCK:
+            self.known = {row[0] for row in conn.execute("SELECT sha256 FROM ai_tags").fetchall()}
+
+    def add(self, sha256, file_name, size, read):
+        with self.lock:
+            if not sha256 or sha256 in self.known:
+                return
+            self.known.add(sha256)
+        try:
+            content = extract_document(file_name, size, read)
+        except OSError as e:
+            EVENTS.warning("tagging_unreadable", f"⚠️ Could not read {file_name} for tagging: {e}", sha256=sha256)
+            content = None
+        if content is None:
+            store_tags(self.conn, [(sha256, "skipped", None, None, None)])
+            return
+        request = tagging_request(sha256, file_name, content)
+        with self.lock:
+            self.pending.append(request)
+            self.pending_bytes += len(content.get("text") or content["source"]["data"])
+            if len(self.pending) < AI_BATCH_SIZE and self.pending_bytes < AI_BATCH_MAX_BYTES:
+                return
+            batch_requests, self.pending, self.pending_bytes = self.pending, [], 0
+        self.submit(batch_requests)
+
+    def submit(self, batch_requests):
+        if not batch_requests:
+            return
+        try:
+            with METRICS.timed("ai_batch"):
+                batch = self.client.messages.batches.create(requests=batch_requests)
+        except Exception as e:
+            EVENTS.error("ai_batch_failed", f"❌ Message batch of {len(batch_requests)} files could not be created: {e}")
+            store_tags(self.conn, [(request["custom_id"], "failed", None, None, None) for request in batch_requests])
+            return
+        with DB_LOCK:
+            self.conn.execute("INSERT OR REPLACE INTO ai_batches (batch_id, status, request_count, created_at) VALUES (?, ?, ?, ?)",
+                              (batch.id, "submitted", len(batch_requests), datetime.now(timezone.utc).isoformat()))
+            self.conn.commit()
+        store_tags(self.conn, [(request["custom_id"], "submitted", batch.id, None, None) for request in batch_requests])
+        METRICS.inc("migration_ai_requests_total", len(batch_requests))
+        EVENTS.info("ai_batch_submitted", f"🏷️ Submitted message batch {batch.id} with {len(batch_requests)} files",
+                    batch=batch.id, files=len(batch_requests))
+
+    # Send whatever is still pending; called once the upload stage has drained
+    def close(self):
+        with self.lock:
+            batch_requests, self.pending, self.pending_bytes = self.pending, [], 0
+        self.submit(batch_requests)
+
+# Read every finished Message Batch into ai_tags. Results are streamed line by line, so no batch is
+# held in memory whole. Unfinished batches are polled for up to `wait` seconds; returns how many remain
+def collect_tagging_results(conn, client, wait=0):
+    deadline = time.time() + wait
+    while True:
+        with DB_LOCK:
+            batch_ids = [row[0] for row in conn.execute("SELECT batch_id FROM ai_batches WHERE status != 'ended'").fetchall()]
+        processing = 0
+        for batch_id in batch_ids:
+            try:
+                if client.messages.batches.retrieve(batch_id).processing_status != "ended":
+                    processing += 1
+                    continue
+                rows, tagged = [], 0
+                for result in client.messages.batches.results(batch_id):
+                    if result.result.type == "succeeded":
+                        text = "".join(block.text for block in result.result.message.content if block.type == "text")
+                        rows.append((result.custom_id, "tagged", batch_id, *parse_tagging_reply(text)))
+                        tagged += 1
+                    else:
+                        rows.append((result.custom_id, "failed", batch_id, None, None))
+                    if len(rows) >= 1000:
+                        store_tags(conn, rows)
+                        rows = []
+                store_tags(conn, rows)
+            except Exception as e:
+                EVENTS.error("ai_batch_failed", f"❌ Could not read message batch {batch_id}: {e}", batch=batch_id)
+                processing += 1
+                continue
+            with DB_LOCK:
+                # A request the batch returned nothing for will not get a result any more
+                conn.execute("UPDATE ai_tags SET status = 'failed' WHERE batch_id = ? AND status = 'submitted'", (batch_id,))
+                conn.execute("UPDATE ai_batches SET status = 'ended' WHERE batch_id = ?", (batch_id,))
+                conn.commit()
+            EVENTS.info("ai_batch_ended", f"✅ Message batch {batch_id} ended: {tagged} files tagged", batch=batch_id, tagged=tagged)
+        if not processing or time.time() >= deadline:
+            return processing
+        EVENTS.info("ai_batch_wait", f"Waiting for {processing} message batches", batches=processing)
+        time.sleep(AI_POLL_INTERVAL)
+
+# Update up to 100 note bodies in one call; returns the IDs HubSpot updated
+def update_notes_batch(inputs):
+    try:
+        response = api_request("hubspot", "POST", HUBSPOT_NOTES_BATCH_UPDATE_API, idempotent=True, headers=get_hubspot_headers(), json={"inputs": inputs})
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("note_update_failed", f"❌ Update of {len(inputs)} notes failed: {e}")
+        return []
+    if response.status_code not in (200, 207):
+        EVENTS.error("note_update_failed", f"❌ Update of {len(inputs)} notes failed: {response.status_code}",
+                     status=response.status_code, response=response.text)
+        return []
+    data = response.json()
+    for error in data.get("errors", []):
+        EVENTS.error("note_update_error", f"❌ Note update error: {error.get('message')}", response=json.dumps(error))
+    return [result["id"] for result in data.get("results", [])]
+
+# Give every note whose files all have a result its tags, HUBSPOT_BATCH_READ_SIZE notes per
+# batch/update call. Each note is patched once; files without a tag (skipped or failed) are left out.
+# Call it once no tagger has files left to submit: a file with no ai_tags row then never reached one
+# (resumed at the note stage, or noted before AI_TAGGING was on) and counts as skipped. `accept` limits
+# the patch to some deals, e.g. a worker's own, whose tagging it knows has finished
+def patch_tagged_notes(conn, accept=None):
+    with DB_LOCK:
+        rows = conn.execute("SELECT a.hubspot_note_id, a.zoho_deal_id, a.file_name, t.status, t.document_type, t.summary "
+                            "FROM attachments a LEFT JOIN ai_tags t ON t.sha256 = a.sha256 "
+                            "WHERE a.status = 'noted' AND a.hubspot_note_id IS NOT NULL "
+                            "AND a.hubspot_note_id NOT IN (SELECT hubspot_note_id FROM tagged_notes) ORDER BY a.rowid").fetchall()
+    notes = {}
+    for hubspot_note_id, zoho_deal_id, file_name, status, document_type, summary in rows:
+        if accept and not accept(zoho_deal_id):
+            continue
+        notes.setdefault(hubspot_note_id, (zoho_deal_id, []))[1].append((file_name, status, document_type, summary))
+    inputs, untagged, waiting = [], [], 0
+    for hubspot_note_id, (zoho_deal_id, files) in notes.items():
+        if any(status == "submitted" for file_name, status, document_type, summary in files):
+            waiting += 1
+            continue
+        tags = [(file_name, document_type, summary) for file_name, status, document_type, summary in files if status == "tagged"]
+        if tags:
+            inputs.append({"id": hubspot_note_id, "properties": {"hs_note_body": build_note_body(zoho_deal_id, tags)}})
+        else:
+            untagged.append(hubspot_note_id)
+    patched = list(untagged)
+    for start in range(0, len(inputs), HUBSPOT_BATCH_READ_SIZE):
+        with METRICS.timed("note"):
+            patched += update_notes_batch(inputs[start:start + HUBSPOT_BATCH_READ_SIZE])
+    patched_at = datetime.now(timezone.utc).isoformat()
+    with DB_LOCK:
+        conn.executemany("INSERT OR IGNORE INTO tagged_notes (hubspot_note_id, patched_at) VALUES (?, ?)",
+                         [(hubspot_note_id, patched_at) for hubspot_note_id in patched])
+        conn.commit()
+    EVENTS.info("notes_tagged", f"✅ Added tags to {len(patched) - len(untagged)} of {len(inputs)} notes"
+                + (f"; {waiting} notes still wait for files being tagged" if waiting else ""),
+                tagged=len(patched) - len(untagged), notes=len(inputs), waiting=waiting)
+
+# After a run, or as `python index.py tag`: collect the finished batches (waiting up to `wait`
+# seconds for the rest), then patch the notes
+def finish_tagging(conn, wait=AI_WAIT_SECONDS, accept=None):
+    EVENTS.info("ai_tags", "Collecting AI tags")
+    processing = collect_tagging_results(conn, get_anthropic_client(), wait)
+    patch_tagged_notes(conn, accept)
+    if processing:
+        EVENTS.warning("ai_batches_pending", f"⚠️ {processing} message batches are still processing; run `python index.py tag` later to add their tags",
+                       batches=processing)
+
+# Existing notes among `note_ids` with their hs_attachment_ids, read HUBSPOT_BATCH_READ_SIZE at a time.
+# Notes that no longer exist are simply absent; None when HubSpot could not be asked
+def batch_read_notes(note_ids):
+    try:
+        response = api_request("hubspot", "POST", HUBSPOT_NOTES_BATCH_READ_API, idempotent=True, headers=get_hubspot_headers(),
+                               json={"properties": ["hs_attachment_ids"], "inputs": [{"id": note_id} for note_id in note_ids]})
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("reconcile_read_failed", f"❌ Request failed while reading notes: {e}")
+        return None
+    if response.status_code not in (200, 207):
+        EVENTS.error("reconcile_read_failed", f"❌ Failed to read notes: {response.status_code}", status=response.status_code, response=response.text)
+        return None
+    return {str(result["id"]): set(filter(None, str(result.get("properties", {}).get("hs_attachment_ids") or "").split(";")))
+            for result in response.json().get("results", [])}
+
+# HubSpot deal IDs each note is associated with; None when HubSpot could not be asked
+def batch_read_note_deals(note_ids):
+    try:
+        response = api_request("hubspot", "POST", HUBSPOT_NOTE_DEALS_BATCH_READ_API, idempotent=True, headers=get_hubspot_headers(),
+                               json={"inputs": [{"id": note_id} for note_id in note_ids]})
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("reconcile_read_failed", f"❌ Request failed while reading note associations: {e}")
+        return None
+    if response.status_code not in (200, 207):
+        EVENTS.error("reconcile_read_failed", f"❌ Failed to read note associations: {response.status_code}",
+                     status=response.status_code, response=response.text)
+        return None
+    return {str(result["from"]["id"]): {str(to["toObjectId"]) for to in result.get("to", [])}
+            for result in response.json().get("results", [])}
+
+# The IDs among `file_ids` that exist in HubSpot Files. The Files API has no batch/read, but its
+# search takes a list of IDs, which costs the same one call per 100 files
+def find_hubspot_files(file_ids):
+    try:
+        response = api_request("hubspot", "GET", HUBSPOT_FILES_SEARCH_API, headers=get_hubspot_headers(),
+                               params={"ids": list(file_ids), "limit": len(file_ids)})
+    except requests.exceptions.RequestException as e:
+        EVENTS.error("reconcile_read_failed", f"❌ Request failed while searching files: {e}")
+        return None
+    if response.status_code != 200:
+        EVENTS.error("reconcile_read_failed", f"❌ Failed to search files: {response.status_code}", status=response.status_code, response=response.text)
+        return None
+    return {str(result["id"]) for result in response.json().get("results", [])}
+
+# Run `read` over `ids` in HubSpot batch-sized slices and merge the results; None if any slice failed
+def batch_read(read, ids):
+    ids = sorted(ids)
+    merged = {}
+    for start in range(0, len(ids), HUBSPOT_BATCH_READ_SIZE):
+        result = read(ids[start:start + HUBSPOT_BATCH_READ_SIZE])
+        if result is None:
+            return None
+        merged.update(dict.fromkeys(result, True) if isinstance(result, set) else result)
+    return merged
+
+# Issues for one chunk of state store rows: attachments that did not finish, and noted ones whose
+# note, deal association or file is not in HubSpot as recorded
+def reconcile_chunk(rows):
+    issues, unchecked = [], 0
+    noted = [row for row in rows if row[3] == "noted"]
+    for zoho_deal_id, zoho_attachment_id, file_name, status, hs_attachment_id, hubspot_deal_id, hubspot_note_id in rows:
+        if status != "noted":
+            issues.append((zoho_deal_id, zoho_attachment_id, "not_migrated", "download" if status == "failed" else "resume", f"status {status}"))
+    note_ids = {row[6] for row in noted if row[6]}
+    file_ids = {row[4] for row in noted if row[4]}
+    notes = batch_read(batch_read_notes, note_ids)
+    note_deals = batch_read(batch_read_note_deals, note_ids)
+    files = batch_read(find_hubspot_files, file_ids)
+    for zoho_deal_id, zoho_attachment_id, file_name, status, hs_attachment_id, hubspot_deal_id, hubspot_note_id in noted:
+        if notes is None or note_deals is None or files is None:
+            unchecked += 1
+        elif hs_attachment_id not in files:
+            issues.append((zoho_deal_id, zoho_attachment_id, "file_missing", "upload", f"HubSpot file {hs_attachment_id}"))
+        elif hubspot_note_id not in notes:
+            issues.append((zoho_deal_id, zoho_attachment_id, "note_missing", "note", f"HubSpot note {hubspot_note_id}"))
+        elif hs_attachment_id not in notes[hubspot_note_id]:
+            issues.append((zoho_deal_id, zoho_attachment_id, "attachment_not_on_note", "note", f"file {hs_attachment_id} not on note {hubspot_note_id}"))
+        elif hubspot_deal_id not in note_deals.get(hubspot_note_id, set()):
+            issues.append((zoho_deal_id, zoho_attachment_id, "note_not_on_deal", "note", f"note {hubspot_note_id} not associated with deal {hubspot_deal_id}"))
+    return issues, unchecked
+
+def store_reconcile_issues(conn, issues):
+    found_at = datetime.now(timezone.utc).isoformat()
+    with DB_LOCK:
+        conn.executemany("INSERT OR REPLACE INTO reconcile_issues (zoho_deal_id, zoho_attachment_id, issue, action, detail, found_at) VALUES (?, ?, ?, ?, ?, ?)",
+                         [issue + (found_at,) for issue in issues])
+        conn.commit()
+
+# Check the migration against HubSpot and Zoho and replace the reconcile_issues table with what
+# does not match. The state store is walked RECONCILE_CHUNK_SIZE rows at a time and HubSpot is read
+# 100 IDs per call; Zoho's attachments are listed in a few paged calls and compared per deal
+def reconcile(conn):
+    EVENTS.info("reconcile", "Reconciling the migration with HubSpot and Zoho")
+    with DB_LOCK:
+        conn.execute("DELETE FROM reconcile_issues")
+        conn.commit()
+    ZOHO_LISTING_INCOMPLETE.clear()
+    zoho = {}
+    for row in iter_zoho_deal_attachments():
+        zoho.setdefault(attachment_parent_id(row), set()).add(row.get("id"))
+    zoho_complete = not ZOHO_LISTING_INCOMPLETE.is_set()
+    if not zoho_complete:
+        EVENTS.warning("reconcile_zoho_incomplete", "⚠️ The Zoho attachment listing failed; Zoho counts are not compared")
+    counts, checked, unchecked, last_rowid = {}, 0, 0, 0
+    state = {}  # zoho_deal_id -> {zoho_attachment_id: status}
+    while True:
+        with DB_LOCK:
+            rows = conn.execute("SELECT rowid, zoho_deal_id, zoho_attachment_id, file_name, status, hubspot_attachment_id, hubspot_deal_id, hubspot_note_id "
+                                "FROM attachments WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, RECONCILE_CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        issues, skipped = reconcile_chunk([row[1:] for row in rows])
+        store_reconcile_issues(conn, issues)
+        for issue in issues:
+            counts[issue[2]] = counts.get(issue[2], 0) + 1
+        for row in rows:
+            state.setdefault(row[1], {})[row[2]] = row[4]
+        checked += len(rows)
+        unchecked += skipped
+        EVENTS.info("reconcile_progress", f"Checked {checked} attachments, {sum(counts.values())} issues so far",
+                    checked=checked, issues=sum(counts.values()))
+    if zoho_complete:
+        issues = []
+        for zoho_deal_id in set(zoho) | set(state):
+            in_zoho, in_state = zoho.get(zoho_deal_id, set()), state.get(zoho_deal_id, {})
+            issues.extend((zoho_deal_id, zoho_attachment_id, "missing_in_state", "download", "in Zoho, never listed")
+                          for zoho_attachment_id in in_zoho - set(in_state))
+            noted = sum(1 for status in in_state.values() if status == "noted")
+            if noted != len(in_zoho):
+                issues.append((zoho_deal_id, "", "count_mismatch", "", f"{len(in_zoho)} attachments in Zoho, {noted} noted"))
+        store_reconcile_issues(conn, issues)
+        for issue in issues:
+            counts[issue[2]] = counts.get(issue[2], 0) + 1
+    for issue, count in sorted(counts.items()):
+        EVENTS.warning("reconcile_issues", f"⚠️ {issue}: {count}", issue=issue, count=count)
+    if unchecked:
+        EVENTS.warning("reconcile_unchecked", f"⚠️ {unchecked} noted attachments could not be checked in HubSpot; run reconcile again",
+                       unchecked=unchecked)
+    if not counts and not unchecked:
+        EVENTS.info("reconciled", f"✅ All {checked} attachments reconciled", checked=checked)
+    else:
+        EVENTS.info("reconcile_done", "Issues are in the reconcile_issues table; `python index.py --reconciled` re-runs just those deals")
+    return counts
+
+# Reset the attachments behind the stored issues to the stage each must redo, clear the issues, and
+# return the affected deals for a targeted re-run. Deals are listed again, which also picks up
+# attachments that were never listed
+def apply_reconcile_issues(conn):
+    with conn.transaction() as db:
+        issues = db.execute("SELECT zoho_deal_id, zoho_attachment_id, action FROM reconcile_issues WHERE action != ''").fetchall()
+        for zoho_deal_id, zoho_attachment_id, action in issues:
+            key = (zoho_deal_id, zoho_attachment_id)
+            if action == "note":
+                db.execute("UPDATE attachments SET status = 'uploaded', hubspot_note_id = NULL "
+                           "WHERE zoho_deal_id = ? AND zoho_attachment_id = ? AND hubspot_attachment_id IS NOT NULL", key)
+            elif action in ("upload", "download"):
+                # The HubSpot file is gone, so deduplication must not hand out its ID again
+                db.execute("DELETE FROM content_hashes WHERE hubspot_file_id IN (SELECT hubspot_attachment_id FROM attachments "
+                           "WHERE zoho_deal_id = ? AND zoho_attachment_id = ?)", key)
+                db.execute("UPDATE attachments SET status = 'listed', hubspot_attachment_id = NULL, hubspot_note_id = NULL "
+                           "WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", key)
+            db.execute("DELETE FROM retry_queue WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", key)
+        db.execute("DELETE FROM reconcile_issues")
+    deals = sorted({zoho_deal_id for zoho_deal_id, _, _ in issues})
+    EVENTS.info("reconcile_rerun", f"Re-running {len(deals)} deals with {len(issues)} reconcile issues", deals=len(deals), issues=len(issues))
+    return [{"id": zoho_deal_id} for zoho_deal_id in deals]
+
+# Bounded queue that hands out the largest waiting file first (longest job first), so big transfers
+# start early instead of stretching the tail of the run. The None shutdown marker sorts last
+class LargestFirstQueue(queue.PriorityQueue):
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.counter = itertools.count()
+
+    def _put(self, item):
+        key = float("inf") if item is None else -(item.get("size") or 0)
+        heapq.heappush(self.queue, (key, next(self.counter), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+# Throughput measured by the last run that moved enough bytes, else the ESTIMATE_* settings
+def load_throughput(conn):
+    measured = get_sync_state(conn, "throughput")
+    if measured:
+        return json.loads(measured)
+    return {"bytes_per_second": ESTIMATE_BYTES_PER_SECOND, "stream_bytes_per_second": ESTIMATE_STREAM_BYTES_PER_SECOND}
+
+def record_throughput(conn):
+    moved = sum(METRICS.total("migration_bytes_total", direction=direction) for direction in ("upload", "transfer", "archive"))
+    streamed = METRICS.total("migration_bytes_total", direction="download") + METRICS.total("migration_bytes_total", direction="transfer")
+    stream_seconds = METRICS.stage_seconds("download") + METRICS.stage_seconds("transfer")
+    if moved < ESTIMATE_MIN_BYTES or not stream_seconds:
+        return
+    set_sync_state(conn, "throughput", json.dumps({"bytes_per_second": moved / (time.time() - METRICS.started),
+                                                   "stream_bytes_per_second": streamed / stream_seconds}))
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+# Print the plan for a work list known before any transfer starts: files and bytes per lane and an
+# estimated run time. The estimate is the slowest of: all bytes at the measured throughput, every
+# file's API calls at the configured request rates, the large lane's bytes over its workers, and
+# the largest single file on one connection
+def print_plan(conn, deals, mode="migrate"):
+    done = ("uploaded", "archived") if mode == "extract" else ("uploaded",)
+    sizes = [attachment_size(attachment) or 0 for deal in deals for attachment in deal.get("attachments", [])
+             if attachment.get("status") not in done]
+    if not sizes:
+        EVENTS.info("plan", "📋 Nothing to transfer", files=0)
+        return
+    large = [size for size in sizes if size >= LARGE_FILE_THRESHOLD]
+    throughput = load_throughput(conn)
+    estimate = max(sum(sizes) / throughput["bytes_per_second"],
+                   len(sizes) / min(ZOHO_REQUESTS_PER_SECOND, HUBSPOT_REQUESTS_PER_SECOND),
+                   sum(large) / (max(LARGE_UPLOAD_WORKERS if mode == "load" else LARGE_DOWNLOAD_WORKERS, 1) * throughput["stream_bytes_per_second"]),
+                   max(sizes) / throughput["stream_bytes_per_second"])
+    EVENTS.info("plan", f"📋 Plan: {len(sizes)} files, {sum(sizes) / 1048576:.1f} MB | large lane {len(large)} files, {sum(large) / 1048576:.1f} MB | "
+                f"largest {max(sizes) / 1048576:.1f} MB | estimated {format_duration(estimate)} at {throughput['bytes_per_second'] / 1048576:.1f} MB/s",
+                files=len(sizes), bytes=sum(sizes), large_files=len(large), estimate_seconds=round(estimate))
+
+# Multi-stage migration engine: list -> download -> upload -> note, one worker pool per stage,
+# connected by bounded queues so a slow stage applies back-pressure instead of buffering everything.
+# Download and upload each have a second lane for large files, and both lanes serve the largest
+# waiting file first
+class MigrationPipeline:
+    STAGES = ("list", "download", "download_large", "upload", "upload_large", "note")
+
+    def __init__(self, conn, list_workers=LIST_WORKERS, download_workers=DOWNLOAD_WORKERS,
+                 upload_workers=UPLOAD_WORKERS, note_workers=NOTE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE,
+                 large_download_workers=LARGE_DOWNLOAD_WORKERS, large_upload_workers=LARGE_UPLOAD_WORKERS,
+                 shard=0, shards=1, modified_since=None, mode="migrate", archived=None):
+        self.conn = conn
+        # "migrate", or one phase of the two-phase mode: "extract" (Zoho -> archives) or "load" (archives -> HubSpot)
+        self.mode = mode
+        self.archived = archived or {}  # Load: manifest entries by (deal, attachment)
+        self.shard = shard
+        self.shards = shards
+        self.modified_since = modified_since  # Delta runs list only attachments added after this
+        # Each shard process keeps its own counters, so each writes its own file
+        self.metrics_file = f"{METRICS_FILE}.{shard}" if METRICS_FILE and shards > 1 else METRICS_FILE
+        self.reclaimed = set()  # Deals outside our shard taken over from expired leases
+        self.adopted = set()  # Whole shards taken over from workers that died
+        self.worker_counts = {
+            "list": list_workers,
+            "download": download_workers,
+            "download_large": large_download_workers,
+            "upload": upload_workers,
+            "upload_large": large_upload_workers,
+            "note": note_workers
+        }
+        self.queues = {stage: LargestFirstQueue(maxsize=queue_size) if stage.startswith(("download", "upload")) else queue.Queue(maxsize=queue_size)
+                       for stage in self.STAGES}
+        self.handlers = {
+            "list": self.list_deal,
+            "download": self.download,
+            "download_large": self.download,
+            "upload": self.upload,
+            "upload_large": self.upload,
+            "note": self.note
+        }
+        self.archive_writer = None
+        self.archive_reader = ArchiveReader() if mode == "load" else None
+        if mode == "extract":
+            # One writer appends to the archive; the upload stage's place is taken by it
+            self.archive_writer = ArchiveWriter("zoho" if shards == 1 else f"zoho-{shard}")
+            self.handlers["upload"] = self.handlers["upload_large"] = self.archive
+            self.worker_counts["upload"] = 1
+            self.worker_counts["upload_large"] = 0
+        self.done = threading.Event()
+        self.note_batcher = NoteBatcher(conn) if NOTE_BATCHING else None
+        self.staging = StagingCache(conn)
+        self.folders = HubSpotFolders(conn, HUBSPOT_FOLDER_ID) if mode != "extract" else None
+        self.tagger = DocumentTagger(conn) if AI_TAGGING and mode != "extract" else None
+        self.uploads_in_flight = {}  # sha256 -> Event set when that content's upload finishes
+        self.uploads_lock = threading.Lock()
+
+    def queue_depths(self):
+        return {stage: q.qsize() for stage, q in self.queues.items()}
+
+    # relist returns the run's deals again, so shards taken over from dead workers can be worked through
+    def run(self, deals, relist=None):
+        threads = {}
+        for stage in self.STAGES:
+            threads[stage] = [threading.Thread(target=self.worker, args=(stage,), name=f"{stage}-{i}", daemon=True)
+                              for i in range(self.worker_counts[stage])]
+            for t in threads[stage]:
+                t.start()
+        monitor = threading.Thread(target=self.report_status, name="pipeline-status", daemon=True)
+        monitor.start()
+        if self.shards > 1:
+            take_shard_lease(self.conn, self.shard, self.shards)
+            heartbeat = threading.Thread(target=self.renew_leases_periodically, name="lease-heartbeat", daemon=True)
+            heartbeat.start()
+        reset_in_flight_retries(self.conn, self.owns)
+        for deal in deals:
+            if self.shards == 1 or deal_shard(deal.get("id"), self.shards) == self.shard:
+                self.queues["list"].put(deal)
+        self.drain_retries()
+        if self.shards > 1:
+            self.take_over_dead_workers(relist)
+        # Shut stages down in order: a stage only stops once everything upstream has drained into it
+        for stage in self.STAGES:
+            for _ in threads[stage]:
+                self.queues[stage].put(None)
+            for t in threads[stage]:
+                t.join()
+        if self.note_batcher:
+            self.note_batcher.close()
+        if self.tagger:
+            self.tagger.close()
+            finish_tagging(self.conn, accept=self.owns)
+        if self.archive_writer:
+            self.archive_writer.close()
+        if self.archive_reader:
+            self.archive_reader.close()
+        self.done.set()
+        EVENTS.info("progress", METRICS.progress(self.queue_depths()), final=True)
+        METRICS.write(self.metrics_file)
+        record_throughput(self.conn)
+        if self.shards > 1:
+            release_leases(self.conn)
+        if DEDUP_STATS["files"]:
+            EVENTS.info("deduplicated", f"♻️ Deduplicated {DEDUP_STATS['files']} files: saved {DEDUP_STATS['bytes'] / 1048576:.1f} MB "
+                        f"and {DEDUP_STATS['calls']} upload calls", **DEDUP_STATS)
+
+    def worker(self, stage):
+        q = self.queues[stage]
+        handler = self.handlers[stage]
+        while True:
+            item = q.get()
+            if item is None:
+                q.task_done()
+                return
+            try:
+                with EVENTS.context(**item_keys(item)):
+                    handler(item)
+            except Exception as e:
+                EVENTS.exception("stage_failed", f"❌ {stage} stage failed for {item.get('file_name') or item.get('id')}: {e}", e,
+                                 stage=stage, **item_keys(item))
+                if stage != "list":
+                    schedule_retry(self.conn, item, stage, str(e))
+                else:
+                    ZOHO_LISTING_INCOMPLETE.set()
+            q.task_done()
+
+    # Once the stages are idle, feed back retries that come due within RETRY_WAIT_SECONDS;
+    # later ones stay in the retry queue for the next run
+    def drain_retries(self):
+        while True:
+            for stage in self.STAGES:
+                self.queues[stage].join()
+            if self.note_batcher:
+                self.note_batcher.flush()
+            due = next_retry_at(self.conn, self.owns)
+            if due is None or due - time.time() > RETRY_WAIT_SECONDS:
+                return
+            time.sleep(max(0, due - time.time()))
+            for item in take_due_retries(self.conn, time.time(), self.owns):
+                self.dispatch(item)
+
+    def owns(self, zoho_deal_id):
+        if self.shards == 1 or zoho_deal_id in self.reclaimed:
+            return True
+        shard = deal_shard(zoho_deal_id, self.shards)
+        return shard == self.shard or shard in self.adopted
+
+    def renew_leases_periodically(self):
+        while not self.done.wait(LEASE_SECONDS / 3):
+            renew_leases(self.conn)
+
+    # Once our own shard is done, stay until every other worker has finished. A worker that stops renewing
+    # its leases has died: take over its whole shard, including the deals it never started, and any deal
+    # lease it left behind
+    def take_over_dead_workers(self, relist):
+        while True:
+            others = other_shard_leases(self.conn, self.shards)
+            for shard, expired in others:
+                if not expired or shard in self.adopted or not claim_deal_lease(self.conn, shard_lease_key(shard, self.shards)):
+                    continue
+                EVENTS.warning("shard_adopted", f"🔓 Taking over shard {shard + 1} of {self.shards} from a worker that stopped", shard=shard)
+                self.adopted.add(shard)
+                reset_in_flight_retries(self.conn, lambda zoho_deal_id, shard=shard: deal_shard(zoho_deal_id, self.shards) == shard)
+                for deal in relist() if relist else []:
+                    if deal_shard(deal.get("id"), self.shards) == shard:
+                        self.queues["list"].put(deal)
+            self.reclaim_expired_leases()
+            self.drain_retries()
+            release_shard_leases(self.conn)
+            if not any(not expired for _, expired in other_shard_leases(self.conn, self.shards)):
+                return
+            time.sleep(LEASE_POLL_SECONDS)
+
+    # Pick up deals whose worker died: its leases stopped being renewed and have expired. Load
+    # rebuilds the deal from the manifests, so the list stage does not ask Zoho for its attachments
+    def reclaim_expired_leases(self):
+        for zoho_deal_id in expired_leases(self.conn):
+            if zoho_deal_id in self.reclaimed or (self.adopted and deal_shard(zoho_deal_id, self.shards) in self.adopted):
+                continue
+            deal = {"id": zoho_deal_id}
+            if self.mode == "load":
+                deal = next(iter_archived_deals({key: entry for key, entry in self.archived.items() if key[0] == zoho_deal_id}), None)
+                if deal is None:
+                    continue
+            EVENTS.warning("lease_reclaimed", f"🔓 Reclaiming deal {zoho_deal_id} from an expired lease", deal=zoho_deal_id)
+            self.reclaimed.add(zoho_deal_id)
+            self.queues["list"].put(deal)
+
+    # Large files go to their stage's large lane, unless that lane has no workers
+    def enqueue(self, stage, item):
+        lane = f"{stage}_large"
+        if (item.get("size") or 0) >= LARGE_FILE_THRESHOLD and self.worker_counts.get(lane):
+            stage = lane
+        self.queues[stage].put(item)
+
+    # Send an item to the stage after the last one it completed: this is what lets a rerun or a
+    # retry resume exactly where the item stopped
+    def dispatch(self, item):
+        status = item.get("status")
+        key = (item["zoho_deal_id"], item["zoho_attachment_id"])
+        if status == "uploaded" and item.get("hs_attachment_id"):
+            self.queues["note"].put(item)
+        elif self.mode == "load":
+            if key not in self.archived:
+                EVENTS.warning("not_archived", f"⚠️ {item['file_name']} is not in the archives. Skipping.", **item_keys(item))
+                return
+            item["archive"] = self.archived[key]
+            item["sha256"] = item.get("sha256") or item["archive"].get("sha256")
+            item["size"] = item["archive"]["size"]
+            self.enqueue("upload", item)
+        elif status == "downloaded" and item.get("file_path") and os.path.exists(item["file_path"]):
+            self.enqueue("upload", item)
+        else:
+            self.enqueue("download", item)
+
+    def report_status(self):
+        while not self.done.wait(PIPELINE_STATUS_INTERVAL):
+            METRICS.set_gauge("migration_staging_bytes", self.staging.used)
+            EVENTS.info("progress", METRICS.progress(self.queue_depths()))
+            METRICS.write(self.metrics_file)
+
+    def set_state(self, item, status, **columns):
+        assignments = "".join(f", {column} = ?" for column in columns)
+        with DB_LOCK:
+            self.conn.execute(f"UPDATE attachments SET status = ?{assignments} WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
+                              (status, *columns.values(), item["zoho_deal_id"], item["zoho_attachment_id"]))
+            self.conn.commit()
+        item["status"] = status
+
+    def list_deal(self, deal):
+        zoho_deal_id = deal.get("id")
+        deal_name = deal.get("Deal_Name", "Unknown Deal")
+        EVENTS.debug("list_deal", f"Processing Deal: {deal_name} (Zoho ID: {zoho_deal_id})")
+        if self.shards > 1 and not claim_deal_lease(self.conn, zoho_deal_id):
+            EVENTS.debug("deal_leased", f"🔒 Deal {zoho_deal_id} is leased by another worker. Skipping.")
+            return
+        # A deal reclaimed from a dead worker may have older attachments still in flight
+        modified_since = None if zoho_deal_id in self.reclaimed else self.modified_since
+        attachments = deal.get("attachments")
+        if attachments is None:
+            with METRICS.timed("list"):
+                attachments = get_zoho_attachments(zoho_deal_id, modified_since)
+        if attachments is None:
+            ZOHO_LISTING_INCOMPLETE.set()
+            return
+        if not attachments:
+            return
+        store_deal_owners(self.conn, [(zoho_deal_id, deal_owner_id(deal))])
+        created_date = datetime.now(timezone.utc).isoformat()
+        with DB_LOCK:
+            self.conn.executemany("INSERT OR IGNORE INTO attachments (zoho_deal_id, zoho_attachment_id, file_name, size, created_time, status, created_date) "
+                                  "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  [(zoho_deal_id, attachment.get("id"), attachment.get("File_Name", f"attachment_{attachment.get('id')}"),
+                                    attachment_size(attachment), attachment.get("Created_Time"), "listed", created_date)
+                                   for attachment in attachments])
+            rows = self.conn.execute("SELECT a.zoho_attachment_id, a.file_name, a.status, a.file_path, a.hubspot_attachment_id, a.size, a.sha256, a.created_time, r.attempts "
+                                     "FROM attachments a LEFT JOIN retry_queue r ON r.zoho_deal_id = a.zoho_deal_id AND r.zoho_attachment_id = a.zoho_attachment_id "
+                                     "WHERE a.zoho_deal_id = ?", (zoho_deal_id,)).fetchall()
+            self.conn.commit()
+        listed = {attachment.get("id") for attachment in attachments}
+        items = []
+        for zoho_attachment_id, file_name, status, file_path, hs_attachment_id, size, sha256, created_time, retry_attempts in rows:
+            if zoho_attachment_id not in listed:
+                continue
+            if status in ("noted", "failed"):
+                EVENTS.debug("skipped", f"✅ Already processed: {file_name}. Skipping.", attachment=zoho_attachment_id, status=status)
+                continue
+            if status == "archived" and self.mode == "extract":
+                EVENTS.debug("skipped", f"✅ Already archived: {file_name}. Skipping.", attachment=zoho_attachment_id, status=status)
+                continue
+            if retry_attempts is not None:
+                EVENTS.debug("skipped", f"🔁 Waiting in retry queue: {file_name}. Skipping.", attachment=zoho_attachment_id, status="retry")
+                continue
+            items.append({
+                "zoho_deal_id": zoho_deal_id,
+                "zoho_attachment_id": zoho_attachment_id,
+                "file_name": file_name,
+                "status": status,
+                "file_path": file_path,
+                "hs_attachment_id": hs_attachment_id,
+                "size": size,
+                "sha256": sha256,
+                "created_time": created_time
+            })
+        METRICS.inc("migration_items_listed_total", len(items))
+        # Lets the note batcher emit a deal's note as soon as its last attachment is uploaded
+        for item in items:
+            item["deal_attachment_count"] = len(items)
+            self.dispatch(item)
+
+    def download(self, item):
+        # In streaming mode a size seen before may be duplicate content, so stage it on disk
+        # where it can be hashed before deciding whether to upload
+        # Files big enough for parallel ranges are staged too: a dropped transfer then resumes instead of restarting
+        if STREAMING_TRANSFER and self.mode == "migrate" and not (DEDUPLICATE_UPLOADS and known_content_size(self.conn, item.get("size"))) \
+                and (item.get("size") or 0) < PARALLEL_RANGE_THRESHOLD:
+            return self.transfer(item)
+        self.stage(item)
+
+    # Download into the staging cache, which reserves the room first and pins the file until it is
+    # uploaded, then queue the upload
+    def stage(self, item):
+        if not self.staging.reserve(item):
+            return schedule_retry(self.conn, item, "download", "staging cache full")
+        with METRICS.timed("download"):
+            file_path, sha256 = download_zoho_attachment(item["zoho_deal_id"], item["zoho_attachment_id"], item["file_name"],
+                                                         self.conn, item.get("size"))
+        if not file_path:
+            return schedule_retry(self.conn, item, "download", "download failed")
+        self.staging.downloaded(item, file_path)
+        METRICS.inc("migration_bytes_total", os.path.getsize(file_path), direction="download")
+        item["sha256"] = sha256
+        self.set_state(item, "downloaded", file_path=file_path, sha256=item["sha256"])
+        item["file_path"] = file_path
+        EVENTS.debug("stored", f"✅ Stored in database: {item['file_name']}")
+        # The real size decides the upload lane; a listing may not have reported one
+        item["size"] = os.path.getsize(file_path)
+        self.enqueue("upload", item)
+
+    # Streaming mode: download and upload happen in one step and the upload stage is bypassed
+    def transfer(self, item):
+        folder_id = self.folders.folder_for(item)
+        if not folder_id:
+            return schedule_retry(self.conn, item, "download", "HubSpot folder unavailable")
+        capture = bytearray() if self.tagger else None
+        with METRICS.timed("transfer"):
+            hs_attachment_id, sha256, stage = stream_attachment_to_hubspot(item["zoho_deal_id"], item["zoho_attachment_id"], item["file_name"],
+                                                                           folder_id, capture)
+        if stage:
+            return self.stage(item)
+        if not hs_attachment_id:
+            return schedule_retry(self.conn, item, "download", "transfer failed")
+        METRICS.inc("migration_bytes_total", item.get("size") or 0, direction="transfer")
+        if DEDUPLICATE_UPLOADS:
+            record_uploaded_content(self.conn, sha256, hs_attachment_id, item.get("size"))
+        self.set_state(item, "uploaded", hubspot_attachment_id=hs_attachment_id, sha256=sha256)
+        if self.tagger:
+            self.tagger.add(sha256, item["file_name"], len(capture), lambda n=None: bytes(capture[:n]))
+        item["hs_attachment_id"] = hs_attachment_id
+        self.queues["note"].put(item)
+
+    def upload(self, item):
+        archived = item.get("archive")
+        size = archived["size"] if archived else os.path.getsize(item["file_path"])
+        sha256 = item.get("sha256") if DEDUPLICATE_UPLOADS else None
+        hs_attachment_id = self.reuse_uploaded_content(sha256) if sha256 else None
+        if hs_attachment_id:
+            count_deduplicated(size)
+            EVENTS.debug("deduplicated", f"♻️ Duplicate content, reusing HubSpot file {hs_attachment_id}: {item['file_name']}",
+                         hubspot_file=hs_attachment_id)
+        else:
+            try:
+                folder_id = self.folders.folder_for(item)
+                if folder_id:
+                    with METRICS.timed("upload"):
+                        if archived:
+                            hs_attachment_id = upload_archive_member(self.archive_reader, archived, item["file_name"], folder_id)
+                        else:
+                            hs_attachment_id = upload_to_hubspot(item["file_path"], item["file_name"], folder_id)
+                if hs_attachment_id:
+                    METRICS.inc("migration_bytes_total", size, direction="upload")
+                if hs_attachment_id and sha256:
+                    record_uploaded_content(self.conn, sha256, hs_attachment_id, size)
+            finally:
+                if sha256:
+                    self.finish_content_upload(sha256)
+            if not hs_attachment_id:
+                return schedule_retry(self.conn, item, "upload", "upload failed")
+        # Keep the file ID so a failed note can be retried without uploading again
+        self.set_state(item, "uploaded", hubspot_attachment_id=hs_attachment_id)
+        if self.tagger:
+            self.tag(item)
+        self.staging.release(item)
+        item["hs_attachment_id"] = hs_attachment_id
+        self.queues["note"].put(item)
+
+    # Hand the file to the tagger while it is still staged (or, in load mode, mapped)
+    def tag(self, item):
+        archived = item.get("archive")
+        if archived:
+            member = self.archive_reader.view(archived["archive"])[archived["offset"]:archived["offset"] + archived["size"]]
+            self.tagger.add(item.get("sha256"), item["file_name"], archived["size"], lambda n=None: bytes(member[:n]))
+            return
+        def read(n=None):
+            with open(item["file_path"], "rb") as f:
+                return f.read(-1 if n is None else n)
+        self.tagger.add(item.get("sha256"), item["file_name"], os.path.getsize(item["file_path"]), read)
+
+    # Extract mode: the staged download goes into the archive instead of to HubSpot
+    def archive(self, item):
+        if (item["zoho_deal_id"], item["zoho_attachment_id"]) not in self.archive_writer.archived:
+            with METRICS.timed("archive"):
+                self.archive_writer.append(item, item["file_path"])
+            METRICS.inc("migration_bytes_total", os.path.getsize(item["file_path"]), direction="archive")
+        self.set_state(item, "archived")
+        self.staging.discard(item)
+        METRICS.inc("migration_items_completed_total")
+        EVENTS.debug("archived", f"✅ Archived: {item['file_name']}")
+
+    # Return the HubSpot file ID if this content is already uploaded. Otherwise the caller becomes
+    # the one uploader for it: identical files arriving meanwhile wait instead of uploading again
+    def reuse_uploaded_content(self, sha256):
+        while True:
+            hubspot_file_id = find_uploaded_content(self.conn, sha256)
+            if hubspot_file_id:
+                return hubspot_file_id
+            with self.uploads_lock:
+                in_flight = self.uploads_in_flight.get(sha256)
+                if in_flight is None:
+                    self.uploads_in_flight[sha256] = threading.Event()
+                    return None
+            in_flight.wait()
+
+    def finish_content_upload(self, sha256):
+        with self.uploads_lock:
+            self.uploads_in_flight.pop(sha256).set()
+
+    def note(self, item):
+        if self.note_batcher:
+            return self.note_batcher.add(item)
+        zoho_deal_id = item["zoho_deal_id"]
+        with METRICS.timed("deal_lookup"):
+            hubspot_deal_id = get_hubspot_deal_id(zoho_deal_id, self.conn)
+        if not hubspot_deal_id:
+            return schedule_retry(self.conn, item, "note", "no matching HubSpot deal")
+        with METRICS.timed("note"):
+            hubspot_note_id = create_note_with_attachment(item["hs_attachment_id"], hubspot_deal_id, zoho_deal_id)
+        if not hubspot_note_id:
+            return schedule_retry(self.conn, item, "note", "note creation failed")
+        with DB_LOCK:
+            self.conn.execute("DELETE FROM retry_queue WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", (zoho_deal_id, item["zoho_attachment_id"]))
+            self.set_state(item, "noted", hubspot_deal_id=hubspot_deal_id, hubspot_note_id=hubspot_note_id)
+        METRICS.inc("migration_items_completed_total")
+        EVENTS.debug("noted", f"✅ Updated database with status 'noted' for {item['file_name']}", note=hubspot_note_id)
 
 # Process migration for all Zoho deals
-def migrate_attachments():
-    print("Starting authorization flows...")
+def migrate_attachments(headless=None, shard=0, shards=1, delta=None, command="migrate", reconciled=False):
+    if headless is None:
+        headless = HEADLESS
+    if delta is None:
+        delta = DELTA_SYNC
+    if headless:
+        headless_auth(hubspot=command != "extract", zoho=command != "load")
+    else:
+        interactive_auth()
+
+    # Extracting only talks to Zoho, so it runs on a host without HubSpot credentials
+    if not HUBSPOT_FOLDER_ID and command != "extract":
+        EVENTS.error("no_folder", "❌ HubSpot folder ID not found. Please complete the OAuth flow and select a folder.")
+        return
+
+    # Workers sharing the database commit every write so they never hold its write lock for long;
+    # WAL with synchronous=NORMAL keeps those commits cheap
+    conn = init_db(commit_every=1 if shards > 1 else STATE_COMMIT_EVERY)
+    if command == "reconcile":
+        reconcile(conn)
+        conn.close()
+        return
+    if command == "tag":
+        finish_tagging(conn)
+        conn.close()
+        return
+    if reconciled:
+        build_deal_index(conn)
+        build_owner_map(conn)
+        deals = apply_reconcile_issues(conn)
+        fetch_deal_owners(conn, [deal["id"] for deal in deals])
+        MigrationPipeline(conn).run(deals)
+        conn.close()
+        return
+    if command == "load":
+        entries = load_archive_manifests()
+        if not entries:
+            EVENTS.warning("no_archives", f"⚠️ No archived attachments in {ARCHIVE_FOLDER}. Run `python index.py extract` first.")
+            conn.close()
+            return
+        build_deal_index(conn)
+        # Deal owners and their emails come from the manifests; only HubSpot owners are read
+        store_archived_users(conn, {(entry["owner"], entry.get("owner_email")) for entry in entries.values() if entry.get("owner")})
+        build_owner_map(conn, zoho=False)
+        EVENTS.info("load", f"Loading {len(entries)} archived attachments from {ARCHIVE_FOLDER}", attachments=len(entries))
+        deals = list(iter_archived_deals(entries))
+        own_deals = [deal for deal in deals if shards == 1 or deal_shard(deal["id"], shards) == shard]
+        print_plan(conn, own_deals, "load")
+        MigrationPipeline(conn, shard=shard, shards=shards, mode="load", archived=entries).run(deals, relist=lambda: deals)
+        conn.close()
+        return
+    if command != "extract":
+        build_deal_index(conn)
+    # Extract records each deal owner's email in the manifest, for a load host that cannot ask Zoho
+    build_owner_map(conn, hubspot=command != "extract")
+    if ZOHO_ATTACHMENT_SOURCE != "deals":
+        # Only deals that actually have files are visited; the list stage makes no API calls
+        if ZOHO_ATTACHMENT_SOURCE != "stored":
+            discover_attachments(conn, delta)
+        if shards > 1:
+            EVENTS.info("shard", f"Worker {WORKER_ID} running shard {shard + 1} of {shards}", worker=WORKER_ID, shard=shard)
+        deals = load_work_list(conn)
+        own_deals = [deal for deal in deals if shards == 1 or deal_shard(deal["id"], shards) == shard]
+        # These deals were never listed, so their owners are read in a few batched calls
+        fetch_deal_owners(conn, [deal["id"] for deal in own_deals])
+        print_plan(conn, own_deals, command)
+        MigrationPipeline(conn, shard=shard, shards=shards, mode=command).run(deals, relist=lambda: load_work_list(conn))
+        conn.close()
+        return
+    # Every clean pass records the newest Modified_Time it saw; a delta run asks Zoho only for
+    # deals, and attachments of those deals, changed after that mark
+    mark_key = delta_mark_key(shard, shards)
+    modified_since = get_sync_state(conn, mark_key) if delta else None
+    if delta and not modified_since:
+        EVENTS.info("delta_sync", "No delta high-water mark yet, running a full pass")
+    elif modified_since:
+        EVENTS.info("delta_sync", f"Delta sync: deals changed since {modified_since}", modified_since=modified_since)
+    # Deals are listed as the run goes, so the only sizes known up front are those of attachments
+    # earlier runs listed and did not finish
+    stored = [deal for deal in load_work_list(conn) if shards == 1 or deal_shard(deal["id"], shards) == shard]
+    if stored:
+        EVENTS.info("plan", "📋 Estimate for the attachments earlier runs listed; attachments found while listing deals come on top")
+        print_plan(conn, stored, command)
+    else:
+        EVENTS.info("plan", "📋 Sizes become known as deals are listed, so there is no up-front plan; "
+                    "ZOHO_ATTACHMENT_SOURCE=coql or bulk lists everything first and estimates the run")
+    ZOHO_LISTING_INCOMPLETE.clear()
+    mark = {"latest": modified_since}
+    deals = track_high_water_mark(get_zoho_deals(modified_since), mark)
+    if shards > 1:
+        EVENTS.info("shard", f"Worker {WORKER_ID} running shard {shard + 1} of {shards}", worker=WORKER_ID, shard=shard)
+    MigrationPipeline(conn, shard=shard, shards=shards, modified_since=modified_since, mode=command).run(
+        deals, relist=lambda: get_zoho_deals(modified_since))
+    if ZOHO_LISTING_INCOMPLETE.is_set():
+        EVENTS.warning("delta_mark_kept", "⚠️ Some deal or attachment listings failed; the delta high-water mark stays where it was")
+    elif mark["latest"] and mark["latest"] != modified_since:
+        set_sync_state(conn, mark_key, mark["latest"])
+        EVENTS.info("delta_mark", f"✅ Next delta run starts from deals changed after {mark['latest']}", modified_since=mark["latest"])
+    conn.close()
+
+# Run `workers` processes on this machine, one per shard. Authorization, the first deal index build
+# and the owner map happen once here; the workers start headless from the stored tokens
+def run_workers(workers, headless=None, delta=None, command="migrate"):
+    if headless is None:
+        headless = HEADLESS
+    if delta is None:
+        delta = DELTA_SYNC
+    if headless:
+        headless_auth(hubspot=command != "extract", zoho=command != "load")
+    else:
+        interactive_auth()
+    conn = init_db()
+    if command != "extract":
+        build_deal_index(conn)
+    # Extract and load workers each build the half of the owner map their side of the API allows
+    if command not in ("extract", "load"):
+        build_owner_map(conn)
+    # Discover once here; the workers then share the stored work list
+    if command != "load" and ZOHO_ATTACHMENT_SOURCE not in ("deals", "stored"):
+        discover_attachments(conn, delta)
+    conn.close()
+    # Split the request budget so the workers together stay within the API limits
+    env = dict(os.environ, RATE_LIMIT_SHARE=str(RATE_LIMIT_SHARE / workers))
+    if ZOHO_ATTACHMENT_SOURCE != "deals":
+        env["ZOHO_ATTACHMENT_SOURCE"] = "stored"
+    delta_args = ["--delta"] if delta else []
+    def start(shards):
+        return {shard: subprocess.Popen([sys.executable, os.path.abspath(__file__), command, "--headless", "--shard", str(shard), "--shards", str(workers)] + delta_args, env=env)
+                for shard in shards}
+    failed = [shard for shard, process in start(range(workers)).items() if process.wait() != 0]
+    # A worker that died before taking its shard lease was never taken over, so run every failed shard
+    # once more. Deals the other workers already finished are skipped
+    if failed:
+        EVENTS.warning("shards_rerun", f"🔁 Worker shards {failed} exited with errors, running them again", shards=failed)
+        failed = [shard for shard, process in start(failed).items() if process.wait() != 0]
+    if failed:
+        raise Exception(f"Worker shards {failed} exited with errors twice; rerun to retry them")
+
+# Unattended startup: reuse the stored refresh tokens and folder choice, refresh silently, and
+# fail fast when something can only be fixed by running the browser flow once. With hubspot=False
+# (extract) only the Zoho token is needed, with zoho=False (load) only the HubSpot one
+def headless_auth(hubspot=True, zoho=True):
+    global HEADLESS
+    HEADLESS = True
+    EVENTS.info("authorization", "Starting headless: using stored tokens and folder configuration")
+    services = []
+    if zoho:
+        services.append(("Zoho", TOKEN_FILE, ZOHO_TOKENS))
+    if hubspot:
+        services.append(("HubSpot", HUBSPOT_TOKEN_FILE, HUBSPOT_TOKENS))
+    for service, token_file, tokens in services:
+        tokens.read_token_file()
+        if not tokens.refresh_token:
+            raise Exception(f"No {service} refresh token in {token_file}. Run `python index.py` interactively once to authorize.")
+        if not tokens.get():
+            raise Exception(f"Could not refresh the {service} access token from {token_file}.")
+    if not load_folder_config() and hubspot:
+        raise Exception(f"No HubSpot folder ID in {FOLDER_CONFIG_FILE}. Run `python index.py` interactively once to select a folder.")
+
+# Browser OAuth for Zoho then HubSpot, followed by the HubSpot folder selection form
+def interactive_auth():
+    EVENTS.info("authorization", "Starting authorization flows...")
     global AUTH_CODE, HUBSPOT_FOLDER_ID, CURRENT_SERVICE
     AUTH_CODE = None
     HUBSPOT_FOLDER_ID = None
@@ -460,12 +3756,12 @@ def migrate_attachments():
     with socketserver.TCPServer(("", 8000), OAuthHandler) as httpd:
         # Start Zoho authorization
         auth_url = f"{ZOHO_AUTH_URL}?scope={ZOHO_SCOPE}&client_id={ZOHO_CLIENT_ID}&response_type=code&access_type=offline&redirect_uri={REDIRECT_URI}"
-        print(f"Opening browser for Zoho authorization: {auth_url}")
+        EVENTS.info("authorization", f"Opening browser for Zoho authorization: {auth_url}", service="zoho")
         webbrowser.open(auth_url)
         while not AUTH_CODE or CURRENT_SERVICE != "hubspot":
             httpd.handle_request()
             if AUTH_CODE and CURRENT_SERVICE == "zoho":
-                print("Zoho authorization completed. Proceeding to HubSpot...")
+                EVENTS.info("authorization", "Zoho authorization completed. Proceeding to HubSpot...", service="zoho")
                 payload = {
                     "code": AUTH_CODE,
                     "client_id": ZOHO_CLIENT_ID,
@@ -474,7 +3770,7 @@ def migrate_attachments():
                     "grant_type": "authorization_code"
                 }
                 try:
-                    response = requests.post(ZOHO_TOKEN_URL, data=payload)
+                    response = api_request("zoho", "POST", ZOHO_TOKEN_URL, data=payload)
                     if response.status_code == 200:
                         data = response.json()
                         access_token = data.get("access_token")
@@ -487,7 +3783,8 @@ def migrate_attachments():
                         }
                         with open(TOKEN_FILE, 'w') as f:
                             json.dump(tokens, f)
-                        print("✅ New Zoho tokens saved")
+                        ZOHO_TOKENS.reset()
+                        EVENTS.info("tokens_saved", "✅ New Zoho tokens saved", service="zoho")
                     else:
                         raise Exception(f"Failed to get Zoho tokens: {response.status_code} - {response.text}")
                 except requests.exceptions.RequestException as e:
@@ -496,12 +3793,12 @@ def migrate_attachments():
         # Start HubSpot authorization
         CURRENT_SERVICE = "hubspot"
         auth_url = f"{HUBSPOT_AUTH_URL}?client_id={HUBSPOT_CLIENT_ID}&scope={HUBSPOT_SCOPE}&redirect_uri={REDIRECT_URI}&response_type=code"
-        print(f"Opening browser for HubSpot authorization: {auth_url}")
+        EVENTS.info("authorization", f"Opening browser for HubSpot authorization: {auth_url}", service="hubspot")
         webbrowser.open(auth_url)
         while not HUBSPOT_FOLDER_ID:
             httpd.handle_request()
             if AUTH_CODE and not HUBSPOT_FOLDER_ID:
-                print("Waiting for folder ID submission...")
+                EVENTS.info("authorization", "Waiting for folder ID submission...", service="hubspot")
 
         # Save HubSpot token
         payload = {
@@ -512,7 +3809,7 @@ def migrate_attachments():
             "code": AUTH_CODE
         }
         try:
-            response = requests.post(HUBSPOT_TOKEN_URL, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
+            response = api_request("hubspot", "POST", HUBSPOT_TOKEN_URL, data=payload, headers={"Content-Type": "application/x-www-form-urlencoded"})
             if response.status_code == 200:
                 data = response.json()
                 access_token = data.get("access_token")
@@ -525,51 +3822,42 @@ def migrate_attachments():
                 }
                 with open(HUBSPOT_TOKEN_FILE, 'w') as f:
                     json.dump(tokens, f)
-                print("✅ New HubSpot tokens saved")
+                HUBSPOT_TOKENS.reset()
+                EVENTS.info("tokens_saved", "✅ New HubSpot tokens saved", service="hubspot")
             else:
                 raise Exception(f"Failed to get HubSpot tokens: {response.status_code} - {response.text}")
         except requests.exceptions.RequestException as e:
             raise Exception(f"Request failed: {e}")
 
-    if not HUBSPOT_FOLDER_ID:
-        print("HubSpot folder ID not found. Please complete the OAuth flow and select a folder.")
-        return
-
-    conn = init_db()
-    c = conn.cursor()
-    deals = get_zoho_deals()
-    for deal in deals:
-        zoho_deal_id = deal.get("id")
-        deal_name = deal.get("Deal_Name", "Unknown Deal")
-        print(f"\nProcessing Deal: {deal_name} (Zoho ID: {zoho_deal_id})")
-        attachments = get_zoho_attachments(zoho_deal_id)
-        if attachments:
-            for attachment in attachments:
-                zoho_attachment_id = attachment.get("id")
-                file_name = attachment.get("File_Name", f"attachment_{zoho_attachment_id}")
-                c.execute("SELECT hubspot_attachment_id FROM attachments WHERE zoho_deal_id = ? AND zoho_attachment_id = ?", (zoho_deal_id, zoho_attachment_id))
-                if c.fetchone():
-                    print(f"✅ Already processed: {file_name}. Skipping.")
-                    continue
-                file_path = download_zoho_attachment(zoho_deal_id, zoho_attachment_id, file_name)
-                if file_path:
-                    created_date = datetime.now(timezone.utc).isoformat()
-                    c.execute("INSERT INTO attachments (zoho_deal_id, zoho_attachment_id, file_name, file_path, status, created_date) VALUES (?, ?, ?, ?, ?, ?)",
-                              (zoho_deal_id, zoho_attachment_id, file_name, file_path, "downloaded", created_date))
-                    conn.commit()
-                    print(f"✅ Stored in database: {file_name}")
-                    hs_attachment_id = upload_to_hubspot(file_path)
-                    if hs_attachment_id:
-                        hubspot_deal_id = get_hubspot_deal_id(zoho_deal_id)
-                        if hubspot_deal_id:
-                            hubspot_note_id = create_note_with_attachment(hs_attachment_id, hubspot_deal_id, zoho_deal_id)
-                            if hubspot_note_id:
-                                c.execute("UPDATE attachments SET hubspot_attachment_id = ?, hubspot_deal_id = ?, hubspot_note_id = ?, status = ? WHERE zoho_deal_id = ? AND zoho_attachment_id = ?",
-                                          (hs_attachment_id, hubspot_deal_id, hubspot_note_id, "uploaded", zoho_deal_id, zoho_attachment_id))
-                                conn.commit()
-                                print(f"✅ Updated database with status 'uploaded' for {file_name}")
-                        os.remove(file_path)
-    conn.close()
-
 if __name__ == "__main__":
-    migrate_attachments()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Migrate Zoho CRM deal attachments to HubSpot notes")
+    parser.add_argument("command", nargs="?", default="migrate", choices=("migrate", "extract", "load", "reconcile", "tag"),
+                        help="migrate in one pass (default), or in two phases: extract Zoho attachments into archives, then load them "
+                             "into HubSpot; reconcile checks the result against HubSpot and Zoho; tag collects AI tagging results "
+                             "and adds them to the notes")
+    parser.add_argument("--headless", action="store_true", default=HEADLESS,
+                        help="skip the browser OAuth flow and use the stored refresh tokens (also MIGRATION_HEADLESS=1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="run this many worker processes, each on its own shard of the deals")
+    parser.add_argument("--shard", type=int, default=0,
+                        help="shard handled by this process (with --shards, for running workers on several hosts)")
+    parser.add_argument("--shards", type=int, default=1, help="total number of shards")
+    parser.add_argument("--delta", action="store_true", default=DELTA_SYNC,
+                        help="only migrate deals and attachments changed since the last clean pass (also MIGRATION_DELTA=1)")
+    parser.add_argument("--reconciled", action="store_true",
+                        help="re-run only the deals with discrepancies found by the last reconcile")
+    args = parser.parse_args()
+    if args.reconciled and (args.command != "migrate" or args.workers > 1 or args.shards > 1):
+        parser.error("--reconciled runs a single migrate process")
+    if args.command in ("reconcile", "tag") and (args.workers > 1 or args.shards > 1):
+        parser.error(f"{args.command} runs in a single process")
+    EVENTS.start(args.shard, args.shards)
+    try:
+        if args.workers > 1:
+            run_workers(args.workers, headless=args.headless, delta=args.delta, command=args.command)
+        else:
+            migrate_attachments(headless=args.headless, shard=args.shard, shards=args.shards, delta=args.delta, command=args.command,
+                                reconciled=args.reconciled)
+    except (Exception, KeyboardInterrupt) as e:
+        EVENTS.crash(e)
+        raise
\ No newline at end of file